@@ -3,44 +3,39 @@ import pandas as pd
 import smtplib
 import ssl
 import time
-import re
 import csv
-import io
-import base64
-import sqlite3
-import random
 import datetime
-import streamlit.components.v1 as components
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.utils import make_msgid
-
-# --- DATABASE INIT ---
-def init_db():
-    conn = sqlite3.connect('campaigns.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS scheduled_emails (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            target_email TEXT,
-            sender_name TEXT,
-            sender_email TEXT,
-            sender_password TEXT,
-            subject TEXT,
-            html_body TEXT,
-            send_at DATETIME,
-            status TEXT DEFAULT 'pending',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-init_db()
+import io
+import os
+import uuid
+from collections import deque
+from dripmailer import outbox, storage
+from dripmailer.aiosmtp import AsyncSessions, AsyncSMTPPool
+from dripmailer.campaign import CampaignRunner
+from dripmailer.dispatcher import Dispatcher, queued_subject
+from dripmailer.execlog import ExecutionLog, new_log_path
+from dripmailer.inbox import InboxScanner
+from dripmailer.leads import missing_columns, read_columns, spool_csv
+from dripmailer.metrics import Metrics, profile_summary, profiled
+from dripmailer.planner import SendPlanner, parse_holidays
+from dripmailer.preview import PreviewEngine, count_fallbacks, template_keys
+from dripmailer.ratelimit import describe_error
+from dripmailer.signatures import LAYOUTS, signature_html
+from dripmailer.smtp_pool import SMTPPool, close_smtp, open_smtp
+from dripmailer.suppression import SuppressionList, import_csv
 
 # --- PAGE CONFIG ---
 st.set_page_config(page_title="Drip Mailer", page_icon="📧", layout="wide")
 
+# --- DATABASE INIT ---
+# Once per server process, not on every rerun
+@st.cache_resource(show_spinner=False)
+def init_database():
+    storage.init_db()
+    return True
+
+init_database()
+
 # --- CUSTOM CSS (Dark Theme + B2CC40 Green) ---
 st.markdown("""
 <style>
@@ -135,7 +130,31 @@ if 'sig_website' not in st.session_state: st.session_state['sig_website'] = "htt
 if 'sig_avatar' not in st.session_state: st.session_state['sig_avatar'] = "https://images.unsplash.com/photo-1531831108325-7fe9616bc780?auto=format&fit=crop&fm=jpg&q=60&w=300"
 if 'sig_logo' not in st.session_state: st.session_state['sig_logo'] = "https://mail.streamax.com/coremail/s?func=lp:getImg&org_id=&img_id=logo_001"
 if 'sig_layout' not in st.session_state: st.session_state['sig_layout'] = "Creative with Avatar"
-if 'latest_log_csv' not in st.session_state: st.session_state['latest_log_csv'] = ""
+if 'latest_log_path' not in st.session_state: st.session_state['latest_log_path'] = ""
+if 'pool_workers' not in st.session_state: st.session_state['pool_workers'] = 4
+if 'pool_conn_rate' not in st.session_state: st.session_state['pool_conn_rate'] = 1.0
+if 'pool_global_rate' not in st.session_state: st.session_state['pool_global_rate'] = 4.0
+if 'pool_account_rate' not in st.session_state: st.session_state['pool_account_rate'] = 2.0
+if 'pool_domain_rate' not in st.session_state: st.session_state['pool_domain_rate'] = 0.0
+if 'pool_max_retries' not in st.session_state: st.session_state['pool_max_retries'] = 2
+if 'queue_max_attempts' not in st.session_state: st.session_state['queue_max_attempts'] = 5
+if 'enqueue_batch' not in st.session_state: st.session_state['enqueue_batch'] = 500
+if 'seq_preenqueue' not in st.session_state: st.session_state['seq_preenqueue'] = False
+if 'use_outbox' not in st.session_state: st.session_state['use_outbox'] = False
+if 'send_all_accounts' not in st.session_state: st.session_state['send_all_accounts'] = False
+if 'skip_contacted' not in st.session_state: st.session_state['skip_contacted'] = True
+if 'metrics_path' not in st.session_state: st.session_state['metrics_path'] = "send_metrics.jsonl"
+if 'profile_sends' not in st.session_state: st.session_state['profile_sends'] = False
+if 'async_smtp' not in st.session_state: st.session_state['async_smtp'] = False
+if 'plan_start_hour' not in st.session_state: st.session_state['plan_start_hour'] = 9
+if 'plan_end_hour' not in st.session_state: st.session_state['plan_end_hour'] = 17
+if 'plan_capacity' not in st.session_state: st.session_state['plan_capacity'] = 0
+if 'plan_holidays' not in st.session_state: st.session_state['plan_holidays'] = ""
+if 'plan_lead_timezones' not in st.session_state: st.session_state['plan_lead_timezones'] = False
+if 'archive_days' not in st.session_state: st.session_state['archive_days'] = 30
+if 'queue_cursors' not in st.session_state: st.session_state['queue_cursors'] = [None]
+if 'preview_leads' not in st.session_state: st.session_state['preview_leads'] = 3
+if 'preview_seed' not in st.session_state: st.session_state['preview_seed'] = 0
 
 # Follow-up Templates State
 for i in range(5):
@@ -159,72 +178,430 @@ Would you be open to a brief 10-minute chat next week?
 
 Best regards,"""
 
-DISCLAIMER_HTML = (
-    '<div style="margin-top: 25px; padding-top: 15px; border-top: 1px solid #e2e8f0; font-family: Arial, sans-serif; font-size: 10px; color: #64748b; line-height: 1.4; text-align: justify;">'
-    '<strong>Email Disclaimer:</strong> This e-mail is intended only for the person or entity to which it is addressed and may contain confidential and/or privileged material. Any review, retransmission, dissemination or other use of, or taking of any action in reliance upon, the information in this e-mail by persons or entities other than the intended recipient is prohibited and may be unlawful. If you received this e-mail in error, please contact the sender and delete it from any computer.'
-    '</div>'
-)
-
-def get_signature_html(sig_id, data):
-    if sig_id == "Minimalist Professional":
-        html = (
-            '<div style="font-family: Arial, sans-serif; color: #333; margin-top: 20px; border-top: 1px solid #eee; padding-top: 15px;">'
-            f'<p style="margin: 0; font-weight: bold; font-size: 14px; color: #000000;">{data["name"]}</p>'
-            f'<p style="margin: 0; font-size: 12px; color: #666;">{data["title"]} | <a href="{data["website"]}" style="color: #666; text-decoration: none;">{data["company"]}</a></p>'
-            f'<p style="margin: 0; font-size: 12px; color: #0066cc;">{data["email"]} | {data["phone"]}</p>'
-            '</div>'
-        )
-        return html + DISCLAIMER_HTML
-    elif sig_id == "Creative with Avatar":
-        html = (
-            '<div style="font-family: \'Helvetica Neue\', Helvetica, Arial, sans-serif; margin-top: 20px; display: flex; align-items: center; gap: 15px;">'
-            f'<img src="{data["avatarUrl"]}" alt="Avatar" style="width: 60px; height: 60px; border-radius: 50%; object-fit: cover; border: 2px solid #e2e8f0;" />'
-            '<div>'
-            f'<p style="margin: 0; font-weight: 600; font-size: 15px; color: #1e293b;">{data["name"]}</p>'
-            f'<p style="margin: 2px 0; font-size: 13px; color: #64748b;">{data["title"]}</p>'
-            f'<p style="margin: 2px 0; font-size: 13px; color: #3b82f6;">{data["email"]} <span style="color: #94a3b8;">|</span> <span style="color: #64748b;">{data["phone"]}</span></p>'
-            f'<a href="{data["website"]}" style="margin: 0; font-size: 13px; color: #3b82f6; text-decoration: none;">{data["company"]}</a>'
-            '</div></div>'
-        )
-        return html + DISCLAIMER_HTML
-    else: # Corporate with Logo
-        html = (
-            '<div style="font-family: Arial, sans-serif; margin-top: 25px;">'
-            f'<p style="margin: 0; font-weight: bold; font-size: 14px; color: #0f172a;">{data["name"]}</p>'
-            f'<p style="margin: 2px 0 5px 0; font-size: 12px; color: #475569;">{data["title"]}</p>'
-            f'<p style="margin: 0; font-size: 12px; color: #B2CC40;"><strong><a href="{data["website"]}" style="color: #B2CC40; text-decoration: none;">{data["company"]}</a></strong></p>'
-            f'<p style="margin: 4px 0 12px 0; font-size: 12px; color: #475569;"><a href="mailto:{data["email"]}" style="color: #B2CC40; text-decoration: none;">{data["email"]}</a> | {data["phone"]}</p>'
-            f'<img src="{data["logoUrl"]}" alt="Company Logo" style="height: 45px; border-radius: 4px;" />'
-            '</div>'
-        )
-        return html + DISCLAIMER_HTML
+if 'main_subj' not in st.session_state: st.session_state['main_subj'] = "Streamlining Operations at {company}"
+if 'main_body' not in st.session_state: st.session_state['main_body'] = DEFAULT_BODY
 
 # --- HELPER FUNCTIONS ---
-def render_template(template_str, row):
-    def replace_var(match):
-        key = match.group(1).lower().strip()
-        val = row.get(key, "")
-        # Ensure NaN or empty strings gracefully fallback to the bracketed variable name
-        return str(val) if pd.notna(val) and str(val).strip() != "" and str(val).lower() != "nan" else f"[{match.group(1)}]"
-    return re.sub(r'\{([^}]+)\}', replace_var, template_str)
-
-def create_message(subject, html_body, to_addr, from_name, from_email):
-    msg = MIMEMultipart("alternative")
-    msg["From"] = f"{from_name} <{from_email}>"
-    msg["To"] = to_addr
-    msg["Subject"] = subject
-    msg["Message-ID"] = make_msgid(domain=from_email.split("@")[-1])
-    msg.attach(MIMEText(html_body, "html", "utf-8"))
-    return msg
-
-def get_random_business_time(days_ahead):
-    """Calculates future date with a random time between 9 AM and 4:59 PM"""
-    target_date = datetime.datetime.now() + datetime.timedelta(days=days_ahead)
-    random_hour = random.randint(9, 16)
-    random_minute = random.randint(0, 59)
-    random_second = random.randint(0, 59)
-    target_time = target_date.replace(hour=random_hour, minute=random_minute, second=random_second, microsecond=0)
-    return target_time.strftime('%Y-%m-%d %H:%M:%S')
+def rejects_download_button(campaign_id):
+    """The skipped-rows file is built only when the button is clicked, not on every rerun"""
+    def build_csv():
+        out = io.StringIO()
+        writer = None
+        conn = storage.connect()
+        try:
+            for reject in storage.iter_rejects(conn, campaign_id):
+                if writer is None:
+                    writer = csv.DictWriter(out, fieldnames=list(reject))
+                    writer.writeheader()
+                writer.writerow(reject)
+        finally:
+            conn.close()
+        return out.getvalue()
+    st.download_button("Download Skipped Rows (CSV)", data=build_csv, file_name="skipped_leads.csv", mime="text/csv", on_click="ignore")
+
+# Queue Manager data is cached briefly so reruns on the other tabs don't hit the database
+QUEUE_CACHE_TTL = 5
+QUEUE_PAGE_SIZE = 50
+# Days ahead shown in the Queue Manager's hourly load chart
+LOAD_DAYS = 14
+# Live log panels: lines shown and seconds between redraws
+LOG_TAIL = 15
+LOG_REFRESH = 0.25
+
+@st.cache_data(ttl=QUEUE_CACHE_TTL, show_spinner=False)
+def load_queue_counts():
+    conn = storage.connect()
+    try:
+        return storage.queue_counts(conn)
+    finally:
+        conn.close()
+
+@st.cache_data(ttl=QUEUE_CACHE_TTL, show_spinner=False)
+def load_pending_page(after, limit=QUEUE_PAGE_SIZE):
+    """Returns (table rows, (send_at, id) of the last row) for one page of the pending queue"""
+    conn = storage.connect()
+    try:
+        rows = storage.pending_page(conn, after, limit)
+    finally:
+        conn.close()
+    table = [{
+        "ID": r['id'],
+        "Target Email": r['target_email'],
+        "Subject": queued_subject(r),
+        "Scheduled For": storage.format_ts(r['send_at']),
+        "Attempts": r['attempts'],
+        "Last Error": r['last_error'] or ""
+    } for r in rows]
+    last_key = (rows[-1]['send_at'], rows[-1]['id']) if rows else None
+    return table, last_key
+
+@st.cache_data(ttl=QUEUE_CACHE_TTL, show_spinner=False)
+def load_accounts():
+    conn = storage.connect()
+    try:
+        return storage.accounts_overview(conn)
+    finally:
+        conn.close()
+
+@st.cache_data(ttl=QUEUE_CACHE_TTL, show_spinner=False)
+def load_unfinished_campaigns():
+    """(campaign, lead counts by status) for each batch send that stopped before reaching every lead"""
+    conn = storage.connect()
+    try:
+        return [(dict(c), storage.lead_status_counts(conn, c['id'])) for c in storage.unfinished_campaigns(conn)]
+    finally:
+        conn.close()
+
+@st.cache_data(ttl=QUEUE_CACHE_TTL, show_spinner=False)
+def load_suppressions(search=""):
+    """(counts by kind, the newest matching entries) for the Setup tab"""
+    conn = storage.connect()
+    try:
+        rows = storage.suppression_page(conn, search)
+        return storage.suppression_counts(conn), [{
+            "Address / Domain": r['value'],
+            "Reason": r['reason'],
+            "Source": r['source'],
+            "Added": storage.format_ts(r['created_at']),
+            "Expires": storage.format_ts(r['expires_at']) or "Never",
+        } for r in rows]
+    finally:
+        conn.close()
+
+@st.cache_data(ttl=QUEUE_CACHE_TTL, show_spinner=False)
+def load_storage_stats(archive_days):
+    """Queue/archive row counts, database size and how many rows archive_days would move"""
+    conn = storage.connect()
+    try:
+        return storage.storage_stats(conn), storage.archivable_count(conn, archive_days)
+    finally:
+        conn.close()
+
+@st.cache_data(ttl=QUEUE_CACHE_TTL, show_spinner=False)
+def load_hourly_load(days=LOAD_DAYS):
+    """Pending emails per sender account and clock hour over the next `days` days"""
+    start = storage.hour_start(storage.now_ts())
+    conn = storage.connect()
+    try:
+        booked = storage.booked_per_hour(conn, start, start + days * 86400)
+    finally:
+        conn.close()
+    return pd.DataFrame(
+        [{"Hour": datetime.datetime.fromtimestamp(hour), "Account": sender, "Emails": count} for (sender, hour), count in booked.items()],
+        columns=["Hour", "Account", "Emails"],
+    )
+
+def clear_queue_cache():
+    """Call after anything writes to the queue"""
+    load_queue_counts.clear()
+    load_pending_page.clear()
+    load_hourly_load.clear()
+    load_storage_stats.clear()
+
+def archive_queue(enable_vacuum=False):
+    """Button callback: archives queue rows finished more than archive_days days ago"""
+    conn = storage.connect()
+    try:
+        if enable_vacuum:
+            storage.enable_incremental_vacuum(conn)
+        archived = storage.archive_finished(conn, st.session_state['archive_days'])
+        freed = storage.reclaim_space(conn)
+    finally:
+        conn.close()
+        clear_queue_cache()
+    st.session_state['archive_result'] = f"Archived {archived} emails and freed {freed / 1e6:.1f} MB of disk space."
+
+def show_metrics(placeholder, metrics):
+    """Draws the live send metrics panel into an st.empty() placeholder"""
+    snap = metrics.snapshot()
+    with placeholder.container():
+        col_t1, col_t2, col_t3 = st.columns(3)
+        col_t1.metric("Messages Finished", snap['messages'])
+        col_t2.metric("Avg Emails/sec", f"{snap['msgs_per_sec']:.2f}")
+        col_t3.metric("Current Emails/sec", f"{snap['current_msgs_per_sec']:.2f}")
+        if snap['stages']:
+            st.dataframe(pd.DataFrame([
+                {"Stage": name, "Count": s['count'], "Mean (ms)": s['mean_ms'], "p50 (ms)": s['p50_ms'], "p99 (ms)": s['p99_ms'], "Max (ms)": s['max_ms'], "Total (s)": s['total_s']}
+                for name, s in snap['stages'].items()
+            ]), use_container_width=True, hide_index=True)
+        errors = [c for c in snap['counters'] if c['name'] == 'smtp_errors_total']
+        if errors:
+            st.caption("SMTP errors by reply code: " + ", ".join(f"{c['labels']['code']}: {c['value']}" for c in errors))
+
+# Queue sends reuse these across button presses; NOOPs keep them open in between
+@st.cache_resource(show_spinner=False)
+def smtp_sessions():
+    return AsyncSessions()
+
+def export_metrics(metrics):
+    if st.session_state['metrics_path']:
+        try:
+            metrics.export(st.session_state['metrics_path'])
+        except OSError as e:
+            st.warning(f"Could not write metrics to {st.session_state['metrics_path']}: {e}")
+
+def log_download_button(path, key=None):
+    """The file is read only when the button is clicked, not on every rerun"""
+    def read_log():
+        with open(path, 'rb') as f:
+            return f.read()
+    st.download_button(
+        label="📥 Download Latest Execution Log (CSV)",
+        data=read_log,
+        file_name=os.path.basename(path),
+        mime="text/csv",
+        on_click="ignore",
+        key=key,
+    )
+
+# Sample data for the editor previews, standing in for a lead
+SAMPLE_LEAD = {"first_name": "John", "company": "Acme Corp", "role": "Manager"}
+
+# Shared by every session; entries are keyed on content hashes and lead ids
+@st.cache_resource(show_spinner=False)
+def preview_engine():
+    return PreviewEngine()
+
+# Leads never change once spooled, so these need no TTL
+@st.cache_data(show_spinner=False, max_entries=32)
+def load_sample_leads(campaign_id, n, seed):
+    conn = storage.connect()
+    try:
+        return storage.sample_leads(conn, campaign_id, n, seed)
+    finally:
+        conn.close()
+
+# Keyed on the placeholders rather than the template text, so typing doesn't rescan the list
+@st.cache_data(show_spinner=False, max_entries=64)
+def load_fallback_counts(campaign_id, keys, your_name):
+    conn = storage.connect()
+    try:
+        return count_fallbacks(storage.iter_leads(conn, campaign_id), keys, {'your_name': your_name})
+    finally:
+        conn.close()
+
+def show_preview_card(preview):
+    preview_html = (
+        '<div style="background-color: #ffffff; color: #1e293b; padding: 24px; border-radius: 8px; border: 1px solid #cbd5e1; font-family: Arial, sans-serif; box-shadow: 0 4px 6px -1px rgba(0, 0, 0, 0.1);">'
+        '<div style="border-bottom: 1px solid #e2e8f0; padding-bottom: 12px; margin-bottom: 20px;">'
+        '<span style="color: #64748b; font-size: 13px; font-weight: 600; text-transform: uppercase;">Subject:</span>'
+        f'<span style="color: #0f172a; font-size: 15px; font-weight: bold; margin-left: 8px;">{preview.subject}</span>'
+        '</div>'
+        '<div style="font-size: 14px; line-height: 1.6; color: #334155;">'
+        f'{preview.body_html}'
+        '</div></div>'
+    )
+    st.markdown(preview_html, unsafe_allow_html=True)
+
+def show_email_preview(subject_template, body_template, sig_html):
+    show_preview_card(preview_engine().render(subject_template, body_template, sig_html, st.session_state['sig_name'], None, SAMPLE_LEAD))
+    show_lead_previews(subject_template, body_template, sig_html)
+
+def show_lead_previews(subject_template, body_template, sig_html):
+    """Placeholder check over the whole uploaded list, then the template rendered for a few of its leads"""
+    spool = st.session_state.get('lead_spool')
+    if not spool or not spool['valid']:
+        return
+    keys = tuple(template_keys(subject_template, body_template))
+    if keys:
+        counts, total = load_fallback_counts(spool['campaign_id'], keys, st.session_state['sig_name'])
+        fallbacks = [f"`{{{key}}}` for {n} of {total} leads" for key, n in counts.items() if n]
+        if fallbacks:
+            st.warning("Some leads would get the [placeholder] fallback text: " + ", ".join(fallbacks))
+        else:
+            st.caption(f"✅ Every placeholder has a value for all {total} uploaded leads.")
+    if st.session_state['preview_leads']:
+        leads = load_sample_leads(spool['campaign_id'], st.session_state['preview_leads'], st.session_state['preview_seed'])
+        with st.expander(f"👥 Preview with {len(leads)} uploaded leads"):
+            for preview in preview_engine().render_leads(subject_template, body_template, sig_html, st.session_state['sig_name'], leads):
+                st.caption(f"To: {preview.email}")
+                show_preview_card(preview)
+
+# Each editor is a fragment: typing in it re-runs only the editor and its own preview
+@st.fragment
+def main_editor(sig_html):
+    col1, col2 = st.columns(2)
+    with col1:
+        st.text_input("Subject Line", key="main_subj")
+        st.text_area("Email Body", height=350, key="main_body")
+    with col2:
+        st.caption("Live HTML Preview (Sample Data)")
+        show_email_preview(st.session_state['main_subj'], st.session_state['main_body'], sig_html)
+
+@st.fragment
+def followup_editor(i, sig_html):
+    # Tab labels pick up a renamed template on the next full rerun
+    st.text_input("Template Name", key=f't_name_{i}')
+    col_t1, col_t2 = st.columns(2)
+    with col_t1:
+        st.text_input(f"Subject Line", key=f't_subj_{i}')
+        st.text_area(f"Email Body", height=250, key=f't_body_{i}')
+    with col_t2:
+        st.caption("Live HTML Preview (Sample Data)")
+        show_email_preview(st.session_state[f't_subj_{i}'], st.session_state[f't_body_{i}'], sig_html)
+
+def prepare_outbox(conn, campaign_id, senders, logs):
+    """Opens the campaign's outbox, rendering it on every CPU first unless an earlier run (or
+    `python -m dripmailer outbox build`) already did."""
+    path = outbox.outbox_path(campaign_id)
+    if not outbox.exists(path):
+        status = st.empty()
+        started = time.perf_counter()
+        stats = outbox.build(conn, campaign_id, path, senders,
+                             on_progress=lambda done, total: status.caption(f"Rendering emails into the outbox: {done}/{total} leads..."))
+        status.empty()
+        logs.append(f"📦 [{time.strftime('%X')}] Rendered {stats['messages']} emails for {stats['leads']} leads in {time.perf_counter() - started:.1f}s")
+    spooled = outbox.Outbox(path)
+    logs.append(f"📦 [{time.strftime('%X')}] Sending from the outbox {path} ({len(spooled)} emails)")
+    return spooled
+
+def run_campaign(campaign_id, username, password, templates=None, resend_unconfirmed=False, use_accounts=False):
+    """Sends (or resumes) a stored campaign with a live progress bar and log.
+    templates, when given, are saved as the campaign's template set once the login succeeded."""
+    try:
+        holidays = parse_holidays(st.session_state['plan_holidays'])
+    except ValueError as e:
+        st.error(f"Invalid holiday list, use YYYY-MM-DD dates: {e}")
+        return
+    if st.session_state['plan_start_hour'] >= st.session_state['plan_end_hour']:
+        st.error("Business hours must end after they start.")
+        return
+    accounts_conn = storage.connect()
+    campaign = storage.get_campaign(accounts_conn, campaign_id) if templates is None else None
+    accounts = storage.campaign_accounts(accounts_conn, campaign or {'sender_email': username, 'sender_password': password, 'use_accounts': use_accounts})
+    accounts_conn.close()
+    progress_bar = st.progress(0)
+    log_container = st.empty()
+    # Only the on-screen tail is kept in memory; the full log goes to disk row by row
+    logs = deque(maxlen=LOG_TAIL)
+    progress = {'done': 0, 'total': 0, 'panel_at': 0.0, 'tail_at': 0.0}
+    metrics = Metrics()
+    with st.expander("📈 Send Metrics", expanded=True):
+        metrics_panel = st.empty()
+    
+    # --- Prepare CSV Logging ---
+    log_path = new_log_path(campaign_id)
+    log_file = open(log_path, 'w', newline='', encoding='utf-8')
+    execution_log = ExecutionLog(log_file)
+    st.session_state['latest_log_path'] = log_path
+    
+    def show_tail():
+        progress_bar.progress(min(1.0, progress['done'] / max(1, progress['total'])))
+        log_container.code('\n'.join(logs), language='text')
+        progress['tail_at'] = time.monotonic()
+    
+    def on_event(event, subject, detail):
+        execution_log.on_event(event, subject, detail)
+        if event == 'start':
+            progress['total'] = subject
+            logs.append(f"▶️ [{time.strftime('%X')}] {subject} leads to send")
+        elif event == 'unconfirmed':
+            action = "sending them again" if detail else "skipping them"
+            logs.append(f"⚠️ [{time.strftime('%X')}] {subject} leads were in flight when the last run stopped, {action}")
+        elif event == 'suppressed':
+            logs.append(f"🚫 [{time.strftime('%X')}] Skipping {subject} leads on the suppression list or already emailed by another campaign")
+        elif event == 'prescheduled':
+            logs.append(f"⏳ [{time.strftime('%X')}] Pre-scheduled {subject} follow-ups")
+        elif event == 'quota_exhausted':
+            resets = f", quotas reset at {detail:%Y-%m-%d %H:%M}" if detail else ""
+            logs.append(f"⛔ [{time.strftime('%X')}] Every sender account is out of quota, {subject} leads left{resets}")
+        elif event == 'cancelled':
+            if subject:
+                logs.append(f"🚫 [{time.strftime('%X')}] Cancelled {subject} follow-ups of leads whose main email was not sent")
+        elif event == 'scheduled':
+            tmpl_name, send_at_time = detail
+            logs.append(f"⏳ [{time.strftime('%X')}] Queued '{tmpl_name}' for {subject['email']} at {send_at_time:%Y-%m-%d %H:%M:%S}")
+        else:
+            if event == 'sent':
+                logs.append(f"✅ [{time.strftime('%X')}] Sent successfully to {subject['email']}")
+            else:
+                logs.append(f"❌ [{time.strftime('%X')}] Failed to send to {subject['email']}: {describe_error(detail)}")
+            progress['done'] += 1
+            if time.monotonic() - progress['panel_at'] >= 1:
+                show_metrics(metrics_panel, metrics)
+                progress['panel_at'] = time.monotonic()
+        # Each redraw is a message to the browser, so fast runs are redrawn a few times a second
+        if time.monotonic() - progress['tail_at'] >= LOG_REFRESH:
+            show_tail()
+    
+    try:
+        pool_class = AsyncSMTPPool if st.session_state['async_smtp'] else SMTPPool
+        with pool_class(
+            username,
+            password,
+            workers=st.session_state['pool_workers'],
+            per_connection_rate=st.session_state['pool_conn_rate'],
+            global_rate=st.session_state['pool_global_rate'],
+            account_rate=st.session_state['pool_account_rate'],
+            domain_rate=st.session_state['pool_domain_rate'],
+            max_retries=st.session_state['pool_max_retries'],
+            metrics=metrics,
+            accounts=accounts,
+        ) as pool:
+            for failed_email, login_error in pool.failed_logins.items():
+                st.warning(f"Could not log in as {failed_email}, sending without it: {login_error}")
+            conn = storage.connect()
+            spooled = None
+            try:
+                # Sender, signature and templates are stored once; follow-ups only reference them
+                if templates is not None:
+                    storage.save_campaign(conn, campaign_id, st.session_state['sig_name'], username, password, selected_sig_html, templates,
+                                          use_accounts=use_accounts)
+                
+                execution_log.write_config(storage.campaign_templates(conn, campaign_id))
+                
+                if st.session_state['use_outbox']:
+                    spooled = prepare_outbox(conn, campaign_id, pool.senders, logs)
+                    show_tail()
+                
+                # Each lead's outcome is checkpointed in campaigns.db, so an interrupted run can be resumed
+                planner = SendPlanner(conn, capacity=st.session_state['plan_capacity'],
+                                      start_hour=st.session_state['plan_start_hour'], end_hour=st.session_state['plan_end_hour'],
+                                      holidays=holidays, lead_timezones=st.session_state['plan_lead_timezones'])
+                runner = CampaignRunner(
+                    conn, campaign_id,
+                    schedule=planner,
+                    skip_contacted=st.session_state['skip_contacted'],
+                    pre_enqueue=st.session_state['seq_preenqueue'],
+                    enqueue_batch=st.session_state['enqueue_batch'],
+                    metrics=metrics,
+                    outbox=spooled,
+                )
+                if st.session_state['profile_sends']:
+                    # Profiles rendering, MIME building and DB work on this thread; SMTP runs on the pool threads
+                    profile_path = f"campaign_{time.strftime('%Y%m%d_%H%M%S')}.prof"
+                    with profiled(profile_path) as profiler:
+                        runner.run(pool, on_event=on_event, resend_unconfirmed=resend_unconfirmed)
+                    with st.expander("🔬 cProfile Summary"):
+                        st.code(profile_summary(profiler), language='text')
+                        with open(profile_path, 'rb') as f:
+                            st.download_button("Download Profile (.prof)", data=f.read(), file_name=profile_path)
+                else:
+                    runner.run(pool, on_event=on_event, resend_unconfirmed=resend_unconfirmed)
+            finally:
+                if spooled is not None:
+                    spooled.close()
+                conn.close()
+                show_tail()
+                show_metrics(metrics_panel, metrics)
+                export_metrics(metrics)
+        if runner.out_of_quota:
+            st.warning("Every sender account reached its quota before all leads were sent. Resume the campaign from Unfinished Campaigns once the quotas reset.")
+        st.success(f"Batch Processing Complete! The execution log was written to `{log_path}`.")
+        log_download_button(log_path, key="log_download_run")
+        
+    except smtplib.SMTPAuthenticationError:
+        st.error("Email or passwords incorrect. Please return to the Setup tab to re-authenticate.")
+    except Exception as e:
+        if '535' in str(e) or 'authentication failed' in str(e).lower():
+            st.error("Email or passwords incorrect. Please return to the Setup tab to re-authenticate.")
+        else:
+            st.error(f"SMTP Connection Error: {str(e)}")
+    finally:
+        log_file.close()
+        # Follow-ups were queued (and maybe cancelled) above
+        clear_queue_cache()
+        load_unfinished_campaigns.clear()
 
 # Generate current signature html to share across tabs
 sig_data = {
@@ -237,7 +614,7 @@ sig_data = {
     "avatarUrl": st.session_state['sig_avatar'],
     "logoUrl": st.session_state['sig_logo']
 }
-selected_sig_html = get_signature_html(st.session_state['sig_layout'], sig_data)
+selected_sig_html = signature_html(st.session_state['sig_layout'], sig_data)
 
 # --- TABS ---
 tab0, tab1, tab2, tab3, tab4 = st.tabs(["0. Setup", "1. Signatures", "2. Compose", "3. Data & Sending", "4. Queue Manager"])
@@ -245,7 +622,7 @@ tab0, tab1, tab2, tab3, tab4 = st.tabs(["0. Setup", "1. Signatures", "2. Compose
 # --- TAB 0: SETUP ---
 with tab0:
     st.markdown("<h2>Environment <span class='brand-text'>Setup</span></h2>", unsafe_allow_html=True)
-    st.write("To securely send emails from the cloud, enter your Streamax credentials here. They are temporarily held in memory for this session only and are never saved to a database.")
+    st.write("To send emails from the cloud, enter your Streamax credentials here. They are held in memory for this session, and the password is also saved unencrypted in campaigns.db when you start a batch send (so the campaign can be resumed and its follow-ups sent) or add it as a sender account below. Keep campaigns.db private.")
     
     with st.container():
         col1, col2 = st.columns(2)
@@ -276,6 +653,129 @@ with tab0:
             else:
                 st.error("Please provide a valid @streamax.com email and password.")
 
+    st.markdown("<h3>Sending <span class='brand-text'>Performance</span></h3>", unsafe_allow_html=True)
+    st.write("Batch sends run over several SMTP connections in parallel. Keep the rates within what mail.streamax.com allows for your account.")
+    col_p1, col_p2, col_p3, col_p4 = st.columns(4)
+    with col_p1:
+        st.number_input("Parallel Connections", min_value=1, max_value=16, step=1, key="pool_workers")
+    with col_p2:
+        st.number_input("Max Emails/sec per Connection", min_value=0.1, step=0.1, key="pool_conn_rate")
+    with col_p3:
+        st.number_input("Max Emails/sec per Account", min_value=0.1, step=0.1, key="pool_account_rate")
+    with col_p4:
+        st.number_input("Max Emails/sec Overall", min_value=0.1, step=0.1, key="pool_global_rate")
+    st.write("Rates are halved automatically while the server answers with temporary (4xx) throttling errors and recover as sends succeed. Permanent (5xx) rejections are never retried.")
+    col_r1, col_r2, col_r3 = st.columns(3)
+    with col_r1:
+        st.number_input("Max Emails/sec per Recipient Domain (0 = no limit)", min_value=0.0, step=0.5, key="pool_domain_rate")
+    with col_r2:
+        st.number_input("Retries per Email (Batch Send)", min_value=0, max_value=10, step=1, key="pool_max_retries")
+    with col_r3:
+        st.number_input("Attempts per Queued Follow-up", min_value=1, max_value=20, step=1, key="queue_max_attempts")
+    st.number_input("Follow-ups Written per DB Transaction", min_value=1, max_value=10000, step=100, key="enqueue_batch")
+    st.checkbox("Use the asyncio SMTP engine (pipelines commands when the server allows it and keeps queue sessions open between runs; faster on high-latency links)", key="async_smtp")
+    col_m1, col_m2 = st.columns(2)
+    with col_m1:
+        st.text_input("Metrics File (.prom for Prometheus text, anything else for JSON lines; empty to disable)", key="metrics_path")
+    with col_m2:
+        st.checkbox("Profile batch sends with cProfile (adds overhead)", key="profile_sends")
+
+    st.markdown("<h3>Sender <span class='brand-text'>Accounts</span></h3>", unsafe_allow_html=True)
+    st.write("Extra mailboxes a campaign can be spread over, each with the daily and hourly quota its relay allows (0 = no cap). Follow-ups go out from the account that sent the lead's first email. An account that reaches its quota hands its remaining leads to the others; queued follow-ups wait for the reset. Passwords are stored in campaigns.db.")
+    accounts_view = load_accounts()
+    if accounts_view:
+        st.dataframe(pd.DataFrame([{
+            "Account": a['email'],
+            "Sender Name": a['sender_name'] or "(campaign's)",
+            "Enabled": bool(a['enabled']),
+            "Sent Today": f"{a['sent_today']} / {a['daily_quota'] or '∞'}",
+            "Sent This Hour": f"{a['sent_this_hour']} / {a['hourly_quota'] or '∞'}",
+        } for a in accounts_view]), use_container_width=True, hide_index=True)
+    with st.form("account_form", clear_on_submit=True):
+        col_a1, col_a2, col_a3 = st.columns(3)
+        with col_a1:
+            account_email = st.text_input("Account Email", placeholder="sales2@streamax.com")
+            account_name = st.text_input("Sender Name (empty = campaign's)")
+        with col_a2:
+            account_pass = st.text_input("Password (empty keeps the saved one)", type="password")
+            account_enabled = st.checkbox("Enabled", value=True)
+        with col_a3:
+            account_daily = st.number_input("Daily Quota", min_value=0, step=50, value=0)
+            account_hourly = st.number_input("Hourly Quota", min_value=0, step=10, value=0)
+        if st.form_submit_button("Save Account"):
+            accounts_conn = storage.connect()
+            try:
+                if not account_email or (not account_pass and storage.get_account(accounts_conn, account_email) is None):
+                    st.error("A new account needs an email address and a password.")
+                else:
+                    if account_pass:
+                        with st.spinner(f"Verifying {account_email}..."):
+                            close_smtp(open_smtp(account_email, account_pass, timeout=15))
+                    storage.save_account(accounts_conn, account_email, account_pass, account_name, account_daily, account_hourly, account_enabled)
+                    load_accounts.clear()
+                    st.success(f"Saved {account_email}.")
+            except smtplib.SMTPAuthenticationError:
+                st.error("Email or passwords incorrect.")
+            except Exception as e:
+                st.error(f"Could not connect to the mail server: {str(e)}")
+            finally:
+                accounts_conn.close()
+    if accounts_view:
+        col_d1, col_d2 = st.columns([3, 1])
+        with col_d1:
+            remove_email = st.selectbox("Account", [a['email'] for a in accounts_view], key="remove_account", label_visibility="collapsed")
+        with col_d2:
+            if st.button("Remove Account", use_container_width=True):
+                accounts_conn = storage.connect()
+                storage.delete_account(accounts_conn, remove_email)
+                accounts_conn.close()
+                load_accounts.clear()
+                st.rerun()
+
+    st.markdown("<h3>Suppression <span class='brand-text'>List</span></h3>", unsafe_allow_html=True)
+    st.write("Addresses and domains that are never emailed, by batch sends or queued follow-ups. Addresses the mail server permanently refuses are added automatically. A domain entry such as `example.com` also covers its subdomains.")
+    suppression_search = st.text_input("Search", key="suppression_search", placeholder="name@company.com or company.com")
+    suppression_counts, suppression_rows = load_suppressions(suppression_search)
+    col_sc1, col_sc2, col_sc3 = st.columns(3)
+    col_sc1.metric("Addresses", suppression_counts['address'])
+    col_sc2.metric("Domains", suppression_counts['domain'])
+    col_sc3.metric("Expired", suppression_counts['expired'])
+    if suppression_rows:
+        st.dataframe(pd.DataFrame(suppression_rows), use_container_width=True, hide_index=True)
+    with st.form("suppression_form", clear_on_submit=True):
+        col_sf1, col_sf2 = st.columns(2)
+        with col_sf1:
+            suppression_file = st.file_uploader("Import CSV (an email or domain column, or one value per line)", type=["csv", "txt"])
+            suppression_values = st.text_area("Or enter addresses/domains, one per line")
+        with col_sf2:
+            suppression_reason = st.text_input("Reason", value="Unsubscribed")
+            suppression_days = st.number_input("Lift after (days, 0 = never)", min_value=0, step=30, value=0)
+        if st.form_submit_button("Add to Suppression List"):
+            suppression_conn = storage.connect()
+            try:
+                expires_at = storage.now_ts(suppression_days * 86400) if suppression_days else None
+                added = invalid = 0
+                if suppression_file is not None:
+                    added, invalid = import_csv(suppression_conn, suppression_file, suppression_reason, source=suppression_file.name, expires_at=expires_at)
+                if suppression_values.strip():
+                    typed_added, typed_invalid = SuppressionList().add(suppression_conn, suppression_values.split(), suppression_reason, expires_at=expires_at)
+                    added, invalid = added + typed_added, invalid + typed_invalid
+                load_suppressions.clear()
+                st.success(f"Suppressed {added} addresses/domains." + (f" Skipped {invalid} values that are neither." if invalid else ""))
+            finally:
+                suppression_conn.close()
+    if suppression_rows:
+        col_su1, col_su2 = st.columns([3, 1])
+        with col_su1:
+            lift_value = st.selectbox("Entry", [r["Address / Domain"] for r in suppression_rows], key="lift_suppression", label_visibility="collapsed")
+        with col_su2:
+            if st.button("Lift Suppression", use_container_width=True):
+                suppression_conn = storage.connect()
+                storage.remove_suppressions(suppression_conn, [lift_value])
+                suppression_conn.close()
+                load_suppressions.clear()
+                st.rerun()
+
 # --- TAB 1: SIGNATURES ---
 with tab1:
     st.markdown("<h2>Email <span class='brand-text'>Signature</span></h2>", unsafe_allow_html=True)
@@ -292,7 +792,7 @@ with tab1:
         st.caption(f"Email: {st.session_state['env_email'] or 'Will use Setup Email'}")
 
     with col2:
-        st.radio("Select Layout", ["Minimalist Professional", "Creative with Avatar", "Corporate with Logo"], key="sig_layout")
+        st.radio("Select Layout", LAYOUTS, key="sig_layout")
         st.markdown("<div style='background: white; padding: 20px; border-radius: 8px; border: 1px solid #cbd5e1; color: black; box-shadow: 0 4px 6px -1px rgba(0, 0, 0, 0.1);'>" + selected_sig_html + "</div>", unsafe_allow_html=True)
 
 # --- TAB 2: COMPOSE ---
@@ -306,35 +806,16 @@ with tab2:
         * `{your_name}`: This is obtained dynamically from the **Full Name** input in the *Signatures* tab.
         """)
     
-    col1, col2 = st.columns(2)
-    with col1:
-        subject_template = st.text_input("Subject Line", "Streamlining Operations at {company}")
-        body_template = st.text_area("Email Body", DEFAULT_BODY, height=350)
-    with col2:
-        st.caption("Live HTML Preview (Sample Data)")
-        sample_row = {
-            "first_name": "John", 
-            "company": "Acme Corp", 
-            "role": "Manager",
-            "your_name": st.session_state['sig_name']
-        }
-        
-        rendered_subject = render_template(subject_template, sample_row)
-        rendered_body_html = render_template(body_template, sample_row).replace('\n', '<br>')
-        
-        preview_html = (
-            '<div style="background-color: #ffffff; color: #1e293b; padding: 24px; border-radius: 8px; border: 1px solid #cbd5e1; font-family: Arial, sans-serif; box-shadow: 0 4px 6px -1px rgba(0, 0, 0, 0.1);">'
-            '<div style="border-bottom: 1px solid #e2e8f0; padding-bottom: 12px; margin-bottom: 20px;">'
-            '<span style="color: #64748b; font-size: 13px; font-weight: 600; text-transform: uppercase;">Subject:</span>'
-            f'<span style="color: #0f172a; font-size: 15px; font-weight: bold; margin-left: 8px;">{rendered_subject}</span>'
-            '</div>'
-            '<div style="font-size: 14px; line-height: 1.6; color: #334155;">'
-            f'{rendered_body_html}'
-            '<br><br>'
-            f'{selected_sig_html}'
-            '</div></div>'
-        )
-        st.markdown(preview_html, unsafe_allow_html=True)
+    if st.session_state.get('lead_spool'):
+        col_p1, col_p2 = st.columns([3, 1])
+        with col_p1:
+            st.number_input("Uploaded leads to preview each template with", min_value=0, max_value=20, key="preview_leads")
+        with col_p2:
+            st.markdown("<br>", unsafe_allow_html=True)
+            st.button("🎲 Pick Other Leads", on_click=lambda: st.session_state.update(preview_seed=st.session_state['preview_seed'] + 1),
+                      use_container_width=True)
+    
+    main_editor(selected_sig_html)
         
     st.markdown("<br>", unsafe_allow_html=True)
     
@@ -346,29 +827,7 @@ with tab2:
         
         for i, t_tab in enumerate(template_tabs):
             with t_tab:
-                st.text_input("Template Name", key=f't_name_{i}')
-                col_t1, col_t2 = st.columns(2)
-                with col_t1:
-                    st.text_input(f"Subject Line", key=f't_subj_{i}')
-                    st.text_area(f"Email Body", height=250, key=f't_body_{i}')
-                with col_t2:
-                    st.caption("Live HTML Preview (Sample Data)")
-                    rendered_t_subj = render_template(st.session_state[f't_subj_{i}'], sample_row)
-                    rendered_t_body_html = render_template(st.session_state[f't_body_{i}'], sample_row).replace('\n', '<br>')
-                    
-                    t_preview_html = (
-                        '<div style="background-color: #ffffff; color: #1e293b; padding: 24px; border-radius: 8px; border: 1px solid #cbd5e1; font-family: Arial, sans-serif; box-shadow: 0 4px 6px -1px rgba(0, 0, 0, 0.1);">'
-                        '<div style="border-bottom: 1px solid #e2e8f0; padding-bottom: 12px; margin-bottom: 20px;">'
-                        '<span style="color: #64748b; font-size: 13px; font-weight: 600; text-transform: uppercase;">Subject:</span>'
-                        f'<span style="color: #0f172a; font-size: 15px; font-weight: bold; margin-left: 8px;">{rendered_t_subj}</span>'
-                        '</div>'
-                        '<div style="font-size: 14px; line-height: 1.6; color: #334155;">'
-                        f'{rendered_t_body_html}'
-                        '<br><br>'
-                        f'{selected_sig_html}'
-                        '</div></div>'
-                    )
-                    st.markdown(t_preview_html, unsafe_allow_html=True)
+                followup_editor(i, selected_sig_html)
 
 # --- TAB 3: DATA & SENDING ---
 with tab3:
@@ -385,24 +844,75 @@ with tab3:
     
     st.markdown("<br><hr style='border-color: rgba(255,255,255,0.1); margin-bottom: 25px;'><br>", unsafe_allow_html=True)
     
+    # --- Resume Interrupted Campaigns ---
+    unfinished = load_unfinished_campaigns()
+    if unfinished:
+        st.markdown("<h3>⏸️ Unfinished <span class='brand-text'>Campaigns</span></h3>", unsafe_allow_html=True)
+        st.write("These batch sends stopped before reaching every lead (closed tab, lost connection or restart). Resuming sends only to the leads that have not been emailed yet, from the account and templates the campaign started with. Don't resume a campaign that is still running in another tab.")
+        for campaign, lead_counts in unfinished:
+            with st.container(border=True):
+                st.markdown(f"**{campaign['sender_email']}** · started {campaign['created_at']}")
+                st.caption(
+                    f"{lead_counts.get('sent', 0)} sent · {lead_counts.get('failed', 0)} failed · "
+                    f"{lead_counts.get('pending', 0)} not sent yet · {lead_counts.get('sending', 0)} in flight when it stopped"
+                )
+                resend_unconfirmed = False
+                if lead_counts.get('sending', 0):
+                    resend_unconfirmed = st.checkbox(
+                        "Resend to leads that were in flight when it stopped (some of them may get the email twice)",
+                        key=f"resend_unconfirmed_{campaign['id']}",
+                    )
+                col_r1, col_r2 = st.columns(2)
+                with col_r1:
+                    resume_clicked = st.button("▶️ Resume Campaign", key=f"resume_{campaign['id']}", use_container_width=True)
+                with col_r2:
+                    if st.button("Mark as Finished", key=f"dismiss_{campaign['id']}", use_container_width=True):
+                        dismiss_conn = storage.connect()
+                        storage.finish_campaign(dismiss_conn, campaign['id'], status='abandoned')
+                        dismiss_conn.close()
+                        load_unfinished_campaigns.clear()
+                        st.rerun()
+                if resume_clicked:
+                    run_campaign(campaign['id'], campaign['sender_email'], campaign['sender_password'], resend_unconfirmed=resend_unconfirmed)
+        st.markdown("<br><hr style='border-color: rgba(255,255,255,0.1); margin-bottom: 25px;'><br>", unsafe_allow_html=True)
+    
     uploaded_file = st.file_uploader("Upload leadList.csv", type=['csv'])
     
     if uploaded_file is not None:
         try:
-            df = pd.read_csv(uploaded_file)
-            df.columns = [str(c).lower().strip() for c in df.columns]
-            required = ['first_name', 'last_name', 'email', 'role', 'company']
-            missing = [r for r in required if r not in df.columns]
+            # The header alone decides whether the file is usable
+            missing = missing_columns(read_columns(uploaded_file))
             
             if missing:
                 st.error(f"Missing required columns: {', '.join(missing)}")
             else:
-                st.dataframe(df.head(10), use_container_width=True)
+                # Clean, validate and dedupe the list chunk by chunk into campaigns.db, once per upload
+                spool = st.session_state.get('lead_spool')
+                if not spool or spool['file_id'] != uploaded_file.file_id:
+                    lead_conn = storage.connect()
+                    # A list that was (partly) sent keeps its leads so the campaign can still be resumed
+                    if spool and storage.get_campaign(lead_conn, spool['campaign_id']) is None:
+                        storage.delete_campaign_leads(lead_conn, spool['campaign_id'])
+                    campaign_id = uuid.uuid4().hex
+                    with st.spinner("Validating lead list..."):
+                        valid_count, rejected_count = spool_csv(lead_conn, uploaded_file, campaign_id)
+                    lead_conn.close()
+                    spool = {'file_id': uploaded_file.file_id, 'campaign_id': campaign_id, 'valid': valid_count, 'rejected': rejected_count}
+                    st.session_state['lead_spool'] = spool
+                campaign_id = spool['campaign_id']
+                
+                lead_conn = storage.connect()
+                st.dataframe(pd.DataFrame(list(storage.iter_leads(lead_conn, campaign_id, limit=10))), use_container_width=True)
+                st.caption(f"{spool['valid']} valid leads ready to send, {spool['rejected']} rows skipped.")
+                if spool['rejected']:
+                    with st.expander(f"⚠️ Skipped Rows ({spool['rejected']})"):
+                        st.dataframe(pd.DataFrame(list(storage.iter_rejects(lead_conn, campaign_id, limit=100))), use_container_width=True, hide_index=True)
+                        rejects_download_button(campaign_id)
                 st.markdown("<br>", unsafe_allow_html=True)
                 
                 # --- Advanced Campaign Settings ---
                 with st.expander("⚙️ Advanced: Email Campaign Cycle"):
-                    st.write("Set up your automated follow-up sequence. Emails will be scheduled at a random time between **9:00 AM and 5:00 PM** on the target date.")
+                    st.write("Set up your automated follow-up sequence. Each follow-up goes out during business hours on the target date (or the next working day), in the hour with the fewest emails already booked for its sender account.")
                     
                     tmpl_options = [st.session_state[f't_name_{j}'] for j in range(5)]
                     
@@ -414,29 +924,38 @@ with tab3:
                             st.number_input("Days after T+0", min_value=1, key=f"seq_delay_{i}", disabled=not st.session_state[f"seq_en_{i}"])
                         with col_s3:
                             st.selectbox("Select Template", options=tmpl_options, key=f"seq_tmpl_{i}", disabled=not st.session_state[f"seq_en_{i}"])
+                    
+                    st.checkbox("Also send from every enabled sender account (Setup tab), sharing the leads between them", key="send_all_accounts")
+                    st.checkbox("Skip leads another campaign has already emailed", key="skip_contacted", help="Addresses on the suppression list (Setup tab) are always skipped.")
+                    st.checkbox("Pre-schedule all follow-ups before the main send starts", key="seq_preenqueue", help="Writes the full follow-up schedule for every lead in one bulk operation up front. Follow-ups for leads whose main email then fails are cancelled at the end of the run.")
+                    st.checkbox("Pre-render every email into an outbox before sending", key="use_outbox", help="Renders the main email and all follow-ups of every lead on all CPU cores first, so the send only streams finished messages. `python -m dripmailer outbox show <campaign>` prints exactly what will go out; leads or templates changed since are rendered at send time instead.")
+                    
+                    col_h1, col_h2, col_h3 = st.columns(3)
+                    with col_h1:
+                        st.number_input("Business hours start", min_value=0, max_value=23, key="plan_start_hour")
+                    with col_h2:
+                        st.number_input("Business hours end", min_value=1, max_value=24, key="plan_end_hour")
+                    with col_h3:
+                        st.number_input("Max follow-ups per hour and account", min_value=0, key="plan_capacity", help="0 = no cap. Accounts with an hourly quota in the Setup tab use that instead. When every hour of a day is full, follow-ups move to the next working day.")
+                    st.text_input("Holidays (no follow-ups)", key="plan_holidays", placeholder="2026-12-24, 2026-12-25, 2027-01-01")
+                    st.checkbox("Use each lead's time zone column for business hours", key="plan_lead_timezones", help="Reads an IANA zone name such as Europe/Berlin from a 'timezone', 'time_zone' or 'tz' column. Leads without one use this machine's time zone.")
                             
                 st.markdown("<br>", unsafe_allow_html=True)
                 
                 # --- Execution ---
+                lead_counts = storage.lead_status_counts(lead_conn, campaign_id)
+                already_processed = spool['valid'] - lead_counts.get('pending', 0)
+                if already_processed:
+                    st.info(f"{already_processed} leads of this upload were already processed by an earlier run. Sending again only reaches the remaining {lead_counts.get('pending', 0)}.")
+                
                 if st.button("INITIATE BATCH SEND", type="primary"):
                     if not st.session_state['env_email'] or not st.session_state['env_pass']:
                         st.error("Missing Credentials! Please go back to Tab 0 (Setup) and enter your Streamax login.")
                     else:
-                        progress_bar = st.progress(0)
-                        log_container = st.empty()
-                        logs = []
-                        
-                        # --- Prepare CSV Logging ---
-                        log_output = io.StringIO()
-                        csv_writer = csv.writer(log_output)
-                        
-                        csv_writer.writerow(["--- CAMPAIGN CONFIGURATION ---"])
-                        csv_writer.writerow(["Type", "Template Name", "Subject", "Body/Details"])
-                        csv_writer.writerow(["Main Email", "Original", subject_template, body_template])
-                        
+                        # Resolve each enabled follow-up once, not once per lead
+                        templates = [(0, "Original", st.session_state['main_subj'], st.session_state['main_body'], 0)]
                         for j in range(5):
                             if st.session_state[f"seq_en_{j}"]:
-                                delay = st.session_state[f"seq_delay_{j}"]
                                 tmpl_name = st.session_state[f"seq_tmpl_{j}"]
                                 t_subj, t_bod = "", ""
                                 for k in range(5):
@@ -444,129 +963,24 @@ with tab3:
                                         t_subj = st.session_state[f't_subj_{k}']
                                         t_bod = st.session_state[f't_body_{k}']
                                         break
-                                csv_writer.writerow(["Follow-up", tmpl_name, t_subj, f"T+{delay} Days | Body: {t_bod}"])
-                        
-                        csv_writer.writerow([])
-                        csv_writer.writerow(["--- EXECUTION LOG ---"])
-                        csv_writer.writerow(["Timestamp", "First Name", "Last Name", "Email Address", "Action", "Details"])
+                                templates.append((len(templates), tmpl_name, t_subj, t_bod, st.session_state[f"seq_delay_{j}"]))
                         
-                        try:
-                            context = ssl.create_default_context()
-                            server = smtplib.SMTP_SSL("mail.streamax.com", 465, timeout=30, context=context)
-                            server.login(st.session_state['env_email'], st.session_state['env_pass'])
-                            
-                            # Open local DB connection for queueing
-                            conn = sqlite3.connect('campaigns.db')
-                            c = conn.cursor()
-                            
-                            total = len(df)
-                            for index, row in df.iterrows():
-                                # Clean up pandas NaN values to prevent literal "nan" strings and strip spaces
-                                row_dict = {k: (str(v).strip() if pd.notna(v) else "") for k, v in row.to_dict().items()}
-                                row_dict["your_name"] = st.session_state['sig_name']
-                                
-                                target_email = row_dict.get('email', '')
-                                first_name = row_dict.get('first_name', '')
-                                last_name = row_dict.get('last_name', '')
-                                
-                                # Skip if no valid email is found
-                                if not target_email or "@" not in target_email:
-                                    continue
-                                    
-                                current_timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-                                
-                                rendered_subj = render_template(subject_template, row_dict)
-                                rendered_body = render_template(body_template, row_dict)
-                                html_content = rendered_body.replace('\n', '<br>') + f"<br><br>{selected_sig_html}"
-                                
-                                msg = create_message(rendered_subj, html_content, target_email, st.session_state['sig_name'], st.session_state['env_email'])
-                                
-                                try:
-                                    server.send_message(msg)
-                                    logs.append(f"✅ [{time.strftime('%X')}] Sent successfully to {target_email}")
-                                    csv_writer.writerow([current_timestamp, first_name, last_name, target_email, "Sent Main Email", "Success"])
-                                    
-                                    # Schedule Follow-ups
-                                    for j in range(5):
-                                        if st.session_state[f"seq_en_{j}"]:
-                                            delay = st.session_state[f"seq_delay_{j}"]
-                                            tmpl_name = st.session_state[f"seq_tmpl_{j}"]
-                                            
-                                            # Grab specific template
-                                            t_subj, t_bod = "", ""
-                                            for k in range(5):
-                                                if st.session_state[f't_name_{k}'] == tmpl_name:
-                                                    t_subj = render_template(st.session_state[f't_subj_{k}'], row_dict)
-                                                    t_bod = render_template(st.session_state[f't_body_{k}'], row_dict)
-                                                    break
-                                            
-                                            f_html_content = t_bod.replace('\n', '<br>') + f"<br><br>{selected_sig_html}"
-                                            send_at_time = get_random_business_time(delay)
-                                            
-                                            # Write to database securely
-                                            c.execute('''
-                                                INSERT INTO scheduled_emails 
-                                                (target_email, sender_name, sender_email, sender_password, subject, html_body, send_at)
-                                                VALUES (?, ?, ?, ?, ?, ?, ?)
-                                            ''', (target_email, st.session_state['sig_name'], st.session_state['env_email'], st.session_state['env_pass'], t_subj, f_html_content, send_at_time))
-                                            
-                                            logs.append(f"⏳ [{time.strftime('%X')}] Queued '{tmpl_name}' for {target_email} at {send_at_time}")
-                                            csv_writer.writerow([current_timestamp, first_name, last_name, target_email, "Scheduled Follow-up", f"{tmpl_name} at {send_at_time}"])
-                                            
-                                except Exception as e:
-                                    logs.append(f"❌ [{time.strftime('%X')}] Failed to send to {target_email}: {str(e)}")
-                                    csv_writer.writerow([current_timestamp, first_name, last_name, target_email, "Sent Main Email", f"Failed: {str(e)}"])
-                                
-                                conn.commit()
-                                progress_bar.progress((index + 1) / total)
-                                log_container.code('\n'.join(logs[-15:]), language='text')
-                                time.sleep(0.5)
-                                
-                            conn.close()
-                            server.quit()
-                            st.success("Batch Processing Complete! Your log should begin downloading automatically.")
-                            
-                            # Finalize CSV
-                            final_csv_data = log_output.getvalue()
-                            st.session_state['latest_log_csv'] = final_csv_data
-                            
-                            b64 = base64.b64encode(final_csv_data.encode()).decode()
-                            timestamp_file = time.strftime('%Y%m%d_%H%M%S')
-                            
-                            components.html(
-                                f"""
-                                <script>
-                                    var a = document.createElement('a');
-                                    a.href = 'data:text/csv;base64,{b64}';
-                                    a.download = 'campaign_log_{timestamp_file}.csv';
-                                    a.click();
-                                </script>
-                                """,
-                                height=0
-                            )
-                            
-                        except smtplib.SMTPAuthenticationError:
-                            st.error("Email or passwords incorrect. Please return to the Setup tab to re-authenticate.")
-                        except Exception as e:
-                            if '535' in str(e) or 'authentication failed' in str(e).lower():
-                                st.error("Email or passwords incorrect. Please return to the Setup tab to re-authenticate.")
-                            else:
-                                st.error(f"SMTP Connection Error: {str(e)}")
+                        run_campaign(campaign_id, st.session_state['env_email'], st.session_state['env_pass'], templates=templates,
+                                     use_accounts=st.session_state['send_all_accounts'])
                 
                 # --- Persistent Manual Download Button ---
-                if st.session_state.get('latest_log_csv'):
+                if os.path.exists(st.session_state['latest_log_path']):
                     st.markdown("<br>", unsafe_allow_html=True)
-                    st.download_button(
-                        label="📥 Download Latest Execution Log (CSV)",
-                        data=st.session_state['latest_log_csv'],
-                        file_name=f"campaign_log_manual.csv",
-                        mime="text/csv",
-                    )
+                    log_download_button(st.session_state['latest_log_path'])
+                
+                lead_conn.close()
         except Exception as e:
             st.error(f"Error reading CSV: {str(e)}")
 
 # --- TAB 4: QUEUE MANAGER ---
-with tab4:
+# A fragment, so paging through the queue doesn't re-run the other tabs
+@st.fragment
+def queue_manager():
     st.markdown("<h2>Queue <span class='brand-text'>Manager</span></h2>", unsafe_allow_html=True)
     
     with st.popover("❓ How does the Queue Manager work?"):
@@ -574,116 +988,171 @@ with tab4:
         **The Queue Manager acts as your manual dispatch center for scheduled follow-ups.**
         
         * **Local Storage:** When you launch a campaign, follow-up emails are saved locally in a database (`campaigns.db`) instead of being sent immediately.
-        * **Randomized Times:** Each follow-up is assigned a natural-looking dispatch time between **9:00 AM and 5:00 PM** on the scheduled `T+X` day.
+        * **Planned Times:** Each follow-up goes out during business hours on the scheduled `T+X` day, or the next working day after a weekend or holiday, in the least busy hour for its sender account (see the chart below and the campaign cycle settings).
         * **Pending vs. Due:** The table below shows all emails waiting in the queue. The **Ready to Send Right Now** metric counts only the emails whose scheduled time has *already passed*.
         * **Dispatch:** Click the **"Process Due Emails Now"** button to physically send the due emails. It logs into the Streamax server, dispatches them, and marks them as completed.
+        * **Quotas:** Follow-ups go out from the account that sent the lead's first email, all accounts at once. Emails beyond an account's daily or hourly quota (Setup tab) are moved to when the quota resets.
+        * **Background Dispatcher:** Run `python -m dripmailer.worker` on the same machine to send due emails automatically, without keeping this page open. Emails it is currently working on show up under **Sending Now**.
         """)
         
     st.write("View all scheduled follow-up emails and manually process ones that have reached their target send time.")
     
-    # Connect to DB and fetch
-    conn = sqlite3.connect('campaigns.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
-    # 1. Show all pending
-    c.execute("SELECT id, target_email, subject, send_at FROM scheduled_emails WHERE status = 'pending' ORDER BY send_at ASC")
-    pending_emails = c.fetchall()
-    
-    current_time_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    
-    # 2. Show only DUE pending
-    c.execute("SELECT * FROM scheduled_emails WHERE status = 'pending' AND send_at <= ?", (current_time_str,))
-    due_emails = c.fetchall()
+    counts = load_queue_counts()
+    due_count = counts['due']
     
-    col_q1, col_q2 = st.columns(2)
+    col_q1, col_q2, col_q3 = st.columns(3)
     with col_q1:
-        st.metric("Total Scheduled (Pending)", len(pending_emails))
+        st.metric("Total Scheduled (Pending)", counts['pending'])
     with col_q2:
-        st.metric("Ready to Send Right Now", len(due_emails), delta_color="off")
+        st.metric("Ready to Send Right Now", due_count, delta_color="off")
+    with col_q3:
+        st.metric("Sending Now (Dispatcher)", counts['sending'], delta_color="off")
         
     st.markdown("### Scheduled Queue")
-    if pending_emails:
-        df_pending = pd.DataFrame([{
-            "ID": r['id'], 
-            "Target Email": r['target_email'], 
-            "Subject": r['subject'], 
-            "Scheduled For": r['send_at']
-        } for r in pending_emails])
-        st.dataframe(df_pending, use_container_width=True, hide_index=True)
+    # One cursor per visited page: the (send_at, id) the page starts after
+    cursors = st.session_state['queue_cursors']
+    page_rows, last_key = load_pending_page(cursors[-1])
+    if not page_rows and len(cursors) > 1:
+        # The page we were on has been sent in the meantime
+        st.session_state['queue_cursors'] = cursors = [None]
+        page_rows, last_key = load_pending_page(None)
+    
+    if page_rows:
+        st.dataframe(pd.DataFrame(page_rows), use_container_width=True, hide_index=True)
+        first_shown = (len(cursors) - 1) * QUEUE_PAGE_SIZE + 1
+        col_pg1, col_pg2, col_pg3 = st.columns([1, 2, 1])
+        with col_pg1:
+            # Callbacks move the cursor before the fragment re-runs, so no extra rerun is needed
+            st.button("⬅️ Previous", disabled=len(cursors) == 1, use_container_width=True, on_click=cursors.pop)
+        with col_pg2:
+            st.caption(f"Showing {first_shown}-{first_shown + len(page_rows) - 1} of {counts['pending']} pending emails")
+        with col_pg3:
+            st.button("Next ➡️", disabled=len(page_rows) < QUEUE_PAGE_SIZE, use_container_width=True, on_click=cursors.append, args=(last_key,))
     else:
         st.info("No emails are currently waiting in the queue.")
+    
+    hourly_load = load_hourly_load()
+    if not hourly_load.empty:
+        st.markdown("### Planned Load per Hour")
+        st.bar_chart(hourly_load, x="Hour", y="Emails", color="Account")
+        peak = hourly_load.groupby("Hour")["Emails"].sum().max()
+        st.caption(f"Pending emails over the next {LOAD_DAYS} days by the hour they are due. Busiest hour: {peak} emails.")
         
     st.markdown("<br><hr style='border-color: rgba(255,255,255,0.1); margin-bottom: 25px;'><br>", unsafe_allow_html=True)
     
     st.markdown("### Execute Due Emails")
-    st.write("Clicking this button will dispatch any emails in the queue whose `Scheduled For` time has already passed.")
+    st.write("Clicking this button will dispatch any emails in the queue whose `Scheduled For` time has already passed. If the background dispatcher (`python -m dripmailer.worker`) is running, due emails go out on their own and this is only needed as a manual override.")
     
-    if st.button("🚀 Process Due Emails Now", type="primary", disabled=len(due_emails) == 0):
+    if st.button("🚀 Process Due Emails Now", type="primary", disabled=due_count == 0):
         
         q_progress = st.progress(0)
         q_log_container = st.empty()
-        q_logs = []
+        q_logs = deque(maxlen=LOG_TAIL)
+        q_tail = {'at': 0.0}
         
-        # Group by sender account to minimize logins
-        accounts_dict = {}
-        for row in due_emails:
-            email_key = row['sender_email']
-            if email_key not in accounts_dict:
-                accounts_dict[email_key] = {
-                    'password': row['sender_password'],
-                    'emails': []
-                }
-            accounts_dict[email_key]['emails'].append(row)
-            
-        total_due = len(due_emails)
-        processed_count = 0
+        total_due = due_count
+        processed = {'count': 0, 'panel_at': 0.0}
+        q_metrics = Metrics()
+        with st.expander("📈 Dispatch Metrics", expanded=True):
+            q_metrics_panel = st.empty()
         
-        for sender_email, account_data in accounts_dict.items():
-            q_logs.append(f"[{time.strftime('%X')}] 🔐 Authenticating for account {sender_email}...")
-            q_log_container.code('\n'.join(q_logs[-15:]), language='text')
-            
-            try:
-                context = ssl.create_default_context()
-                server = smtplib.SMTP_SSL("mail.streamax.com", 465, timeout=30, context=context)
-                server.login(sender_email, account_data['password'])
-                
-                for row in account_data['emails']:
-                    email_id = row['id']
-                    target = row['target_email']
-                    q_logs.append(f"[{time.strftime('%X')}] 📤 Sending ID {email_id} to {target}...")
-                    q_log_container.code('\n'.join(q_logs[-15:]), language='text')
-                    
-                    try:
-                        msg = MIMEMultipart("alternative")
-                        msg["From"] = f"{row['sender_name']} <{row['sender_email']}>"
-                        msg["To"] = target
-                        msg["Subject"] = row['subject']
-                        msg["Message-ID"] = make_msgid(domain=row['sender_email'].split("@")[-1])
-                        msg.attach(MIMEText(row['html_body'], "html", "utf-8"))
-                        
-                        server.send_message(msg)
-                        
-                        # Mark sent
-                        c.execute("UPDATE scheduled_emails SET status = 'sent' WHERE id = ?", (email_id,))
-                        q_logs.append(f"   ✅ Success!")
-                    except Exception as e:
-                        q_logs.append(f"   ❌ Failed: {str(e)}")
-                        c.execute("UPDATE scheduled_emails SET status = 'failed' WHERE id = ?", (email_id,))
-                        
-                    conn.commit()
-                    processed_count += 1
-                    q_progress.progress(processed_count / total_due)
-                    q_log_container.code('\n'.join(q_logs[-15:]), language='text')
-                    time.sleep(0.5)
-                    
-                server.quit()
-            except Exception as e:
-                q_logs.append(f"[{time.strftime('%X')}] ❌ Critical Auth Error for {sender_email}: {str(e)}")
-                q_log_container.code('\n'.join(q_logs[-15:]), language='text')
+        def on_queue_event(event, subject, error):
+            if event == 'login':
+                q_logs.append(f"[{time.strftime('%X')}] 🔐 Authenticating for account {subject}...")
+            elif event == 'login_failed':
+                q_logs.append(f"[{time.strftime('%X')}] ❌ Critical Auth Error for {subject}: {str(error)}")
+            elif event == 'sending':
+                q_logs.append(f"[{time.strftime('%X')}] 📤 Sending ID {subject['id']} to {subject['target_email']}...")
+            elif event == 'deferred':
+                deferred_count, resets_at = error
+                q_logs.append(f"[{time.strftime('%X')}] ⛔ {subject} is out of quota, {deferred_count} emails moved to {storage.format_ts(resets_at)}")
+                processed['count'] += deferred_count
+                q_progress.progress(min(1.0, processed['count'] / total_due))
+            elif event == 'suppressed':
+                q_logs.append(f"[{time.strftime('%X')}] 🚫 Skipped ID {subject['id']} to {subject['target_email']}: {error}")
+                processed['count'] += 1
+                q_progress.progress(min(1.0, processed['count'] / total_due))
+            elif event == 'retry':
+                q_logs.append(f"   ⏳ {describe_error(error)} - will retry later")
+                processed['count'] += 1
+                q_progress.progress(min(1.0, processed['count'] / total_due))
+            else:
+                q_logs.append(f"   ✅ Success!" if event == 'sent' else f"   ❌ Failed: {describe_error(error)}")
+                processed['count'] += 1
+                q_progress.progress(min(1.0, processed['count'] / total_due))
+            if event != 'sending' and time.monotonic() - processed['panel_at'] >= 1:
+                show_metrics(q_metrics_panel, q_metrics)
+                processed['panel_at'] = time.monotonic()
+            if time.monotonic() - q_tail['at'] >= LOG_REFRESH:
+                q_log_container.code('\n'.join(q_logs), language='text')
+                q_tail['at'] = time.monotonic()
+        
+        # Rows are claimed in small batches and sessions are shared per sender account
+        conn = storage.connect()
+        try:
+            with Dispatcher(
+                rate_per_account=st.session_state['pool_account_rate'],
+                domain_rate=st.session_state['pool_domain_rate'],
+                max_attempts=st.session_state['queue_max_attempts'],
+                metrics=q_metrics,
+                sessions=smtp_sessions() if st.session_state['async_smtp'] else None,
+                outbox_dir=outbox.OUTBOX_DIR,
+            ) as dispatcher:
+                dispatcher.drain(conn, on_event=on_queue_event)
+        finally:
+            conn.close()
+            clear_queue_cache()
+            q_log_container.code('\n'.join(q_logs), language='text')
+            show_metrics(q_metrics_panel, q_metrics)
+            export_metrics(q_metrics)
                 
         st.success("Queue processing complete!")
         time.sleep(2)
         st.rerun() # Refresh the UI to update the tables
+    
+    st.markdown("<br><hr style='border-color: rgba(255,255,255,0.1); margin-bottom: 25px;'><br>", unsafe_allow_html=True)
+    
+    st.markdown("### Replies & Bounces")
+    st.write("Reads the mail that arrived in your Streamax inbox since the last check. Leads who replied, or whose email bounced, get no further follow-ups, and bounced addresses are added to the suppression list. Out-of-office replies are ignored. `python -m dripmailer scan-inbox` does the same from cron.")
+    
+    if st.button("📬 Check Inbox for Replies & Bounces", disabled=not st.session_state['env_email']):
+        scan_conn = storage.connect()
+        scan_status = st.empty()
+        try:
+            scanner = InboxScanner(st.session_state['env_email'], st.session_state['env_pass'])
+            with st.spinner("Reading new messages..."):
+                found = scanner.scan(scan_conn, on_batch=lambda found, left: scan_status.caption(f"{found['messages']} messages read, {left} left..."))
+            scan_status.empty()
+            st.success(f"{found['messages']} new messages: {found['replied']} leads replied, {found['bounced']} bounced, {found['cancelled']} follow-ups cancelled.")
+        except Exception as e:
+            st.error(f"Could not read the inbox: {str(e)}")
+        finally:
+            scan_conn.close()
+            clear_queue_cache()
+    
+    st.markdown("<br><hr style='border-color: rgba(255,255,255,0.1); margin-bottom: 25px;'><br>", unsafe_allow_html=True)
+    
+    st.markdown("### Storage & Retention")
+    st.write("Sent, failed and cancelled emails stay in the queue table until they are archived. Archiving moves them to `scheduled_emails_archive` without their bodies and passwords, which keeps this page and the dispatcher fast however many campaigns have run. `python -m dripmailer.worker --archive-days 30` does it every hour.")
+    stats, archivable = load_storage_stats(st.session_state['archive_days'])
+    col_st1, col_st2, col_st3, col_st4 = st.columns(4)
+    col_st1.metric("Rows in Queue (Hot)", sum(stats['hot'].values()))
+    col_st2.metric("Finished Rows in Queue", sum(n for status, n in stats['hot'].items() if status in storage.FINISHED_STATUSES))
+    col_st3.metric("Archived Rows (Cold)", stats['archived'])
+    col_st4.metric("Database Size", f"{(stats['db_bytes'] + stats['wal_bytes']) / 1e6:.1f} MB", f"{stats['free_bytes'] / 1e6:.1f} MB free", delta_color="off")
+    
+    col_ar1, col_ar2 = st.columns([1, 2])
+    with col_ar1:
+        st.number_input("Archive emails finished more than (days) ago", min_value=0, step=7, key="archive_days")
+    with col_ar2:
+        st.markdown("<br>", unsafe_allow_html=True)
+        # Callbacks run before the fragment re-runs, so the numbers above are already up to date
+        st.button(f"🗄️ Archive {archivable} Finished Emails", disabled=archivable == 0, on_click=archive_queue)
+    if 'archive_result' in st.session_state:
+        st.success(st.session_state.pop('archive_result'))
+    if not stats['incremental_vacuum']:
+        st.info("This database was created before incremental vacuum was switched on, so archived space is reused but not handed back to the disk. Enabling it rewrites the file once; stop the background dispatcher first.")
+        st.button("Enable Incremental Vacuum", on_click=archive_queue, args=(True,))
 
-    conn.close()
+with tab4:
+    queue_manager()
@@ -0,0 +1,186 @@
+"""A local IMAP stand-in for the inbox scanner: one read-only mailbox served from memory,
+with knobs for rebuilding it under a new UIDVALIDITY.
+
+    python -m benchmarks.imap_mailbox --port 1143 replies/*.eml
+"""
+import argparse
+import re
+import socketserver
+import threading
+import time
+
+_UID_RANGE = re.compile(r'UID (\d+):\*', re.I)
+_PEEK = re.compile(r'<0\.(\d+)>')
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b"\r\n")
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.reply("* OK [CAPABILITY IMAP4rev1] mailbox ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, command = line.decode('ascii', 'replace').strip().partition(" ")
+            mailbox.commands.append(command)
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "CAPABILITY":
+                self.reply("* CAPABILITY IMAP4rev1")
+            elif verb == "LOGIN":
+                pass
+            elif verb in ("SELECT", "EXAMINE"):
+                uids = mailbox.uids()
+                self.reply(f"* {len(uids)} EXISTS")
+                self.reply(f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid")
+                self.reply(f"* OK [UIDNEXT {mailbox.next_uid}] Predicted next UID")
+                self.reply(f"{tag} OK [READ-ONLY] {verb} completed")
+                continue
+            elif command.upper().startswith("UID SEARCH"):
+                self.reply(" ".join(["* SEARCH", *map(str, mailbox.search(command))]))
+            elif command.upper().startswith("UID FETCH"):
+                self.fetch(mailbox, command)
+            elif verb == "NOOP":
+                pass
+            elif verb == "LOGOUT":
+                self.reply("* BYE logging out")
+                self.reply(f"{tag} OK LOGOUT completed")
+                return
+            else:
+                self.reply(f"{tag} BAD Command not recognized")
+                continue
+            self.reply(f"{tag} OK {verb} completed")
+
+    def fetch(self, mailbox, command):
+        wanted = set()
+        for part in command.split()[2].split(","):
+            low, _, high = part.partition(":")
+            wanted.update(range(int(low), int(high or low) + 1))
+        peek = _PEEK.search(command)
+        for seq, uid in enumerate(mailbox.uids(), 1):
+            if uid in wanted:
+                data = mailbox.messages[uid]
+                if peek:
+                    data = data[:int(peek.group(1))]
+                mailbox.fetched += 1
+                self.wfile.write(f"* {seq} FETCH (UID {uid} BODY[]<0> {{{len(data)}}}\r\n".encode('ascii') + data + b")\r\n")
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class IMAPMailbox:
+    """Threaded IMAP server with a single mailbox that any login can open.
+
+    deliver() adds a message under the next UID. rebuild() renumbers every message from
+    UID 1 under a new UIDVALIDITY, as a server does when a mailbox is recreated. Every
+    command received is kept in `commands`; `fetched` counts messages sent to clients.
+    Searches other than "UID n:*" match the whole mailbox.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.next_uid = 1
+        self.messages = {}
+        self.commands = []
+        self.fetched = 0
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.mailbox = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="imap-mailbox", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def deliver(self, raw):
+        """Adds a raw message and returns its UID."""
+        with self._lock:
+            uid = self.next_uid
+            self.messages[uid] = raw
+            self.next_uid += 1
+        return uid
+
+    def rebuild(self, uidvalidity=None):
+        with self._lock:
+            self.uidvalidity = uidvalidity or self.uidvalidity + 1
+            self.messages = {uid: raw for uid, raw in enumerate(self.messages.values(), 1)}
+            self.next_uid = len(self.messages) + 1
+
+    def uids(self):
+        with self._lock:
+            return sorted(self.messages)
+
+    def search(self, command):
+        uids = self.uids()
+        match = _UID_RANGE.search(command)
+        if not match:
+            return uids
+        # As on a real server, "n:*" also matches the newest message when it is below n
+        low = int(match.group(1))
+        return [uid for uid in uids if uid >= low] or uids[-1:]
+
+
+def reply_message(message_id, sender="lead@example.com", auto=False):
+    """A reply to the message with `message_id`; with auto, an out-of-office one."""
+    headers = (f"From: <{sender}>\r\nTo: <sender@example.com>\r\nSubject: Re: your email\r\n"
+               f"Message-ID: <{time.time_ns()}.reply@example.com>\r\nIn-Reply-To: {message_id}\r\nReferences: {message_id}\r\n")
+    if auto:
+        headers += "Auto-Submitted: auto-replied\r\n"
+    return (headers + "\r\nThanks, tell me more.\r\n").encode('ascii')
+
+
+def bounce_message(message_id, action="failed"):
+    """A delivery-status report returning the message with `message_id`."""
+    return (f"From: Mail Delivery System <MAILER-DAEMON@mx.example.com>\r\nTo: <sender@example.com>\r\n"
+            f"Subject: Undelivered Mail Returned to Sender\r\nMessage-ID: <{time.time_ns()}.dsn@mx.example.com>\r\n"
+            f"Content-Type: multipart/report; report-type=delivery-status; boundary=\"report\"\r\n\r\n"
+            f"--report\r\n\r\nThe message could not be delivered.\r\n"
+            f"--report\r\nContent-Type: message/delivery-status\r\n\r\n"
+            f"Reporting-MTA: dns; mx.example.com\r\n\r\nFinal-Recipient: rfc822; lead@example.com\r\nAction: {action}\r\nStatus: 5.1.1\r\n"
+            f"--report\r\nContent-Type: text/rfc822-headers\r\n\r\n"
+            f"From: <sender@example.com>\r\nMessage-ID: {message_id}\r\nSubject: Hello\r\n--report--\r\n").encode('ascii')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local IMAP mailbox for benchmarks and manual testing.")
+    parser.add_argument("messages", nargs="*", help="Raw message files (.eml) to serve, in UID order")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1143)
+    parser.add_argument("--uidvalidity", type=int, default=1)
+    args = parser.parse_args(argv)
+    mailbox = IMAPMailbox(args.host, args.port, args.uidvalidity).start()
+    for path in args.messages:
+        with open(path, 'rb') as f:
+            mailbox.deliver(f.read())
+    print(f"IMAP mailbox listening on {args.host}:{mailbox.address[1]} with {len(mailbox.messages)} messages (Ctrl+C to stop)", flush=True)
+    try:
+        while True:
+            time.sleep(5)
+            print(f"fetched={mailbox.fetched}", flush=True)
+    except KeyboardInterrupt:
+        mailbox.stop()
+
+
+if __name__ == "__main__":
+    main()
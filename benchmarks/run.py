@@ -0,0 +1,264 @@
+"""Send-path benchmark: synthetic lead lists pushed through the real campaign and queue code
+against a local SMTP sink.
+
+    python -m benchmarks.run                               # 1k, 10k and 100k leads
+    python -m benchmarks.run --sizes 1000 10000 --output baseline.json
+    python -m benchmarks.run --compare baseline.json       # run again, show change per metric
+
+Each size runs in its own process so peak RSS is per size. Per size it measures:
+  - spool: CSV -> validated leads table (dripmailer.leads.spool_csv)
+  - outbox: with --outbox, every email pre-rendered by dripmailer.outbox.build
+  - batch: CampaignRunner main send through SMTPPool, with follow-up scheduling (tab 3)
+  - drain: every queued follow-up sent through Dispatcher.drain (tab 4)
+
+--async-smtp sends both through dripmailer.aiosmtp instead of smtplib threads.
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.smtp_sink import SMTPSink
+from dripmailer import outbox, storage
+from dripmailer.campaign import CampaignRunner
+from dripmailer.dispatcher import Dispatcher
+from dripmailer.aiosmtp import AsyncSMTPPool
+from dripmailer.leads import spool_csv
+from dripmailer.metrics import Metrics
+from dripmailer.smtp_pool import SMTPPool
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+SUBJECT = "Quick question for {company}"
+BODY = "Hi {first_name},\n\nI noticed {company} is growing its {role} team and wanted to share how we help.\n\nBest,\n{your_name}"
+FOLLOWUP_BODY = "Hi {first_name}, just bumping this up in case it got buried.\n\n{your_name}"
+SIGNATURE = "<table><tr><td><strong>Bench Sender</strong><br>Benchmarks Inc.<br>(555) 123-4567</td></tr></table>"
+
+
+def write_leads(path, size):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Email", "First_Name", "Last_Name", "Company", "Role"])
+        for i in range(size):
+            writer.writerow([f"lead{i}@example{i % 97}.com", f"First{i}", f"Last{i}", f"Company {i % 1000}", "Operations Manager"])
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def stage(snapshot, name):
+    return snapshot['stages'].get(name, {'count': 0, 'total_s': 0.0, 'p50_ms': 0.0, 'p99_ms': 0.0})
+
+
+def send_report(snapshot, seconds):
+    message = stage(snapshot, 'message')
+    db_write = stage(snapshot, 'db_write')
+    return {
+        'messages': snapshot['messages'],
+        'seconds': round(seconds, 3),
+        'msgs_per_sec': round(snapshot['messages'] / seconds, 1) if seconds else 0.0,
+        'latency_p50_ms': message['p50_ms'],
+        'latency_p99_ms': message['p99_ms'],
+        'smtp_send_p50_ms': stage(snapshot, 'smtp_send')['p50_ms'],
+        'smtp_send_p99_ms': stage(snapshot, 'smtp_send')['p99_ms'],
+        'db_write_transactions': db_write['count'],
+        'db_write_seconds': db_write['total_s'],
+    }
+
+
+def run_size(size, args):
+    workdir = tempfile.mkdtemp(prefix=f"dripmailer-bench-{size}-")
+    db_path = os.path.join(workdir, "campaigns.db")
+    leads_path = os.path.join(workdir, "leads.csv")
+    write_leads(leads_path, size)
+    storage.init_db(db_path)
+    conn = storage.connect(db_path)
+    result = {'size': size}
+
+    # --- spool ---
+    started = time.perf_counter()
+    with open(leads_path, 'rb') as f:
+        valid, rejected = spool_csv(conn, f, "bench")
+    seconds = time.perf_counter() - started
+    result['spool'] = {'leads': valid, 'rejected': rejected, 'seconds': round(seconds, 3), 'rows_per_sec': round(valid / seconds, 1)}
+
+    templates = [(0, "Original", SUBJECT, BODY, 0)]
+    templates += [(step, f"Follow-up {step}", f"Re: {SUBJECT}", FOLLOWUP_BODY, 3 * step) for step in range(1, args.followups + 1)]
+    storage.save_campaign(conn, "bench", "Bench Sender", "bench@example.com", "secret", SIGNATURE, templates)
+
+    spooled = None
+    if args.outbox:
+        # --- outbox ---
+        path = outbox.outbox_path("bench", workdir)
+        started = time.perf_counter()
+        stats = outbox.build(conn, "bench", path, workers=args.outbox_workers)
+        seconds = time.perf_counter() - started
+        result['outbox'] = dict(stats, seconds=round(seconds, 3), msgs_per_sec=round(stats['messages'] / seconds, 1))
+        spooled = outbox.Outbox(path)
+
+    pool_class = AsyncSMTPPool if args.async_smtp else SMTPPool
+    with SMTPSink(latency=args.latency, fail_rate=args.fail_rate, throttle_every=args.throttle_every, pipelining=args.pipelining) as sink:
+        host, port = sink.address
+
+        # --- batch send (tab 3) ---
+        metrics = Metrics()
+        # Follow-ups are made due right away so the drain phase has the full queue to send
+        due_now = lambda days, lead, sender: datetime.datetime.now() - datetime.timedelta(seconds=1)
+        started = time.perf_counter()
+        with pool_class("bench@example.com", "secret", workers=args.workers, per_connection_rate=0, global_rate=0,
+                      host=host, port=port, use_ssl=False, backoff_base=0.01, backoff_cap=0.1, metrics=metrics) as pool:
+            runner = CampaignRunner(conn, "bench", enqueue_batch=args.enqueue_batch, schedule=due_now, metrics=metrics, outbox=spooled)
+            counts = runner.run(pool)
+        seconds = time.perf_counter() - started
+        batch = send_report(metrics.snapshot(), seconds)
+        queued = conn.execute("SELECT COUNT(*) FROM scheduled_emails WHERE status = 'pending'").fetchone()[0]
+        batch['leads_sent'] = counts.get('sent', 0)
+        batch['leads_failed'] = counts.get('failed', 0)
+        batch['followups_queued'] = queued
+        # Lead checkpoints plus follow-up rows, per second spent in DB write transactions
+        batch['sqlite_rows_per_sec'] = round((size + queued) / batch['db_write_seconds'], 1) if batch['db_write_seconds'] else 0.0
+        result['batch'] = batch
+
+        # --- queue drain (tab 4) ---
+        if queued and not args.skip_drain:
+            metrics = Metrics()
+            started = time.perf_counter()
+            with Dispatcher(host=host, port=port, use_ssl=False, rate_per_account=0, max_attempts=1, metrics=metrics,
+                            async_smtp=args.async_smtp, outbox_dir=workdir if args.outbox else None) as dispatcher:
+                dispatcher.drain(conn, batch_size=args.drain_batch)
+            seconds = time.perf_counter() - started
+            drain = send_report(metrics.snapshot(), seconds)
+            drain['sqlite_rows_per_sec'] = round(drain['messages'] / drain['db_write_seconds'], 1) if drain['db_write_seconds'] else 0.0
+            result['drain'] = drain
+
+        result['sink'] = {'accepted': sink.messages, 'rejected': sink.rejected, 'throttled': sink.throttled, 'megabytes': round(sink.bytes / 1e6, 2)}
+
+    if spooled is not None:
+        spooled.close()
+    conn.close()
+    result['db_megabytes'] = round(sum(os.path.getsize(os.path.join(workdir, n)) for n in os.listdir(workdir) if n.startswith("campaigns.db")) / 1e6, 2)
+    result['peak_rss_mb'] = peak_rss_mb()
+    if not args.keep:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(report):
+    """{(size, 'batch.msgs_per_sec'): value} for every numeric result, for comparisons."""
+    flat = {}
+    for result in report['results']:
+        for section, values in result.items():
+            if isinstance(values, dict):
+                for key, value in values.items():
+                    flat[(result['size'], f"{section}.{key}")] = value
+            elif section != 'size':
+                flat[(result['size'], section)] = values
+    return flat
+
+
+def print_comparison(baseline, current):
+    old, new = flatten(baseline), flatten(current)
+    print(f"\nCompared with {baseline.get('revision') or 'baseline'} ({baseline.get('created')}):")
+    print(f"{'size':>8}  {'metric':<32} {'baseline':>12} {'current':>12} {'change':>9}")
+    for key in sorted(new):
+        if key not in old or not isinstance(new[key], (int, float)):
+            continue
+        before, after = old[key], new[key]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"{key[0]:>8}  {key[1]:<32} {before:>12} {after:>12} {change:>9}")
+
+
+# Settings forwarded to the per-size child process
+CHILD_OPTIONS = ('workers', 'followups', 'enqueue_batch', 'drain_batch', 'latency', 'fail_rate', 'throttle_every', 'outbox_workers')
+CHILD_FLAGS = ('skip_drain', 'keep', 'async_smtp', 'pipelining', 'outbox')
+
+
+def child_options(args):
+    options = []
+    for name in CHILD_OPTIONS:
+        options += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    options += [f"--{name.replace('_', '-')}" for name in CHILD_FLAGS if getattr(args, name)]
+    return options
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the dripmailer send path against a local SMTP sink.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="Lead list sizes to run")
+    parser.add_argument("--workers", type=int, default=8, help="SMTPPool connections for the batch send")
+    parser.add_argument("--followups", type=int, default=1, help="Follow-up steps per lead")
+    parser.add_argument("--enqueue-batch", type=int, default=500, help="Follow-ups written per DB transaction")
+    parser.add_argument("--drain-batch", type=int, default=50, help="Queue rows claimed per transaction")
+    parser.add_argument("--latency", type=float, default=0.0, help="Sink seconds per message")
+    parser.add_argument("--fail-rate", type=float, default=0.01, help="Share of recipients the sink rejects")
+    parser.add_argument("--throttle-every", type=int, default=0, help="Sink answers every Nth recipient with 451")
+    parser.add_argument("--async-smtp", action="store_true", help="Send through the asyncio SMTP engine")
+    parser.add_argument("--pipelining", action="store_true", help="Sink advertises ESMTP PIPELINING")
+    parser.add_argument("--outbox", action="store_true", help="Pre-render every email into an outbox and send from it")
+    parser.add_argument("--outbox-workers", type=int, default=0, help="Outbox rendering processes (0 = one per CPU)")
+    parser.add_argument("--skip-drain", action="store_true", help="Only benchmark the batch send")
+    parser.add_argument("--keep", action="store_true", help="Keep each size's temporary campaigns.db")
+    parser.add_argument("--output", help="Write the JSON report here (default: stdout)")
+    parser.add_argument("--compare", metavar="BASELINE", help="Compare against an earlier JSON report")
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.single:
+        print(json.dumps(run_size(args.single, args)))
+        return
+
+    # One process per size keeps peak RSS (and caches) from leaking between sizes
+    results = []
+    for size in args.sizes:
+        print(f"Running {size} leads...", file=sys.stderr, flush=True)
+        child = subprocess.run(
+            [sys.executable, "-m", "benchmarks.run", *child_options(args), "--single", str(size)],
+            capture_output=True, text=True,
+        )
+        if child.returncode:
+            sys.stderr.write(child.stderr)
+            sys.exit(child.returncode)
+        results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'single', 'sizes')},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+        print(f"Wrote {args.output}", file=sys.stderr)
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""A local SMTP stand-in for benchmarks: accepts and discards mail, with knobs for
+relay latency, throttling replies and rejected recipients.
+
+    python -m benchmarks.smtp_sink --port 2525 --latency 0.05
+"""
+import argparse
+import collections
+import socketserver
+import threading
+import time
+import zlib
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # Pipelined commands get their replies back to back; Nagle would hold each one for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b"\r\n")
+
+    def handle(self):
+        sink = self.server.sink
+        self.reply("220 sink ESMTP ready")
+        rejected = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip()
+            verb = command[:4].upper()
+            sink.received(verb)
+            if verb == "EHLO":
+                self.reply("250-sink")
+                self.reply("250-AUTH PLAIN LOGIN")
+                if sink.pipelining:
+                    self.reply("250-PIPELINING")
+                self.reply("250 8BITMIME")
+            elif verb == "HELO":
+                self.reply("250 sink")
+            elif verb == "AUTH":
+                if sink.login():
+                    self.reply("235 2.7.0 Authentication successful")
+                else:
+                    self.reply("535 5.7.8 Authentication credentials invalid")
+            elif verb == "MAIL":
+                rejected = False
+                self.reply("250 2.1.0 Ok")
+            elif verb == "RCPT":
+                code = sink.recipient_reply(command)
+                rejected = code is not None
+                self.reply(code or "250 2.1.5 Ok")
+                if code and code.startswith("421"):
+                    # A relay closes the session after a 421
+                    return
+            elif verb == "DATA":
+                if rejected:
+                    self.reply("554 5.5.1 No valid recipients")
+                    continue
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                while True:
+                    chunk = self.rfile.readline()
+                    if chunk in (b".\r\n", b""):
+                        break
+                    size += len(chunk)
+                if sink.latency:
+                    time.sleep(sink.latency)
+                sink.accepted(size)
+                self.reply("250 2.0.0 Ok: queued")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 2.0.0 Ok")
+            elif verb == "QUIT":
+                self.reply("221 2.0.0 Bye")
+                return
+            else:
+                self.reply("502 5.5.2 Command not recognized")
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink:
+    """Threaded SMTP server that counts and drops every message it accepts.
+
+    latency: seconds spent before acknowledging each message's DATA.
+    fail_rate: share of recipients permanently rejected (550), chosen by a hash of the
+      address so the same leads fail on every run.
+    throttle_every: every Nth recipient gets a temporary 451, as a throttling relay would.
+    replies: {address: reply line} for recipients that always get that RCPT reply, e.g.
+      "421 4.7.0 Try again later" (which also closes the session) or "550 5.1.1 User unknown".
+    refuse_login: answer every AUTH with 535.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, fail_rate=0.0, throttle_every=0, pipelining=False,
+                 replies=None, refuse_login=False):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.throttle_every = throttle_every
+        self.pipelining = pipelining
+        self.replies = dict(replies or {})
+        self.refuse_login = refuse_login
+        self.logins = 0
+        # SMTP verbs received, e.g. commands['NOOP'] for keep-alives
+        self.commands = collections.Counter()
+        self.messages = 0
+        self.bytes = 0
+        self.rejected = 0
+        self.throttled = 0
+        self._recipients = 0
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.sink = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        # A short poll interval keeps stop() quick for the tests' per-test sinks
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05},
+                                        name="smtp-sink", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def received(self, verb):
+        with self._lock:
+            self.commands[verb] += 1
+
+    def login(self):
+        with self._lock:
+            if self.refuse_login:
+                return False
+            self.logins += 1
+            return True
+
+    def recipient_reply(self, command):
+        address = command.partition(":")[2].strip().strip("<>").lower()
+        with self._lock:
+            self._recipients += 1
+            if address in self.replies:
+                return self.replies[address]
+            if self.throttle_every and self._recipients % self.throttle_every == 0:
+                self.throttled += 1
+                return "451 4.7.1 Too many messages, slow down"
+            if self.fail_rate and zlib.crc32(address.encode()) % 10000 < self.fail_rate * 10000:
+                self.rejected += 1
+                return "550 5.1.1 User unknown"
+        return None
+
+    def accepted(self, size):
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local SMTP sink for benchmarks and manual testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before acknowledging each message")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of recipients rejected with 550")
+    parser.add_argument("--throttle-every", type=int, default=0, help="Answer every Nth recipient with 451")
+    parser.add_argument("--pipelining", action="store_true", help="Advertise ESMTP PIPELINING")
+    args = parser.parse_args(argv)
+    sink = SMTPSink(args.host, args.port, args.latency, args.fail_rate, args.throttle_every, args.pipelining).start()
+    print(f"SMTP sink listening on {args.host}:{sink.address[1]} (Ctrl+C to stop)", flush=True)
+    try:
+        while True:
+            time.sleep(5)
+            print(f"accepted={sink.messages} rejected={sink.rejected} throttled={sink.throttled}", flush=True)
+    except KeyboardInterrupt:
+        sink.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+"""Sending engine for the Drip Mailer Streamlit app.
+
+Nothing in this package imports Streamlit, so the worker, the benchmarks and scripts can use
+it directly; app.py is only the UI on top.
+"""
@@ -0,0 +1,5 @@
+import sys
+
+from dripmailer.cli import main
+
+sys.exit(main())
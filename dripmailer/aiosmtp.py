@@ -0,0 +1,475 @@
+"""asyncio SMTP: pipelined sends, NOOP keep-alive and reconnects.
+
+AsyncSMTPPool is a drop-in SMTPPool for the batch send, and AsyncSessions gives Dispatcher
+sessions that stay logged in between drains. Replies are raised as the same smtplib
+exceptions the blocking path raises, so retries and error classification are unchanged.
+"""
+import asyncio
+import base64
+import contextlib
+import functools
+import re
+import smtplib
+import socket
+import ssl
+import threading
+import time
+
+from dripmailer.ratelimit import RateLimiter
+from dripmailer.smtp_pool import _STOP, SMTP_HOST, SMTP_PORT, SMTPPool, session_lost
+
+CRLF = b"\r\n"
+
+
+@functools.lru_cache(maxsize=1)
+def _local_hostname():
+    return socket.getfqdn()
+
+
+def _dot_stuff(data):
+    # What smtplib.sendmail does to a bytes message before ending it with <CRLF>.<CRLF>
+    data = re.sub(br'(?m)^\.', b'..', data)
+    if not data.endswith(CRLF):
+        data += CRLF
+    return data + b"." + CRLF
+
+
+class AsyncSMTP:
+    """One SMTP session on asyncio streams.
+
+    When the server advertises PIPELINING, MAIL FROM, every RCPT TO and DATA go out in a
+    single write, so a message costs two round-trips instead of smtplib's four.
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, use_ssl=True, timeout=30, pipelining=True):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.use_pipelining = pipelining
+        self.extensions = {}
+        # last_used counts any command, NOOPs included; last_sent only logins and messages
+        self.last_used = self.last_sent = time.monotonic()
+        self._reader = None
+        self._writer = None
+
+    @property
+    def connected(self):
+        # A relay that dropped the idle session shows up as EOF before anything is sent
+        return self._writer is not None and not self._writer.is_closing() and not self._reader.at_eof()
+
+    @property
+    def pipelining(self):
+        return self.use_pipelining and 'pipelining' in self.extensions
+
+    async def connect(self, username=None, password=None):
+        context = ssl.create_default_context() if self.use_ssl else None
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=context), self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timed out connecting to {self.host}:{self.port}") from None
+        code, message = await self._reply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, message)
+        await self._ehlo()
+        if password:
+            await self._login(username, password)
+        self.last_used = self.last_sent = time.monotonic()
+        return self
+
+    async def _ehlo(self):
+        code, message = await self.command(f"EHLO {_local_hostname()}")
+        if code != 250:
+            code, message = await self.command(f"HELO {_local_hostname()}")
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, message)
+            return
+        self.extensions = {}
+        for line in message.decode('latin-1').split('\n')[1:]:
+            name, _, params = line.strip().partition(' ')
+            self.extensions[name.lower()] = params
+
+    async def _login(self, username, password):
+        if 'auth' not in self.extensions:
+            raise smtplib.SMTPNotSupportedError("SMTP AUTH extension not supported by server.")
+        methods = self.extensions['auth'].upper().split()
+        if 'PLAIN' in methods:
+            token = base64.b64encode(f"\0{username}\0{password}".encode('utf-8')).decode('ascii')
+            code, message = await self.command(f"AUTH PLAIN {token}")
+        elif 'LOGIN' in methods:
+            code, message = await self.command("AUTH LOGIN " + base64.b64encode(username.encode('utf-8')).decode('ascii'))
+            if code == 334:
+                code, message = await self.command(base64.b64encode(password.encode('utf-8')).decode('ascii'))
+        else:
+            raise smtplib.SMTPException("No suitable authentication method found.")
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, message)
+
+    def _write(self, data):
+        if not self.connected:
+            raise smtplib.SMTPServerDisconnected("please run connect() first")
+        self._writer.write(data)
+
+    async def _reply(self):
+        """(code, message) of the next reply, joining the lines of a multi-line reply like smtplib."""
+        if self._reader is None:
+            raise smtplib.SMTPServerDisconnected("please run connect() first")
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self._reader.readline(), self.timeout)
+            except asyncio.TimeoutError:
+                self.close()
+                raise TimeoutError("Timed out waiting for the server's reply") from None
+            except ConnectionError:
+                self.close()
+                raise
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            lines.append(line[4:].strip(b" \t\r\n"))
+            if line[3:4] != b"-":
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        if code == 421:
+            self.close()
+        return code, b"\n".join(lines)
+
+    async def command(self, line):
+        self._write(line.encode('utf-8') + CRLF)
+        return await self._reply()
+
+    async def sendmail(self, sender, recipients, data):
+        """smtplib.SMTP.sendmail() for a bytes message: returns the refused recipients, raises
+        SMTPSenderRefused, SMTPRecipientsRefused or SMTPDataError like it does."""
+        commands = [f"MAIL FROM:<{sender}>"] + [f"RCPT TO:<{r}>" for r in recipients] + ["DATA"]
+        replies = []
+        if self.pipelining:
+            self._write(b"".join(c.encode('utf-8') + CRLF for c in commands))
+            # A 421 closes the session, so no replies follow it
+            while len(replies) < len(commands) and (not replies or replies[-1][0] != 421):
+                replies.append(await self._reply())
+        else:
+            # Stops where smtplib would: after a refused MAIL FROM or a 421, or before DATA when
+            # no recipient was accepted
+            replies.append(await self.command(commands[0]))
+            if replies[0][0] == 250:
+                for c in commands[1:-1]:
+                    replies.append(await self.command(c))
+                    if replies[-1][0] == 421:
+                        break
+                if replies[-1][0] != 421 and any(code in (250, 251) for code, _ in replies[1:]):
+                    replies.append(await self.command(commands[-1]))
+        self.last_used = time.monotonic()
+
+        code, message = replies[0]
+        refused = {r: reply for r, reply in zip(recipients, replies[1:]) if reply[0] not in (250, 251)}
+        data_code, data_message = replies[-1] if len(replies) == len(commands) else (503, b"")
+        closed = len(replies) < len(commands) and replies[-1][0] == 421
+        if code != 250 or len(refused) == len(recipients) or closed:
+            if data_code == 354:
+                # A pipelined DATA can be accepted even though nothing before it was
+                self._write(b"." + CRLF)
+                await self._reply()
+            await self._rset()
+            if code != 250:
+                raise smtplib.SMTPSenderRefused(code, message, sender)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data_code != 354:
+            await self._rset()
+            raise smtplib.SMTPDataError(data_code, data_message)
+
+        self._write(_dot_stuff(data))
+        code, message = await self._reply()
+        self.last_used = self.last_sent = time.monotonic()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, message)
+        return refused
+
+    async def _rset(self):
+        try:
+            if self.connected:
+                await self.command("RSET")
+        except (smtplib.SMTPServerDisconnected, asyncio.TimeoutError, ConnectionError):
+            pass
+
+    async def noop(self):
+        code, _ = await self.command("NOOP")
+        self.last_used = time.monotonic()
+        return code
+
+    async def quit(self):
+        try:
+            if self.connected:
+                await self.command("QUIT")
+        except Exception:
+            pass
+        self.close()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class EventLoopThread:
+    """An asyncio event loop running on a daemon thread, for callers that are not coroutines."""
+
+    def __init__(self, name):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self._thread.start()
+
+    def run(self, coro):
+        """Runs a coroutine on the loop and blocks until it returns."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class _Jobs:
+    """Thread-safe put() into an asyncio.Queue, so SMTPPool.imap() can feed the loop."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, job):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, job)
+
+
+class AsyncSMTPPool(SMTPPool):
+    """SMTPPool with every connection as a coroutine on one event loop instead of a thread.
+
+    Same interface, pacing, retries and metrics. Sends are pipelined when the relay allows
+    it, and a connection that has had no work for `keepalive` seconds sends a NOOP so the
+    relay doesn't drop it between bursts; one that was dropped anyway reconnects on the
+    next send.
+    """
+
+    def __init__(self, *args, keepalive=30, pipelining=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.keepalive = keepalive
+        self.pipelining = pipelining
+        self._loop = None
+
+    async def _aconnect(self, username, password):
+        with self.metrics.time('smtp_login'):
+            return await AsyncSMTP(self.host, self.port, self.use_ssl, self.timeout, self.pipelining).connect(username, password)
+
+    def start(self):
+        self._loop = EventLoopThread("smtp-pool")
+        try:
+            self._loop.run(self._start())
+        except BaseException:
+            self._loop.stop()
+            self._loop = None
+            raise
+        return self
+
+    async def _start(self):
+        # Every account logs in at once; bad credentials still fail before any lead is touched
+        sessions = await asyncio.gather(*(self._aconnect(u, p) for u, p in self.accounts), return_exceptions=True)
+        for (username, password), first in zip(self.accounts, sessions):
+            if isinstance(first, BaseException):
+                self.failed_logins[username] = first
+                continue
+            jobs = self._queues[username] = _Jobs(self._loop.loop)
+            self.senders.append(username)
+            for i in range(self.workers):
+                task = asyncio.ensure_future(self._arun(username, password, jobs.queue, first if i == 0 else None))
+                self._threads.append((jobs, task))
+        if not self.senders:
+            raise next(iter(self.failed_logins.values()))
+
+    def _withdraw(self):
+        return self._loop.run(self._awithdraw())
+
+    async def _awithdraw(self):
+        withdrawn = set()
+        for jobs in self._queues.values():
+            while not jobs.queue.empty():
+                job = jobs.queue.get_nowait()
+                if job is not _STOP:
+                    withdrawn.add(job[0])
+        return withdrawn
+
+    def close(self):
+        if self._loop is None:
+            return
+        self._withdraw()
+        for jobs, _ in self._threads:
+            jobs.put(_STOP)
+        self._loop.run(self._join())
+        self._threads = []
+        self._loop.stop()
+        self._loop = None
+
+    async def _join(self):
+        await asyncio.gather(*(task for _, task in self._threads), return_exceptions=True)
+
+    async def _next_job(self, jobs, session):
+        """The next job, sending a NOOP whenever the connection has been idle for `keepalive` seconds."""
+        while True:
+            if session is None or not session.connected or not self.keepalive:
+                return await jobs.get(), session
+            try:
+                return await asyncio.wait_for(jobs.get(), self.keepalive), session
+            except asyncio.TimeoutError:
+                try:
+                    if await session.noop() != 250:
+                        raise smtplib.SMTPServerDisconnected("NOOP refused")
+                except Exception:
+                    await session.quit()
+                    session = None
+
+    async def _arun(self, username, password, jobs, session):
+        limiter = RateLimiter(self.per_connection_rate)
+        account = self._account_limits.get(username)
+        while True:
+            job, session = await self._next_job(jobs, session)
+            if job is _STOP:
+                break
+            seq, envelope, submitted = job
+            domain = self._domains.get(envelope.recipient.rsplit("@", 1)[-1])
+            error = None
+            attempt = 0
+            while True:
+                try:
+                    if session is None or not session.connected:
+                        session = await self._aconnect(username, password)
+                    await limiter.acquire_async()
+                    await account.acquire_async()
+                    await self._global.acquire_async()
+                    await domain.acquire_async()
+                    with self.metrics.time('smtp_send'):
+                        await session.sendmail(envelope.sender, [envelope.recipient], envelope.data)
+                    account.speed_up()
+                    domain.speed_up()
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    if session_lost(e) and session is not None:
+                        await session.quit()
+                        session = None
+                    delay = self._retry_delay(e, attempt, account, domain)
+                    if delay is None:
+                        break
+                    if delay:
+                        await asyncio.sleep(delay)
+                    attempt += 1
+            self._finish(seq, error, submitted)
+        if session is not None:
+            await session.quit()
+
+
+class _Session:
+    """Blocking stand-in for an smtplib session, backed by one of AsyncSessions' connections."""
+
+    def __init__(self, sessions, email):
+        self.sessions = sessions
+        self.email = email
+
+    def sendmail(self, sender, recipients, data):
+        return self.sessions._loop.run(self.sessions._send(self.email, sender, recipients, data))
+
+    def quit(self):
+        self.sessions.drop(self.email)
+
+
+class AsyncSessions:
+    """Logged-in AsyncSMTP sessions, one per sender account, shared by Dispatcher runs.
+
+    A background task sends NOOP on sessions idle for `keepalive` seconds so they survive
+    the gaps between drains, and quits them after `max_idle` seconds without a send
+    (NOOPs don't count).
+    Sessions the relay dropped anyway are reopened on the next send.
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, use_ssl=True, timeout=30, keepalive=30, max_idle=600, pipelining=True):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        self.pipelining = pipelining
+        self._sessions = {}
+        self._locks = {}
+        self._loop = EventLoopThread("smtp-sessions")
+        self._keeper = asyncio.run_coroutine_threadsafe(self._keep_alive(), self._loop.loop) if keepalive else None
+
+    def session(self, email, password, metrics=None):
+        """A logged-in session for the account, reusing the open one when there is one.
+        Logins are timed in `metrics` under smtp_login."""
+        smtp = self._sessions.get(email)
+        if smtp is None or not smtp.connected:
+            self._loop.run(self._open(email, password, metrics))
+        return _Session(self, email)
+
+    def drop(self, email):
+        self._loop.run(self._drop(email))
+
+    def close(self):
+        if self._loop is None:
+            return
+        if self._keeper is not None:
+            self._keeper.cancel()
+        for email in list(self._sessions):
+            self.drop(email)
+        self._loop.stop()
+        self._loop = None
+
+    def _lock(self, email):
+        lock = self._locks.get(email)
+        if lock is None:
+            lock = self._locks[email] = asyncio.Lock()
+        return lock
+
+    async def _open(self, email, password, metrics):
+        async with self._lock(email):
+            smtp = self._sessions.get(email)
+            if smtp is None or not smtp.connected:
+                smtp = AsyncSMTP(self.host, self.port, self.use_ssl, self.timeout, self.pipelining)
+                with metrics.time('smtp_login') if metrics else contextlib.nullcontext():
+                    self._sessions[email] = await smtp.connect(email, password)
+
+    async def _send(self, email, sender, recipients, data):
+        async with self._lock(email):
+            smtp = self._sessions.get(email)
+            if smtp is None or not smtp.connected:
+                raise smtplib.SMTPServerDisconnected("Session closed since it was opened")
+            return await smtp.sendmail(sender, recipients, data)
+
+    async def _drop(self, email):
+        async with self._lock(email):
+            smtp = self._sessions.pop(email, None)
+            if smtp is not None:
+                await smtp.quit()
+
+    async def _keep_alive(self):
+        while True:
+            await asyncio.sleep(self.keepalive / 2)
+            for email, smtp in list(self._sessions.items()):
+                lock = self._lock(email)
+                idle = time.monotonic() - smtp.last_used
+                if lock.locked() or idle < self.keepalive:
+                    continue
+                async with lock:
+                    if self._sessions.get(email) is not smtp:
+                        continue
+                    try:
+                        if time.monotonic() - smtp.last_sent >= self.max_idle or not smtp.connected or await smtp.noop() != 250:
+                            raise smtplib.SMTPServerDisconnected("Idle session closed")
+                    except Exception:
+                        del self._sessions[email]
+                        await smtp.quit()
@@ -0,0 +1,238 @@
+import collections
+import datetime
+import json
+
+from dripmailer import storage
+from dripmailer.message import MessageFactory
+from dripmailer.metrics import Metrics
+from dripmailer.outbox import message_digest
+from dripmailer.planner import SendPlanner
+from dripmailer.ratelimit import describe_error
+from dripmailer.signatures import for_account
+from dripmailer.suppression import SuppressionList, hard_bounce
+from dripmailer.templating import compile_template
+
+
+class CampaignRunner:
+    """Sends a stored campaign's main email to its leads and schedules their follow-ups.
+
+    Each lead's outcome is checkpointed in the leads table as the run goes, so running an
+    interrupted campaign again carries on with the leads it never got to. When the run is
+    stopped by an exception (a Streamlit rerun, a lost connection) the leads it had claimed
+    are settled exactly. Only after a hard kill can leads be left with an unknown outcome;
+    they are resent if `resend_unconfirmed` is set and otherwise set aside as 'unconfirmed'.
+
+    Leads are dealt round-robin to the pool's logged-in accounts (see SMTPPool's
+    `accounts`), each lead's follow-ups later going out from the same account. An account
+    whose daily or hourly quota is used up drops out of the rotation; once every account
+    is out, the run stops and the campaign stays unfinished, to be resumed after the reset.
+
+    Follow-up send times come from `schedule(days_ahead, lead, sender_email)`, by default
+    a SendPlanner with no hourly cap.
+
+    Before sending, pending leads on the suppression list, and with `skip_contacted` those
+    another campaign has already emailed, are set aside as 'suppressed'. Addresses the
+    relay refuses for good are added to the list as hard bounces.
+
+    Given an `outbox` (see dripmailer.outbox), a lead's main email goes out as spooled,
+    from the account it was rendered for, as long as that account can still send and the
+    lead, templates and signature are unchanged; otherwise it is rendered here as usual.
+
+    on_event(event, subject, detail) is called with:
+      'start' (number of leads to send), 'unconfirmed' (count, resent?),
+      'sent' / 'failed' (lead, error), 'scheduled' (lead, (template name, send_at)),
+      'suppressed' (count), 'prescheduled' (count), 'cancelled' (count) and
+      'quota_exhausted' (leads left, datetime the first account can send again).
+    """
+
+    def __init__(self, conn, campaign_id, pre_enqueue=False, enqueue_batch=500, checkpoint_every=25,
+                 schedule=None, suppressions=None, skip_contacted=True, metrics=None, outbox=None):
+        self.conn = conn
+        self.metrics = metrics or Metrics()
+        self.campaign_id = campaign_id
+        self.enqueue_batch = enqueue_batch
+        self.checkpoint_every = checkpoint_every
+        self.schedule = schedule or SendPlanner(conn)
+        self.suppressions = suppressions or SuppressionList.load(conn)
+        self.skip_contacted = skip_contacted
+        self.outbox = outbox
+        self.campaign = storage.get_campaign(conn, campaign_id)
+        templates = storage.campaign_templates(conn, campaign_id)
+        self.main = templates[0]
+        self.followups = templates[1:]
+        self.pre_enqueue = bool(pre_enqueue and self.followups)
+        self._factories = {}
+        self._senders = collections.deque([self.campaign['sender_email']])
+        self.quotas = storage.QuotaTracker(conn)
+        self.out_of_quota = False
+        # Leads marked 'sending' in the database whose result has not been recorded yet
+        self._claimed = set()
+
+    def lead_variables(self, record, sender_name=None):
+        return dict(record, your_name=sender_name or self.campaign['sender_name'])
+
+    def factory(self, email):
+        """MessageFactory for one of the sending accounts, with its own name and signature address."""
+        factory = self._factories.get(email)
+        if factory is None:
+            account = storage.get_account(self.conn, email) if email != self.campaign['sender_email'] else None
+            name = (account['sender_name'] if account is not None else None) or self.campaign['sender_name']
+            signature = for_account(self.campaign['signature_html'], self.campaign['sender_email'], email)
+            factory = self._factories[email] = MessageFactory(name, email, signature)
+        return factory
+
+    def _spooled_account(self, record):
+        """(account, outbox entry) when the lead's spooled main email can go out from its
+        account, which then has a send taken from its quota; otherwise (None, None)."""
+        entry = self.outbox.get(record['email'], 0)
+        if entry is None or entry.sender not in self._senders or not self.quotas.take(entry.sender):
+            self.metrics.count('outbox_messages_total', result='unused')
+            return None, None
+        return entry.sender, entry
+
+    def _spooled(self, entry, factory, row_dict):
+        signature = for_account(self.campaign['signature_html'], self.campaign['sender_email'], factory.from_email)
+        digest = message_digest(factory.from_name, factory.from_email, signature, self.main['subject'], self.main['body'], json.dumps(row_dict))
+        hit = entry.digest == digest
+        self.metrics.count('outbox_messages_total', result='hit' if hit else 'stale')
+        if not hit:
+            return None
+        with self.metrics.time('outbox_read'):
+            return self.outbox.envelope(entry)
+
+    def _next_account(self):
+        # Round-robin over the logged-in accounts, skipping any that are out of quota
+        for _ in range(len(self._senders)):
+            email = self._senders[0]
+            self._senders.rotate(-1)
+            if self.quotas.take(email):
+                return email
+        return None
+
+    def followup_rows(self, row_dict, sender_email):
+        # Follow-ups are rendered by the dispatcher at send time from the stored template
+        for template in self.followups:
+            send_at = self.schedule(template['delay_days'], row_dict, sender_email)
+            row = storage.followup_row(self.campaign_id, row_dict['email'], template['id'], row_dict,
+                                       storage.to_epoch(send_at), template['step'])
+            yield template['name'], send_at, row
+
+    def _pre_enqueue(self, emit):
+        queued = [0]
+
+        def rows():
+            for record in storage.iter_leads(self.conn, self.campaign_id, status='pending'):
+                row_dict = self.lead_variables(record)
+                # Planned against the campaign's own account; the lead may later be dealt to another
+                for name, send_at, row in self.followup_rows(row_dict, self.campaign['sender_email']):
+                    queued[0] += 1
+                    emit('scheduled', row_dict, (name, send_at))
+                    yield row
+
+        with self.metrics.time('db_write'):
+            storage.enqueue_followups(self.conn, rows())
+            self.conn.commit()
+        emit('prescheduled', queued[0], None)
+
+    def _suppress(self, emit):
+        reason_for = self.suppressions.reason
+        if self.skip_contacted:
+            contacted = storage.contacted_emails(self.conn, self.campaign_id)
+            reason_for = lambda email: self.suppressions.reason(email) or ("Already emailed by another campaign" if email in contacted else None)
+        suppressed = storage.suppress_leads(self.conn, self.campaign_id, reason_for)
+        if suppressed:
+            emit('suppressed', suppressed, None)
+
+    def _jobs(self, claim_batch):
+        main_subject = compile_template(self.main['subject'] or "")
+        main_body = compile_template(self.main['body'] or "")
+        after_id = 0
+        while True:
+            with self.metrics.time('db_claim'):
+                claimed = storage.claim_leads(self.conn, self.campaign_id, after_id, claim_batch)
+            if not claimed:
+                return
+            self._claimed.update(lead_id for lead_id, _ in claimed)
+            for lead_id, record in claimed:
+                email, entry = self._spooled_account(record) if self.outbox is not None else (None, None)
+                if email is None:
+                    email = self._next_account()
+                if email is None:
+                    # Every account is out of quota; the unsent leads are handed back as pending
+                    self.out_of_quota = True
+                    return
+                factory = self.factory(email)
+                row_dict = self.lead_variables(record, factory.from_name)
+                envelope = self._spooled(entry, factory, row_dict) if entry is not None else None
+                if envelope is None:
+                    with self.metrics.time('render'):
+                        subject, body = main_subject.render(row_dict), main_body.render(row_dict)
+                    with self.metrics.time('mime_build'):
+                        envelope = factory.build(row_dict['email'], subject, body)
+                yield (lead_id, row_dict, envelope.message_id, email), envelope
+            after_id = claimed[-1][0]
+
+    def _record(self, checkpoint, tag, error, emit):
+        lead_id, row_dict, message_id, email = tag
+        self._claimed.discard(lead_id)
+        if error is None:
+            # Queued ahead of the lead's own checkpoint and of any event (on_event may stop the
+            # run): a resume never schedules the follow-ups of a lead already marked sent
+            scheduled = [] if self.pre_enqueue else list(self.followup_rows(row_dict, email))
+            for _, _, row in scheduled:
+                checkpoint.add(row)
+            checkpoint.lead_done(lead_id, 'sent', message_id, sender_email=email)
+            emit('sent', row_dict, None)
+            for name, send_at, _ in scheduled:
+                emit('scheduled', row_dict, (name, send_at))
+        else:
+            self.quotas.refund(email)
+            bounce = hard_bounce(error)
+            if bounce:
+                self.suppressions.add(self.conn, [row_dict['email']], bounce, source='bounce')
+            checkpoint.lead_done(lead_id, 'failed', error=describe_error(error), sender_email=email)
+            emit('failed', row_dict, error)
+
+    def run(self, pool, on_event=None, resend_unconfirmed=False):
+        """Sends to every pending lead through `pool` and returns the final lead status counts."""
+        emit = on_event or (lambda event, subject, detail: None)
+        conn = self.conn
+
+        unconfirmed = storage.settle_unconfirmed_leads(conn, self.campaign_id, 'pending' if resend_unconfirmed else 'unconfirmed')
+        if unconfirmed:
+            emit('unconfirmed', unconfirmed, resend_unconfirmed)
+        self._suppress(emit)
+        emit('start', storage.lead_status_counts(conn, self.campaign_id).get('pending', 0), None)
+
+        if self.pre_enqueue:
+            self._pre_enqueue(emit)
+
+        self._senders = collections.deque(pool.senders)
+        self.out_of_quota = False
+        # Claim about as many leads as the pool keeps in flight, so few are at stake in a crash
+        with storage.CampaignCheckpoint(conn, self.enqueue_batch, self.checkpoint_every, self.metrics) as checkpoint:
+            results = pool.imap(self._jobs(pool.connections * 4))
+            try:
+                for tag, error in results:
+                    self._record(checkpoint, tag, error, emit)
+            finally:
+                # Interrupted: keep what already went out and hand the rest back as pending
+                results.close()
+                for tag, error in pool.abandoned:
+                    self._record(checkpoint, tag, error, lambda event, subject, detail: None)
+                checkpoint.flush()
+                storage.release_leads(conn, self._claimed)
+                self._claimed.clear()
+                self.quotas.release()
+
+        # Leads whose main email failed, was suppressed or was left unconfirmed by an earlier
+        # run must not get the follow-ups pre-scheduled for them
+        emit('cancelled', storage.cancel_unsent_followups(conn, self.campaign_id), None)
+
+        counts = storage.lead_status_counts(conn, self.campaign_id)
+        if self.out_of_quota:
+            resets_at = min(filter(None, map(self.quotas.resets_at, pool.senders)), default=None)
+            emit('quota_exhausted', counts.get('pending', 0), datetime.datetime.fromtimestamp(resets_at) if resets_at else None)
+        else:
+            storage.finish_campaign(conn, self.campaign_id)
+        return counts
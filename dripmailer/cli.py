@@ -0,0 +1,573 @@
+"""Headless batch sends and queue draining, for cron or systemd.
+
+    python -m dripmailer send --leads leads.csv --template intro.txt --followup 4:bump.txt --email me@streamax.com
+    python -m dripmailer send --resume CAMPAIGN_ID
+    python -m dripmailer drain-queue
+    python -m dripmailer accounts add sales2@streamax.com --daily 500 --hourly 100
+    python -m dripmailer suppress import unsubscribed.csv --reason "Unsubscribed"
+    python -m dripmailer scan-inbox --email me@streamax.com
+    python -m dripmailer archive --days 30
+    python -m dripmailer outbox show CAMPAIGN_ID --email someone@example.com
+
+Template files start with a "Subject: ..." line, then a blank line, then the body. SMTP
+passwords are read from $DRIPMAILER_PASSWORD, or prompted for on a terminal.
+"""
+import argparse
+import collections
+import datetime
+import getpass
+import imaplib
+import itertools
+import os
+import signal
+import smtplib
+import sys
+import time
+import uuid
+
+from dripmailer import outbox, storage, worker
+from dripmailer.aiosmtp import AsyncSMTPPool
+from dripmailer.campaign import CampaignRunner
+from dripmailer.execlog import ExecutionLog, new_log_path
+from dripmailer.inbox import IMAP_HOST, IMAP_PORT, InboxScanner
+from dripmailer.leads import missing_columns, read_columns, spool_csv
+from dripmailer.metrics import Metrics, profile_summary, profiled
+from dripmailer.planner import SendPlanner
+from dripmailer.ratelimit import describe_error
+from dripmailer.signatures import LAYOUTS, signature_html
+from dripmailer.smtp_pool import SMTP_HOST, SMTP_PORT, SMTPPool
+from dripmailer.suppression import SuppressionList, import_csv
+
+log = worker.log
+
+
+def read_template(path):
+    """(name, subject, body) from a template file; the name is the file name without extension."""
+    with open(path, encoding='utf-8') as f:
+        first, _, body = f.read().partition('\n')
+    if not first.lower().startswith('subject:'):
+        raise ValueError(f"{path}: the first line must be 'Subject: ...'")
+    name = os.path.splitext(os.path.basename(path))[0]
+    return name, first[len('subject:'):].strip(), body.strip('\n')
+
+
+def followup_spec(value):
+    days, sep, path = value.partition(':')
+    if not sep or not days.isdigit() or int(days) < 1:
+        raise argparse.ArgumentTypeError(f"expected DAYS:FILE with DAYS >= 1, got {value!r}")
+    return int(days), path
+
+
+def business_hours(value):
+    """START-END (e.g. 9-17) for --business-hours."""
+    start, sep, end = value.partition('-')
+    if not sep or not start.strip().isdigit() or not end.strip().isdigit():
+        raise argparse.ArgumentTypeError(f"expected START-END hours like 9-17, got {value!r}")
+    return int(start), int(end)
+
+
+def holiday(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a YYYY-MM-DD date, got {value!r}")
+
+
+def campaign_signature(args, email):
+    if args.signature_html:
+        with open(args.signature_html, encoding='utf-8') as f:
+            return f.read()
+    return signature_html(args.signature_layout, {
+        'name': args.sender_name, 'title': args.title, 'company': args.company, 'phone': args.phone,
+        'email': email, 'website': args.website, 'avatarUrl': args.avatar_url, 'logoUrl': args.logo_url,
+    })
+
+
+class Progress:
+    """CampaignRunner events to the execution log and stdout: every lead with --verbose,
+    otherwise a status line every few seconds."""
+
+    def __init__(self, execution_log, metrics, verbose=False, interval=5.0):
+        self.execution_log = execution_log
+        self.metrics = metrics
+        self.verbose = verbose
+        self.interval = interval
+        self.total = self.sent = self.failed = 0
+        self.reported_at = time.monotonic()
+
+    def __call__(self, event, subject, detail):
+        self.execution_log.on_event(event, subject, detail)
+        if event == 'start':
+            self.total = subject
+            log(f"{subject} leads to send")
+        elif event == 'unconfirmed':
+            log(f"{subject} leads were in flight when the last run stopped, {'sending them again' if detail else 'skipping them'}")
+        elif event == 'suppressed':
+            log(f"Skipping {subject} leads on the suppression list or already emailed by another campaign")
+        elif event == 'prescheduled':
+            log(f"Pre-scheduled {subject} follow-ups")
+        elif event == 'cancelled':
+            if subject:
+                log(f"Cancelled {subject} follow-ups of leads whose main email was not sent")
+        elif event == 'quota_exhausted':
+            resets = f"; quotas reset at {detail:%Y-%m-%d %H:%M:%S}" if detail else ""
+            log(f"Every account is out of quota, {subject} leads left{resets}")
+        elif event == 'scheduled':
+            if self.verbose:
+                log(f"Queued '{detail[0]}' for {subject['email']} at {detail[1]:%Y-%m-%d %H:%M:%S}")
+        else:
+            if event == 'sent':
+                self.sent += 1
+                if self.verbose:
+                    log(f"Sent to {subject['email']}")
+            else:
+                self.failed += 1
+                if self.verbose:
+                    log(f"Failed to send to {subject['email']}: {describe_error(detail)}")
+            if not self.verbose and time.monotonic() - self.reported_at >= self.interval:
+                log(self.summary())
+                self.reported_at = time.monotonic()
+
+    def summary(self):
+        done = self.sent + self.failed
+        return f"{done}/{self.total} leads, {self.sent} sent, {self.failed} failed, {self.metrics.current_rate():.1f} emails/sec"
+
+
+def read_password(prompt):
+    password = os.environ.get('DRIPMAILER_PASSWORD')
+    if not password and sys.stdin.isatty():
+        password = getpass.getpass(prompt)
+    return password
+
+
+def build_outbox(conn, campaign_id, path, accounts=None, workers=None):
+    started = time.perf_counter()
+    reported = [started]
+
+    def on_progress(done, total):
+        if time.perf_counter() - reported[0] >= 5:
+            log(f"Rendered {done}/{total} leads")
+            reported[0] = time.perf_counter()
+
+    stats = outbox.build(conn, campaign_id, path, accounts, workers, on_progress=on_progress)
+    log(f"Rendered {stats['messages']} emails for {stats['leads']} leads into {path} "
+        f"({stats['bytes'] / 1e6:.1f} MB) in {time.perf_counter() - started:.1f}s")
+
+
+def cmd_send(args):
+    storage.init_db(args.db)
+    conn = storage.connect(args.db)
+    campaign_id = templates = None
+    metrics = Metrics()
+    try:
+        start_hour, end_hour = args.business_hours
+        planner = SendPlanner(conn, capacity=args.hourly_capacity, start_hour=start_hour, end_hour=end_hour,
+                              holidays=args.holiday, lead_timezones=args.lead_timezones)
+        if args.resume:
+            campaign = storage.get_campaign(conn, args.resume)
+            if campaign is None:
+                log(f"No campaign {args.resume} in {args.db}")
+                return 2
+            campaign_id, username, password = args.resume, campaign['sender_email'], campaign['sender_password']
+            accounts = storage.campaign_accounts(conn, campaign)
+        else:
+            username = args.email or os.environ.get('DRIPMAILER_EMAIL')
+            if not username:
+                log("No sender account: pass --email or set DRIPMAILER_EMAIL")
+                return 2
+            password = read_password(f"Password for {username}: ")
+            if not password:
+                log("No password: set DRIPMAILER_PASSWORD")
+                return 2
+            accounts = storage.campaign_accounts(conn, {'sender_email': username, 'sender_password': password, 'use_accounts': args.all_accounts})
+
+            # Resolve the templates before anything is written, so a typo fails fast
+            name, subject, body = read_template(args.template)
+            templates = [(0, "Original", subject, body, 0)]
+            for days, path in args.followup:
+                name, subject, body = read_template(path)
+                templates.append((len(templates), name, subject, body, days))
+            signature = campaign_signature(args, username)
+
+            with open(args.leads, 'rb') as f:
+                missing = missing_columns(read_columns(f))
+                if missing:
+                    log(f"Missing required columns: {', '.join(missing)}")
+                    return 2
+                campaign_id = uuid.uuid4().hex
+                valid, rejected = spool_csv(conn, f, campaign_id)
+            log(f"Campaign {campaign_id}: {valid} valid leads, {rejected} rows skipped")
+
+        log_path = args.log or new_log_path(campaign_id)
+        with open(log_path, 'w', newline='', encoding='utf-8') as log_file:
+            progress = Progress(ExecutionLog(log_file), metrics, args.verbose, args.progress_interval)
+            pool_class = AsyncSMTPPool if args.async_smtp else SMTPPool
+            with pool_class(
+                username, password,
+                workers=args.workers, per_connection_rate=args.connection_rate, global_rate=args.rate,
+                host=args.host, port=args.port, use_ssl=not args.no_ssl, max_retries=args.max_retries,
+                account_rate=args.account_rate, domain_rate=args.domain_rate, metrics=metrics, accounts=accounts,
+            ) as pool:
+                for email, error in pool.failed_logins.items():
+                    log(f"Could not log in as {email}, sending without it: {error}")
+                if len(pool.senders) > 1:
+                    log(f"Sending from {len(pool.senders)} accounts: {', '.join(pool.senders)}")
+                # Sender, signature and templates are stored once the login succeeded, as in the app
+                if templates is not None:
+                    storage.save_campaign(conn, campaign_id, args.sender_name, username, password, signature, templates,
+                                          use_accounts=args.all_accounts)
+                progress.execution_log.write_config(storage.campaign_templates(conn, campaign_id))
+                log(f"Writing the execution log to {log_path}")
+
+                spooled = None
+                if args.outbox or args.outbox_only:
+                    path = outbox.outbox_path(campaign_id, args.outbox_dir)
+                    # An outbox built (and maybe inspected) earlier is sent as it is
+                    if args.outbox_only or not outbox.exists(path):
+                        build_outbox(conn, campaign_id, path, pool.senders, args.outbox_workers)
+                    if args.outbox_only:
+                        log(f"Nothing sent. Inspect it with: python -m dripmailer outbox show {campaign_id}")
+                        log(f"Then send it with: python -m dripmailer send --resume {campaign_id} --outbox")
+                        return 0
+                    spooled = outbox.Outbox(path)
+                    log(f"Sending from the outbox {path} ({len(spooled)} emails)")
+
+                runner = CampaignRunner(conn, campaign_id, schedule=planner, skip_contacted=not args.recontact,
+                                        pre_enqueue=args.pre_schedule,
+                                        enqueue_batch=args.enqueue_batch, metrics=metrics, outbox=spooled)
+                try:
+                    if args.profile:
+                        with profiled(args.profile) as profiler:
+                            counts = runner.run(pool, progress, args.resend_unconfirmed)
+                        print(profile_summary(profiler), flush=True)
+                    else:
+                        counts = runner.run(pool, progress, args.resend_unconfirmed)
+                finally:
+                    if spooled is not None:
+                        spooled.close()
+        log(progress.summary())
+        if planner.overbooked:
+            log(f"{planner.overbooked} follow-ups found no hour under --hourly-capacity within {planner.max_days} days and were booked into the least busy one")
+        log("Done: " + ", ".join(f"{n} {status}" for status, n in sorted(counts.items())))
+        if runner.out_of_quota:
+            log(f"Send the rest after the reset with: python -m dripmailer send --resume {campaign_id}")
+        return 0
+    except ValueError as e:
+        log(str(e))
+        return 2
+    except smtplib.SMTPAuthenticationError:
+        log(f"Email or password incorrect for {username}")
+        return 1
+    except (OSError, smtplib.SMTPException) as e:
+        log(f"SMTP Connection Error: {e}")
+        return 1
+    except KeyboardInterrupt:
+        log(f"Interrupted. Resume with: python -m dripmailer send --resume {campaign_id}")
+        return 130
+    finally:
+        # A list that never got past the login is not kept around as an unstartable campaign
+        if campaign_id and templates is not None and storage.get_campaign(conn, campaign_id) is None:
+            storage.delete_campaign_leads(conn, campaign_id)
+        conn.close()
+        if args.metrics:
+            metrics.export(args.metrics)
+
+
+def cmd_drain_queue(args):
+    return worker.run(once=True, **worker.run_options(args))
+
+
+def cmd_scan_inbox(args):
+    username = args.email or os.environ.get('DRIPMAILER_EMAIL')
+    if not username:
+        log("No mailbox account: pass --email or set DRIPMAILER_EMAIL")
+        return 2
+    password = read_password(f"Password for {username}: ")
+    if not password:
+        log("No password: set DRIPMAILER_PASSWORD")
+        return 2
+    storage.init_db(args.db)
+    conn = storage.connect(args.db)
+    scanner = InboxScanner(username, password, host=args.host, port=args.port, use_ssl=not args.no_ssl, mailbox=args.mailbox)
+    try:
+        counts = scanner.scan(conn, on_batch=lambda counts, left: log(f"{counts['messages']} messages read, {left} left"))
+    except (OSError, imaplib.IMAP4.error) as e:
+        log(f"IMAP Error: {e}")
+        return 1
+    finally:
+        conn.close()
+    log(f"{counts['messages']} new messages: {counts['replied']} leads replied, {counts['bounced']} bounced, "
+        f"{counts['cancelled']} follow-ups cancelled")
+    return 0
+
+
+def cmd_archive(args):
+    storage.init_db(args.db)
+    conn = storage.connect(args.db)
+    try:
+        if args.enable_incremental_vacuum and not storage.storage_stats(conn)['incremental_vacuum']:
+            log("Rewriting the database once to enable incremental vacuum...")
+            storage.enable_incremental_vacuum(conn)
+        started = time.perf_counter()
+        on_batch = (lambda n: log(f"Archived {n} rows")) if args.verbose else None
+        archived = storage.archive_finished(conn, args.days, args.batch_size, on_batch=on_batch)
+        freed = storage.reclaim_space(conn)
+        stats = storage.storage_stats(conn)
+    finally:
+        conn.close()
+    log(f"Archived {archived} emails finished more than {args.days} days ago in {time.perf_counter() - started:.1f}s, "
+        f"freed {freed / 1e6:.1f} MB")
+    hot = ", ".join(f"{n} {status}" for status, n in sorted(stats['hot'].items())) or "empty"
+    log(f"Queue: {hot}; archive: {stats['archived']} rows; database {stats['db_bytes'] / 1e6:.1f} MB")
+    if not stats['incremental_vacuum']:
+        log("This database can't hand free space back yet; run once with --enable-incremental-vacuum while nothing else is sending")
+    return 0
+
+
+def open_outbox(target, directory):
+    """The outbox at a path, or the one of a campaign id in `directory`."""
+    path = target if outbox.exists(target) else outbox.outbox_path(target, directory)
+    if not outbox.exists(path):
+        raise ValueError(f"No outbox at {target} or {path}")
+    return outbox.Outbox(path)
+
+
+def cmd_outbox(args):
+    try:
+        if args.action == 'build':
+            storage.init_db(args.db)
+            conn = storage.connect(args.db)
+            try:
+                build_outbox(conn, args.campaign, args.out or outbox.outbox_path(args.campaign, args.dir), workers=args.workers)
+            finally:
+                conn.close()
+        elif args.action == 'delete':
+            path = outbox.outbox_path(args.campaign, args.dir)
+            log(f"Deleted {path}" if outbox.remove(path) else f"No outbox at {path}")
+        elif args.action == 'diff':
+            with open_outbox(args.old, args.dir) as old, open_outbox(args.new, args.dir) as new:
+                changes = collections.Counter()
+                for email, step, change, lines in outbox.diff(old, new):
+                    changes[change] += 1
+                    if lines:
+                        print('\n'.join(lines))
+                    else:
+                        print(f"Only in {old.path if change == 'removed' else new.path}: {email} (step {step})")
+            log(f"{changes['changed']} emails differ, {changes['removed']} only in {old.path}, {changes['added']} only in {new.path}")
+        else:
+            with open_outbox(args.target, args.dir) as spooled:
+                if not args.raw:
+                    steps = collections.Counter(entry.step for entry in spooled)
+                    print(f"{spooled.path}: campaign {spooled.campaign_id}, built {storage.format_ts(spooled.created_at)}, "
+                          f"{len(spooled)} emails, {spooled.size / 1e6:.1f} MB")
+                    print("  " + ", ".join(f"step {step}: {n}" for step, n in sorted(steps.items())))
+                if args.email:
+                    for entry in spooled:
+                        if entry.email == args.email.strip().lower() and args.step in (None, entry.step):
+                            if args.raw:
+                                sys.stdout.write(spooled.raw(entry).decode('ascii') + '\n')
+                            else:
+                                print(f"\n=== step {entry.step}, {entry.message_id} ===")
+                                print('\n'.join(outbox.describe(spooled.raw(entry))))
+                else:
+                    print(f"{'step':>4}  {'from':<32} {'to':<36} message-id")
+                    for entry in itertools.islice((e for e in spooled if args.step in (None, e.step)), args.limit):
+                        print(f"{entry.step:>4}  {entry.sender:<32} {entry.email:<36} {entry.message_id}")
+        return 0
+    except (OSError, ValueError) as e:
+        log(str(e))
+        return 2
+
+
+def cmd_accounts(args):
+    storage.init_db(args.db)
+    conn = storage.connect(args.db)
+    try:
+        if args.action == 'add':
+            existing = storage.get_account(conn, args.email)
+            password = read_password(f"Password for {args.email}{' (empty keeps the stored one)' if existing else ''}: ")
+            if not password and existing is None:
+                log("No password: set DRIPMAILER_PASSWORD")
+                return 2
+            storage.save_account(conn, args.email, password or "", args.name, args.daily, args.hourly, not args.disabled)
+            log(f"Saved {args.email}")
+        elif args.action == 'remove':
+            storage.delete_account(conn, args.email)
+            log(f"Removed {args.email}")
+        else:
+            print(f"{'account':<36} {'enabled':>7} {'today':>13} {'this hour':>13}")
+            for a in storage.accounts_overview(conn):
+                today = f"{a['sent_today']}/{a['daily_quota'] or '-'}"
+                hour = f"{a['sent_this_hour']}/{a['hourly_quota'] or '-'}"
+                print(f"{a['email']:<36} {'yes' if a['enabled'] else 'no':>7} {today:>13} {hour:>13}")
+        return 0
+    finally:
+        conn.close()
+
+
+def cmd_suppress(args):
+    storage.init_db(args.db)
+    conn = storage.connect(args.db)
+    try:
+        expires_at = storage.now_ts(args.days * 86400) if getattr(args, 'days', 0) else None
+        if args.action == 'import':
+            started = time.perf_counter()
+            with open(args.file, 'rb') as f:
+                added, invalid = import_csv(conn, f, args.reason, source=os.path.basename(args.file), expires_at=expires_at)
+            log(f"Suppressed {added} addresses/domains in {time.perf_counter() - started:.1f}s"
+                + (f", skipped {invalid} invalid values" if invalid else ""))
+        elif args.action == 'add':
+            added, invalid = SuppressionList().add(conn, args.values, args.reason, expires_at=expires_at)
+            log(f"Suppressed {added}" + (f", skipped {invalid} invalid values" if invalid else ""))
+        elif args.action == 'remove':
+            log(f"Removed {storage.remove_suppressions(conn, [v.strip().lower() for v in args.values])}")
+        elif args.action == 'purge':
+            log(f"Deleted {storage.purge_expired_suppressions(conn)} expired suppressions")
+        else:
+            counts = storage.suppression_counts(conn)
+            print(f"{counts['address']} addresses, {counts['domain']} domains, {counts['expired']} expired")
+            for r in storage.suppression_page(conn, args.search, args.limit):
+                expires = storage.format_ts(r['expires_at']) or "never"
+                print(f"{r['value']:<40} {r['kind']:<8} expires {expires:<19}  {r['reason'] or ''}")
+        return 0
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m dripmailer", description="Drip Mailer without the browser.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    send = commands.add_parser('send', help="Batch send a campaign's main email and schedule its follow-ups (tab 3)")
+    send.add_argument("--leads", metavar="CSV", help="Lead list with first_name, last_name, email, role, company")
+    send.add_argument("--template", metavar="FILE", help="Main email template")
+    send.add_argument("--followup", metavar="DAYS:FILE", type=followup_spec, action="append", default=[],
+                      help="Follow-up template sent DAYS after the main email; repeat for more steps")
+    send.add_argument("--resume", metavar="CAMPAIGN_ID", help="Carry on with an interrupted campaign instead")
+    send.add_argument("--resend-unconfirmed", action="store_true", help="When resuming, resend leads whose result is unknown")
+    send.add_argument("--email", help="Sender account (default: $DRIPMAILER_EMAIL)")
+    send.add_argument("--all-accounts", action="store_true", help="Spread the leads over every enabled sender account as well")
+    send.add_argument("--sender-name", default="", help="Sender display name, also {your_name} and the signature name")
+    send.add_argument("--signature-layout", choices=LAYOUTS, default=LAYOUTS[0])
+    send.add_argument("--signature-html", metavar="FILE", help="Use this HTML as the signature instead of a layout")
+    send.add_argument("--title", default="")
+    send.add_argument("--company", default="Streamax Technology")
+    send.add_argument("--phone", default="")
+    send.add_argument("--website", default="https://www.streamax.com")
+    send.add_argument("--avatar-url", default="")
+    send.add_argument("--logo-url", default="https://mail.streamax.com/coremail/s?func=lp:getImg&org_id=&img_id=logo_001")
+    send.add_argument("--db", default=storage.DB_PATH, help="Path to campaigns.db")
+    send.add_argument("--log", metavar="FILE", help="Execution log CSV (default: campaign_log_<time>_<campaign>.csv)")
+    send.add_argument("--host", default=SMTP_HOST)
+    send.add_argument("--port", type=int, default=SMTP_PORT)
+    send.add_argument("--no-ssl", action="store_true", help="Plain SMTP instead of SMTPS")
+    send.add_argument("--workers", type=int, default=4, help="Parallel SMTP connections")
+    send.add_argument("--connection-rate", type=float, default=1.0, help="Max emails/sec per connection (0 = no limit)")
+    send.add_argument("--rate", type=float, default=4.0, help="Max emails/sec overall (0 = no limit)")
+    send.add_argument("--account-rate", type=float, help="Max emails/sec per sender account (default: --rate)")
+    send.add_argument("--domain-rate", type=float, default=0, help="Max emails/sec per recipient domain (0 = no limit)")
+    send.add_argument("--async-smtp", action="store_true", help="Send through the asyncio engine (pipelined, NOOP keep-alive)")
+    send.add_argument("--max-retries", type=int, default=2, help="Retries per email on temporary failures")
+    send.add_argument("--enqueue-batch", type=int, default=500, help="Follow-ups written per DB transaction")
+    send.add_argument("--pre-schedule", action="store_true", help="Write every lead's follow-ups before the main send starts")
+    send.add_argument("--recontact", action="store_true", help="Also send to leads another campaign has already emailed")
+    send.add_argument("--outbox", action="store_true",
+                      help="Render every email into the campaign's outbox on all CPUs first (or use the one already built), then send from it")
+    send.add_argument("--outbox-only", action="store_true", help="Build the outbox and stop before sending, to inspect it")
+    send.add_argument("--outbox-dir", default=outbox.OUTBOX_DIR, help="Where outboxes are kept")
+    send.add_argument("--outbox-workers", type=int, help="Rendering processes (default: one per CPU)")
+    send.add_argument("--business-hours", metavar="START-END", type=business_hours, default=(9, 17),
+                      help="Local hours follow-ups are scheduled in (default: 9-17)")
+    send.add_argument("--hourly-capacity", type=int, default=0,
+                      help="Max follow-ups booked per hour and account, unless the account has an hourly quota (0 = no cap)")
+    send.add_argument("--holiday", metavar="YYYY-MM-DD", type=holiday, action="append", default=[],
+                      help="Day without follow-ups, like a weekend; repeat for more")
+    send.add_argument("--lead-timezones", action="store_true",
+                      help="Apply business hours in each lead's timezone/time_zone/tz column where present")
+    send.add_argument("--metrics", metavar="FILE", help="Write send metrics at the end: Prometheus text for *.prom, JSON lines otherwise")
+    send.add_argument("--profile", metavar="FILE", help="cProfile the run and dump the stats here")
+    send.add_argument("--verbose", action="store_true", help="Print every lead instead of periodic progress lines")
+    send.add_argument("--progress-interval", type=float, default=5.0, help="Seconds between progress lines")
+    send.set_defaults(func=cmd_send)
+
+    drain = commands.add_parser('drain-queue', help="Send every due follow-up once, like Process Due Emails Now (tab 4)")
+    worker.add_dispatcher_arguments(drain)
+    drain.set_defaults(func=cmd_drain_queue)
+
+    scan = commands.add_parser('scan-inbox', help="Cancel the follow-ups of leads who replied or bounced, from new mail in an IMAP mailbox")
+    scan.add_argument("--email", help="Mailbox account (default: $DRIPMAILER_EMAIL)")
+    scan.add_argument("--host", default=IMAP_HOST)
+    scan.add_argument("--port", type=int, default=IMAP_PORT)
+    scan.add_argument("--no-ssl", action="store_true", help="Plain IMAP instead of IMAPS")
+    scan.add_argument("--mailbox", default="INBOX", help="Folder to scan; run once per folder if bounces are filed elsewhere")
+    scan.add_argument("--db", default=storage.DB_PATH, help="Path to campaigns.db")
+    scan.set_defaults(func=cmd_scan_inbox)
+
+    archive = commands.add_parser('archive', help="Move old sent/failed queue rows to the archive table and shrink the database")
+    archive.add_argument("--days", type=int, default=30, help="Archive emails finished more than this many days ago")
+    archive.add_argument("--batch-size", type=int, default=1000, help="Rows moved per transaction")
+    archive.add_argument("--enable-incremental-vacuum", action="store_true",
+                         help="Databases created before this option existed need one full VACUUM to hand space back")
+    archive.add_argument("--verbose", action="store_true", help="Print progress after every batch")
+    archive.add_argument("--db", default=storage.DB_PATH, help="Path to campaigns.db")
+    archive.set_defaults(func=cmd_archive)
+
+    box = commands.add_parser('outbox', help="Pre-render a campaign's emails into its outbox, or inspect and compare outboxes")
+    box.add_argument("--dir", default=outbox.OUTBOX_DIR, help="Where outboxes are kept")
+    box_actions = box.add_subparsers(dest='action', required=True)
+    build = box_actions.add_parser('build', help="Render the main email and follow-ups of every pending lead of a stored campaign")
+    build.add_argument("campaign")
+    build.add_argument("--out", metavar="PATH", help="Write here instead of the campaign's outbox, e.g. to diff against it")
+    build.add_argument("--workers", type=int, help="Rendering processes (default: one per CPU)")
+    build.add_argument("--db", default=storage.DB_PATH, help="Path to campaigns.db")
+    show = box_actions.add_parser('show', help="Summarize an outbox, or print the emails to one recipient")
+    show.add_argument("target", metavar="CAMPAIGN_ID|PATH")
+    show.add_argument("--email", help="Print the emails to this recipient")
+    show.add_argument("--step", type=int, help="Only this step (0 = the main email)")
+    show.add_argument("--raw", action="store_true", help="With --email, print the bytes as they go on the wire")
+    show.add_argument("--limit", type=int, default=50, help="Emails to list")
+    compare = box_actions.add_parser('diff', help="Show what changed between two outboxes, email by email")
+    compare.add_argument("old", metavar="CAMPAIGN_ID|PATH")
+    compare.add_argument("new", metavar="CAMPAIGN_ID|PATH")
+    delete = box_actions.add_parser('delete', help="Delete a campaign's outbox; its emails are rendered at send time again")
+    delete.add_argument("campaign")
+    box.set_defaults(func=cmd_outbox)
+
+    accounts = commands.add_parser('accounts', help="List, add or remove the sender accounts campaigns can be spread over")
+    accounts.add_argument("--db", default=storage.DB_PATH, help="Path to campaigns.db")
+    actions = accounts.add_subparsers(dest='action')
+    add = actions.add_parser('add', help="Add an account or change its settings (password from $DRIPMAILER_PASSWORD)")
+    add.add_argument("email")
+    add.add_argument("--name", default="", help="Sender display name (default: the campaign's)")
+    add.add_argument("--daily", type=int, default=0, help="Max emails per day (0 = no cap)")
+    add.add_argument("--hourly", type=int, default=0, help="Max emails per hour (0 = no cap)")
+    add.add_argument("--disabled", action="store_true", help="Keep the account but don't send from it")
+    remove = actions.add_parser('remove', help="Delete an account and its usage history")
+    remove.add_argument("email")
+    accounts.set_defaults(func=cmd_accounts)
+
+    suppress = commands.add_parser('suppress', help="List or change the addresses and domains that are never emailed")
+    suppress.add_argument("--db", default=storage.DB_PATH, help="Path to campaigns.db")
+    suppress.add_argument("--search", default="", help="Only list entries containing this text")
+    suppress.add_argument("--limit", type=int, default=50, help="Entries to list, newest first")
+    suppress_actions = suppress.add_subparsers(dest='action')
+    bulk = suppress_actions.add_parser('import', help="Suppress every address/domain in a CSV (email, domain or first column)")
+    bulk.add_argument("file")
+    bulk.add_argument("--reason", default="Unsubscribed", help="Reason for rows without a reason column")
+    bulk.add_argument("--days", type=int, default=0, help="Lift the suppressions after this many days (0 = never)")
+    add = suppress_actions.add_parser('add', help="Suppress addresses or domains (example.com covers its subdomains)")
+    add.add_argument("values", nargs='+')
+    add.add_argument("--reason", default="Added by hand")
+    add.add_argument("--days", type=int, default=0, help="Lift the suppressions after this many days (0 = never)")
+    remove = suppress_actions.add_parser('remove', help="Lift suppressions")
+    remove.add_argument("values", nargs='+')
+    suppress_actions.add_parser('purge', help="Delete expired suppressions")
+    suppress.set_defaults(func=cmd_suppress)
+
+    args = parser.parse_args(argv)
+    if args.command == 'send' and not args.resume and not (args.leads and args.template):
+        send.error("--leads and --template are required unless --resume is given")
+
+    # systemd stops services with SIGTERM; let it unwind like Ctrl+C so claimed leads are settled
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    return args.func(args)
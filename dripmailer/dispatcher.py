@@ -0,0 +1,376 @@
+import json
+import os
+import queue
+import threading
+import time
+
+from dripmailer import storage
+from dripmailer.aiosmtp import AsyncSessions
+from dripmailer.message import MessageFactory
+from dripmailer.metrics import Metrics
+from dripmailer.outbox import Outbox, message_digest, outbox_path
+from dripmailer.signatures import for_account
+from dripmailer.ratelimit import TRANSIENT, LimiterGroup, backoff_delay, classify_error, describe_error, is_throttle, smtp_code
+from dripmailer.smtp_pool import RECONNECT_ERRORS, SMTP_HOST, SMTP_PORT, close_smtp, open_smtp
+from dripmailer.suppression import SuppressionList, hard_bounce
+from dripmailer.templating import compile_template
+
+
+# Seconds before a campaign's outbox is looked for (or checked for a rebuild) again
+OUTBOX_RECHECK = 60
+
+
+def queued_subject(row):
+    if row['template_id'] is None:
+        return row['subject']
+    return compile_template(row['subject_template'] or "").render(json.loads(row['variables']))
+
+
+def render_queued(row):
+    """Subject and plain-text body of a normalized queue row, rendered just-in-time."""
+    body = compile_template(row['body_template'] or "").render(json.loads(row['variables']))
+    return queued_subject(row), body
+
+
+class Dispatcher:
+    """Sends claimed scheduled_emails rows, keeping one logged-in session per sender account.
+
+    Sessions outlive a single batch so a long-running worker does not log in again for
+    every poll; sessions idle for longer than `idle_timeout` seconds are reopened.
+
+    The accounts in a batch are sent from concurrently, one thread each. Sends are paced
+    per sender account and per recipient domain, slowing down when the relay throttles.
+    Rows beyond what an account's daily/hourly quota allows are deferred until it resets.
+    Temporary failures are put back in the queue with jittered exponential backoff until
+    a row has had `max_attempts` tries; permanent ones fail at once.
+    Stage timings and errors by reply code are recorded in `metrics`.
+
+    Rows to suppressed addresses or domains are marked 'suppressed' instead of sent, and
+    recipients the relay refuses for good are added to the list. Without `suppressions`
+    the list is loaded from the database on the first batch and reloaded every few minutes.
+
+    With `async_smtp`, sessions come from an AsyncSessions (pipelined sends, NOOP keep-alive)
+    instead of smtplib. Pass `sessions` to share one that outlives this dispatcher.
+
+    With `outbox_dir`, follow-ups of campaigns that have an outbox there go out as spooled
+    while their queue row still matches what was rendered (see dripmailer.outbox).
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, use_ssl=True, rate_per_account=2.0, idle_timeout=120,
+                 domain_rate=0, max_attempts=5, backoff_base=60.0, backoff_cap=3600.0, metrics=None,
+                 async_smtp=False, sessions=None, suppressions=None, outbox_dir=None):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.idle_timeout = idle_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.metrics = metrics or Metrics()
+        self._sessions = {}
+        self._accounts = LimiterGroup(rate_per_account)
+        self._domains = LimiterGroup(domain_rate)
+        self._factories = {}
+        self.suppressions = suppressions
+        self.outbox_dir = outbox_dir
+        # campaign_id -> (checked at, index mtime, Outbox or None)
+        self._outboxes = {}
+        self._outbox_lock = threading.Lock()
+        self._own_sessions = async_smtp and sessions is None
+        self.sessions = AsyncSessions(host, port, use_ssl) if self._own_sessions else sessions
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for server, _ in self._sessions.values():
+            close_smtp(server)
+        self._sessions = {}
+        for _, _, outbox in self._outboxes.values():
+            if outbox is not None:
+                outbox.close()
+        self._outboxes = {}
+        if self._own_sessions:
+            self.sessions.close()
+
+    def _session(self, email, password):
+        if self.sessions is not None:
+            return self.sessions.session(email, password, self.metrics)
+        entry = self._sessions.get(email)
+        if entry is not None:
+            server, last_used = entry
+            if time.monotonic() - last_used < self.idle_timeout:
+                return server
+            close_smtp(server)
+            del self._sessions[email]
+        with self.metrics.time('smtp_login'):
+            server = open_smtp(email, password, self.host, self.port, self.use_ssl)
+        self._sessions[email] = (server, time.monotonic())
+        return server
+
+    def _drop(self, email):
+        if self.sessions is not None:
+            self.sessions.drop(email)
+            return
+        entry = self._sessions.pop(email, None)
+        if entry is not None:
+            close_smtp(entry[0])
+
+    def _factory(self, row):
+        # One factory per sender/signature, so a campaign's shared parts are encoded once
+        signature = for_account(row['signature_html'] or "", row['campaign_sender_email'], row['sender_email'])
+        key = (row['sender_name'], row['sender_email'], signature)
+        factory = self._factories.get(key)
+        if factory is None:
+            factory = self._factories.setdefault(key, MessageFactory(*key))
+        return factory
+
+    def _outbox(self, campaign_id):
+        """The campaign's outbox, reopened after a rebuild, or None without one."""
+        path = outbox_path(campaign_id, self.outbox_dir)
+        with self._outbox_lock:
+            cached = self._outboxes.get(campaign_id)
+            now = time.monotonic()
+            if cached is not None and now - cached[0] < OUTBOX_RECHECK:
+                return cached[2]
+            try:
+                mtime = os.stat(path + '.idx').st_mtime_ns
+            except OSError:
+                mtime = None
+            outbox = cached[2] if cached is not None and cached[1] == mtime else None
+            if outbox is None and mtime is not None:
+                # A replaced outbox is left to the garbage collector, as a sending thread may still be reading it
+                try:
+                    outbox = Outbox(path)
+                except (OSError, ValueError):
+                    mtime = None
+            self._outboxes[campaign_id] = (now, mtime, outbox)
+            return outbox
+
+    def _spooled(self, row, factory):
+        outbox = self._outbox(row['campaign_id']) if row['campaign_id'] else None
+        entry = outbox.get(row['target_email'], row['step']) if outbox is not None else None
+        if entry is None or entry.sender != row['sender_email']:
+            return None
+        signature = for_account(row['signature_html'] or "", row['campaign_sender_email'], row['sender_email'])
+        digest = message_digest(factory.from_name, row['sender_email'], signature, row['subject_template'], row['body_template'], row['variables'])
+        hit = entry.digest == digest
+        self.metrics.count('outbox_messages_total', result='hit' if hit else 'stale')
+        if not hit:
+            return None
+        with self.metrics.time('outbox_read'):
+            return outbox.envelope(entry)
+
+    def build_envelope(self, row):
+        factory = self._factory(row)
+        if row['template_id'] is None:
+            # Rows queued before templates were stored carry their own rendered subject and HTML
+            with self.metrics.time('mime_build'):
+                return factory.build_html(row['target_email'], row['subject'], row['html_body'])
+        if self.outbox_dir is not None:
+            envelope = self._spooled(row, factory)
+            if envelope is not None:
+                return envelope
+        with self.metrics.time('render'):
+            subject, body = render_queued(row)
+        with self.metrics.time('mime_build'):
+            return factory.build(row['target_email'], subject, body)
+
+    def send_row(self, row):
+        """Sends one row and returns the Message-ID it went out with."""
+        email = row['sender_email']
+        envelope = self.build_envelope(row)
+        # A reused session may have been dropped by the server since the last batch
+        for attempt in range(2):
+            server = self._session(email, row['sender_password'])
+            try:
+                with self.metrics.time('smtp_send'):
+                    server.sendmail(envelope.sender, [envelope.recipient], envelope.data)
+                if self.sessions is None:
+                    self._sessions[email] = (server, time.monotonic())
+                return envelope.message_id
+            except RECONNECT_ERRORS:
+                self._drop(email)
+                if attempt:
+                    raise
+
+    def dispatch(self, conn, rows, on_event=None):
+        """Sends claimed rows, all sender accounts at once, and records each outcome.
+
+        Each account's rows are sent in order on a thread of their own; the outcomes come
+        back to the calling thread, which does every database write and on_event call.
+        Returns the sender accounts that could not log in; their rows go back to 'pending'.
+        """
+        emit = on_event or (lambda *args: None)
+        if self.suppressions is None:
+            self.suppressions = SuppressionList.load(conn)
+        else:
+            self.suppressions.refresh(conn)
+        accounts = {}
+        suppressed = []
+        for row in rows:
+            reason = self.suppressions.reason(row['target_email'])
+            if reason:
+                suppressed.append((row, reason))
+            else:
+                accounts.setdefault(row['sender_email'], []).append(row)
+        if suppressed:
+            storage.suppress_queued(conn, [(row['id'], reason) for row, reason in suppressed])
+            for row, reason in suppressed:
+                emit('suppressed', row, reason)
+
+        now = storage.now_ts()
+        reserved = {}
+        for sender_email, account_rows in list(accounts.items()):
+            granted = storage.reserve_sends(conn, sender_email, len(account_rows), now)
+            if granted is None:
+                continue
+            reserved[sender_email] = granted
+            if granted < len(account_rows):
+                resets_at = storage.quota_resets_at(conn, sender_email, now)
+                later = account_rows[granted:]
+                storage.defer(conn, [r['id'] for r in later], resets_at)
+                emit('deferred', sender_email, (len(later), resets_at))
+                accounts[sender_email] = account_rows[:granted]
+            if not accounts[sender_email]:
+                del accounts[sender_email]
+
+        results = queue.Queue()
+        stop = threading.Event()
+        threads = [
+            threading.Thread(target=self._send_account, args=(email, account_rows, results, stop), name=f"dispatch-{email}", daemon=True)
+            for email, account_rows in accounts.items()
+        ]
+        for t in threads:
+            t.start()
+
+        failed_logins = set()
+        unsent = {email: 0 for email in reserved}
+        done = set()
+
+        def record(kind, subject, detail, emit):
+            if kind == 'login_failed':
+                failed_logins.add(subject)
+                account_rows = accounts[subject]
+                storage.release(conn, [r['id'] for r in account_rows])
+                done.update(r['id'] for r in account_rows)
+                if subject in unsent:
+                    unsent[subject] += len(account_rows)
+                emit(kind, subject, detail)
+            elif kind == 'sent':
+                done.add(subject['id'])
+                with self.metrics.time('db_write'):
+                    storage.set_status(conn, subject['id'], 'sent', message_id=detail)
+                emit('sent', subject, None)
+            elif kind == 'error':
+                done.add(subject['id'])
+                if subject['sender_email'] in unsent:
+                    unsent[subject['sender_email']] += 1
+                self._record_failure(conn, subject, detail, emit)
+            else:
+                emit(kind, subject, detail)
+
+        finished = 0
+        try:
+            while finished < len(threads):
+                kind, subject, detail = results.get()
+                if kind == 'done':
+                    finished += 1
+                else:
+                    record(kind, subject, detail, emit)
+        finally:
+            if finished < len(threads):
+                # Interrupted: stop the senders, keep what already went out, hand the rest back
+                stop.set()
+                for t in threads:
+                    t.join()
+                while True:
+                    try:
+                        kind, subject, detail = results.get_nowait()
+                    except queue.Empty:
+                        break
+                    if kind != 'done':
+                        record(kind, subject, detail, lambda *args: None)
+                left = [r for account_rows in accounts.values() for r in account_rows if r['id'] not in done]
+                storage.release(conn, [r['id'] for r in left])
+                for r in left:
+                    if r['sender_email'] in unsent:
+                        unsent[r['sender_email']] += 1
+            for email, count in unsent.items():
+                storage.release_sends(conn, email, count, storage.hour_start(now))
+        return failed_logins
+
+    def _send_account(self, sender_email, rows, results, stop):
+        """Runs on its own thread: sends one account's rows and reports back through `results`."""
+        try:
+            results.put(('login', sender_email, None))
+            try:
+                self._session(sender_email, rows[0]['sender_password'])
+            except Exception as e:
+                results.put(('login_failed', sender_email, e))
+                return
+
+            account = self._accounts.get(sender_email)
+            for row in rows:
+                if stop.is_set():
+                    return
+                results.put(('sending', row, None))
+                domain = self._domains.get(row['target_email'].rsplit("@", 1)[-1])
+                account.acquire()
+                domain.acquire()
+                started = time.perf_counter()
+                try:
+                    message_id = self.send_row(row)
+                except Exception as e:
+                    self.metrics.observe('message', time.perf_counter() - started)
+                    self.metrics.message_done(False)
+                    self._throttled(row, e, account, domain)
+                    results.put(('error', row, e))
+                    continue
+                self.metrics.observe('message', time.perf_counter() - started)
+                self.metrics.message_done(True)
+                account.speed_up()
+                domain.speed_up()
+                results.put(('sent', row, message_id))
+        finally:
+            results.put(('done', sender_email, None))
+
+    def _throttled(self, row, error, account, domain):
+        # On the account's own thread, so the next send from it is already slowed down
+        self.metrics.count('smtp_errors_total', code=smtp_code(error) or type(error).__name__)
+        if is_throttle(error):
+            account.slow_down()
+            domain.slow_down()
+        if classify_error(error)[1] == 421:
+            self._drop(row['sender_email'])
+
+    def _record_failure(self, conn, row, error, emit):
+        kind, _ = classify_error(error)
+        bounce = hard_bounce(error)
+        if bounce:
+            self.suppressions.add(conn, [row['target_email']], bounce, source='bounce')
+        if kind == TRANSIENT and row['attempts'] + 1 < self.max_attempts:
+            retry_at = storage.now_ts(backoff_delay(row['attempts'], self.backoff_base, self.backoff_cap))
+            with self.metrics.time('db_write'):
+                storage.reschedule(conn, row['id'], retry_at, describe_error(error))
+            emit('retry', row, error)
+        else:
+            with self.metrics.time('db_write'):
+                storage.set_status(conn, row['id'], 'failed', describe_error(error))
+            emit('failed', row, error)
+
+    def drain(self, conn, batch_size=50, lease_seconds=300, on_event=None):
+        """Claims and sends due rows in small batches until none are left. Returns the number handled."""
+        handled = 0
+        skip = set()
+        while True:
+            with self.metrics.time('db_claim'):
+                rows = storage.claim_due(conn, batch_size, lease_seconds, skip_senders=skip)
+            if not rows:
+                return handled
+            failed_logins = self.dispatch(conn, rows, on_event)
+            handled += sum(1 for r in rows if r['sender_email'] not in failed_logins)
+            skip |= failed_logins
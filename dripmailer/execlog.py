@@ -0,0 +1,59 @@
+import csv
+import time
+
+from dripmailer.ratelimit import describe_error
+
+HEADER = ["Timestamp", "First Name", "Last Name", "Email Address", "Action", "Details"]
+
+
+def new_log_path(campaign_id):
+    """campaign_log_<time>_<campaign>.csv in the working directory; the campaign part keeps runs started in the same second apart."""
+    return f"campaign_log_{time.strftime('%Y%m%d_%H%M%S')}_{campaign_id[:8]}.csv"
+
+
+class ExecutionLog:
+    """Writes the campaign log CSV: the template configuration, then one row per CampaignRunner event.
+
+    Each row is flushed as it is written, so a log file is complete up to the moment a run stops.
+    """
+
+    def __init__(self, fileobj):
+        self.file = fileobj
+        self.writer = csv.writer(fileobj)
+
+    def write_config(self, templates):
+        self.writer.writerow(["--- CAMPAIGN CONFIGURATION ---"])
+        self.writer.writerow(["Type", "Template Name", "Subject", "Body/Details"])
+        for t in templates:
+            if t['step'] == 0:
+                self.writer.writerow(["Main Email", "Original", t['subject'], t['body']])
+            else:
+                self.writer.writerow(["Follow-up", t['name'], t['subject'], f"T+{t['delay_days']} Days | Body: {t['body']}"])
+        self.writer.writerow([])
+        self.writer.writerow(["--- EXECUTION LOG ---"])
+        self.writer.writerow(HEADER)
+        self.file.flush()
+
+    def row(self, lead, action, details):
+        lead = lead or {}
+        self.writer.writerow([time.strftime('%Y-%m-%d %H:%M:%S'), lead.get('first_name', ''), lead.get('last_name', ''),
+                              lead.get('email', ''), action, details])
+        self.file.flush()
+
+    def on_event(self, event, subject, detail):
+        if event == 'unconfirmed':
+            self.row(None, "Unconfirmed Leads", f"{subject} leads, {'resent' if detail else 'skipped'}")
+        elif event == 'quota_exhausted':
+            resumes = f", quotas reset {detail:%Y-%m-%d %H:%M:%S}" if detail else ""
+            self.row(None, "Quota Exhausted", f"{subject} leads left for a later run{resumes}")
+        elif event == 'suppressed':
+            self.row(None, "Suppressed Leads", f"{subject} leads on the suppression list or already emailed, not sent")
+        elif event == 'cancelled' and subject:
+            self.row(None, "Cancelled Follow-ups", f"{subject} follow-ups of leads whose main email was not sent")
+        elif event == 'scheduled':
+            tmpl_name, send_at_time = detail
+            self.row(subject, "Scheduled Follow-up", f"{tmpl_name} at {send_at_time:%Y-%m-%d %H:%M:%S}")
+        elif event == 'sent':
+            self.row(subject, "Sent Main Email", "Success")
+        elif event == 'failed':
+            self.row(subject, "Sent Main Email", f"Failed: {describe_error(detail)}")
@@ -0,0 +1,165 @@
+"""Reads new replies and bounces from an IMAP mailbox and stops the follow-ups of those leads."""
+import datetime
+import imaplib
+import re
+import ssl
+
+from dripmailer import storage
+from dripmailer.suppression import SuppressionList
+
+IMAP_HOST = "mail.streamax.com"
+IMAP_PORT = 993
+
+# Messages fetched per round trip; the checkpoint moves forward after each batch
+FETCH_BATCH = 100
+# Enough of each message for its headers and, in a bounce, the returned original's headers
+PEEK_BYTES = 65536
+# How far back the first scan of a mailbox (or one whose UIDVALIDITY changed) looks
+FIRST_SCAN_DAYS = 30
+
+_HEADER_END = re.compile(rb'\r?\n\r?\n')
+_MESSAGE_IDS = re.compile(rb'<[^<>\s]+@[^<>\s]+>')
+_ORIGINAL_MESSAGE_ID = re.compile(rb'^Message-ID:[ \t]*(?:\r?\n[ \t]+)?(<[^<>\s]+@[^<>\s]+>)', re.I | re.M)
+_FETCH_UID = re.compile(rb'UID (\d+)')
+_BOUNCE_SENDER = re.compile(rb'^From:.*\b(mailer-daemon|postmaster)\b', re.I | re.M)
+_DSN = re.compile(rb'^Content-Type:[ \t]*multipart/report;(?:.|\r?\n[ \t])*?report-type="?delivery-status', re.I | re.M)
+_AUTO_REPLY = re.compile(rb'^(Auto-Submitted:[ \t]*auto-replied|X-Autoreply:|X-Autorespond:|Precedence:[ \t]*auto_reply)', re.I | re.M)
+
+
+def _header(headers, name):
+    """A header's value with folded lines joined, or b'' (the first one if repeated)."""
+    match = re.search(rb'^' + name + rb':[ \t]*((?:.*)(?:\r?\n[ \t].*)*)', headers, re.I | re.M)
+    return match.group(1) if match else b''
+
+
+def classify(raw):
+    """('bounced' | 'replied' | None, Message-IDs it refers to) for the start of a raw message.
+
+    A bounce (a delivery-status report or mail from MAILER-DAEMON/postmaster) refers to the
+    Message-ID of the returned original in its body; reports that only say delivery is
+    delayed are ignored. A reply refers to its In-Reply-To and References headers.
+    Out-of-office and other auto-replies don't count as replies.
+    """
+    split = _HEADER_END.search(raw)
+    headers, body = (raw[:split.start()], raw[split.end():]) if split else (raw, b'')
+    if _DSN.search(headers) or _BOUNCE_SENDER.search(headers):
+        if re.search(rb'^Action:[ \t]*delayed', body, re.I | re.M) and not re.search(rb'^Action:[ \t]*failed', body, re.I | re.M):
+            return None, []
+        return 'bounced', [m.decode('ascii', 'replace') for m in _ORIGINAL_MESSAGE_ID.findall(body)]
+    if _AUTO_REPLY.search(headers):
+        return None, []
+    refs = _MESSAGE_IDS.findall(_header(headers, rb'In-Reply-To') + b' ' + _header(headers, rb'References'))
+    return ('replied' if refs else None), [m.decode('ascii', 'replace') for m in refs]
+
+
+class InboxScanner:
+    """Scans one IMAP mailbox for messages that arrived since the last scan.
+
+    Only UIDs above the checkpoint stored in campaigns.db are fetched, read-only and without
+    setting the \\Seen flag. If the server reports a new UIDVALIDITY (the mailbox was
+    rebuilt) the UIDs mean nothing anymore and the scan falls back to the messages of the
+    last few days; matching again is harmless, as only pending follow-ups are cancelled.
+
+    Matched leads are marked 'replied' or 'bounced' and their pending follow-ups cancelled.
+    Bounced addresses are also added to the suppression list.
+    """
+
+    def __init__(self, username, password, host=IMAP_HOST, port=IMAP_PORT, use_ssl=True, mailbox='INBOX', timeout=30):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.mailbox = mailbox
+        self.timeout = timeout
+
+    @property
+    def checkpoint_key(self):
+        return f"{self.username}@{self.host}/{self.mailbox}"
+
+    def _connect(self):
+        if self.use_ssl:
+            imap = imaplib.IMAP4_SSL(self.host, self.port, ssl_context=ssl.create_default_context(), timeout=self.timeout)
+        else:
+            imap = imaplib.IMAP4(self.host, self.port, timeout=self.timeout)
+        try:
+            imap.login(self.username, self.password)
+            typ, data = imap.select(self.mailbox, readonly=True)
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"Cannot open mailbox {self.mailbox}: {data[0].decode(errors='replace')}")
+        except Exception:
+            imap.shutdown()
+            raise
+        return imap
+
+    def _new_uids(self, imap, conn):
+        _, data = imap.response('UIDVALIDITY')
+        uidvalidity = int(data[0])
+        checkpoint = storage.get_mailbox_checkpoint(conn, self.checkpoint_key)
+        if checkpoint is not None and checkpoint['uidvalidity'] == uidvalidity:
+            last_uid = checkpoint['last_uid']
+            _, data = imap.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+        else:
+            last_uid = 0
+            since = datetime.date.today() - datetime.timedelta(days=FIRST_SCAN_DAYS)
+            _, data = imap.uid('SEARCH', None, 'SINCE', since.strftime('%d-%b-%Y'))
+        # "n:*" always matches the newest message, even when it is not above n
+        uids = sorted(uid for uid in map(int, data[0].split()) if uid > last_uid)
+        return uidvalidity, uids
+
+    def _fetch(self, imap, uids):
+        """Yields (uid, raw message start) for a batch of UIDs."""
+        _, data = imap.uid('FETCH', ','.join(map(str, uids)), f'(UID BODY.PEEK[]<0.{PEEK_BYTES}>)')
+        for item in data:
+            if isinstance(item, tuple):
+                match = _FETCH_UID.search(item[0])
+                if match:
+                    yield int(match.group(1)), item[1]
+
+    def scan(self, conn, on_batch=None):
+        """Reads every new message and returns {'messages', 'replied', 'bounced', 'cancelled'} counts.
+
+        on_batch(counts so far, messages left) is called after each batch.
+        """
+        counts = {'messages': 0, 'replied': 0, 'bounced': 0, 'cancelled': 0}
+        imap = self._connect()
+        try:
+            uidvalidity, uids = self._new_uids(imap, conn)
+            for start in range(0, len(uids), FETCH_BATCH):
+                batch = uids[start:start + FETCH_BATCH]
+                self._process(conn, self._fetch(imap, batch), counts)
+                storage.save_mailbox_checkpoint(conn, self.checkpoint_key, uidvalidity, batch[-1])
+                conn.commit()
+                if on_batch:
+                    on_batch(counts, len(uids) - start - len(batch))
+            if not uids:
+                # Keeps the UIDVALIDITY current so the next scan doesn't look back again
+                checkpoint = storage.get_mailbox_checkpoint(conn, self.checkpoint_key)
+                if checkpoint is None or checkpoint['uidvalidity'] != uidvalidity:
+                    storage.save_mailbox_checkpoint(conn, self.checkpoint_key, uidvalidity, 0)
+                    conn.commit()
+        finally:
+            try:
+                imap.logout()
+            except (OSError, imaplib.IMAP4.error):
+                pass
+        return counts
+
+    def _process(self, conn, messages, counts):
+        refs = {'replied': set(), 'bounced': set()}
+        for _, raw in messages:
+            counts['messages'] += 1
+            kind, message_ids = classify(raw)
+            if kind:
+                refs[kind].update(message_ids)
+        bounced = []
+        for kind in ('replied', 'bounced'):
+            matched = set(storage.sent_by_message_ids(conn, refs[kind]).values()) if refs[kind] else set()
+            if matched:
+                counts[kind] += len(matched)
+                counts['cancelled'] += storage.record_responses(conn, matched, kind)
+                if kind == 'bounced':
+                    bounced = [email for _, email in matched]
+        if bounced:
+            # Commits the batch's updates along with the suppressions
+            SuppressionList().add(conn, bounced, "Bounced (delivery status report)", source='dsn')
@@ -0,0 +1,86 @@
+import re
+
+import pandas as pd
+
+from dripmailer import storage
+
+REQUIRED_COLUMNS = ['first_name', 'last_name', 'email', 'role', 'company']
+
+# Deliberately loose: one @, no whitespace, and a dot in the domain
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s.]+$')
+
+
+def normalize_columns(df):
+    df.columns = [str(c).lower().strip() for c in df.columns]
+    return df
+
+
+def missing_columns(columns):
+    return [r for r in REQUIRED_COLUMNS if r not in columns]
+
+
+def prepare_leads(df):
+    """Cleans a lead DataFrame in one vectorized pass before anything is sent.
+
+    Every cell becomes a stripped string (NaN -> ""), emails are lowercased, and rows
+    with a missing/invalid or repeated email are dropped. Returns (records, rejected):
+    a list of plain dicts ready for the sender, and a DataFrame of the dropped rows with
+    their 1-based CSV row number and the reason.
+    """
+    clean = df.astype(object).where(df.notna(), "").astype(str).apply(lambda col: col.str.strip())
+    clean['email'] = clean['email'].str.lower()
+
+    reason = pd.Series("", index=clean.index)
+    empty = clean['email'] == ""
+    invalid = ~empty & ~clean['email'].str.match(EMAIL_PATTERN)
+    duplicate = ~empty & ~invalid & clean['email'].duplicated(keep='first')
+    reason[empty] = "Missing email"
+    reason[invalid] = "Invalid email"
+    reason[duplicate] = "Duplicate email"
+
+    bad = reason != ""
+    rejected = clean[bad].copy()
+    rejected.insert(0, 'row', clean.index[bad.to_numpy()] + 1)
+    rejected['reason'] = reason[bad]
+    records = clean[~bad].to_dict('records')
+    return records, rejected.reset_index(drop=True)
+
+
+# --- STREAMING INGEST ---
+# Large uploads are read a chunk at a time and spooled into the leads table, so the
+# preview and the sender work from a cursor instead of a full in-memory DataFrame.
+
+CHUNK_ROWS = 5000
+
+
+def read_columns(fileobj):
+    """Normalized column names from the CSV header alone; rewinds the file afterwards."""
+    columns = normalize_columns(pd.read_csv(fileobj, nrows=0)).columns
+    fileobj.seek(0)
+    return list(columns)
+
+
+def spool_csv(conn, fileobj, campaign_id, chunksize=CHUNK_ROWS):
+    """Cleans the CSV chunk by chunk into the leads/lead_rejects tables.
+
+    Duplicates are caught across chunks through the (campaign_id, email) unique index.
+    Returns (valid_count, rejected_count).
+    """
+    valid = rejected_total = 0
+    # dtype=str keeps values as written (e.g. leading zeros) and stable across chunks
+    for chunk in pd.read_csv(fileobj, chunksize=chunksize, dtype=str):
+        records, rejected = prepare_leads(normalize_columns(chunk))
+        kept_rows = chunk.index.difference(rejected['row'] - 1) + 1
+        rejects = [(r.pop('row'), r['email'], r.pop('reason'), r) for r in rejected.to_dict('records')]
+
+        seen = storage.existing_lead_emails(conn, campaign_id, [r['email'] for r in records])
+        if seen:
+            rejects += [(int(row), r['email'], "Duplicate email", r) for row, r in zip(kept_rows, records) if r['email'] in seen]
+            records = [r for r in records if r['email'] not in seen]
+
+        storage.insert_leads(conn, campaign_id, records)
+        storage.insert_rejects(conn, campaign_id, rejects)
+        conn.commit()
+        valid += len(records)
+        rejected_total += len(rejects)
+    return valid, rejected_total
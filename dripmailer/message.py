@@ -0,0 +1,121 @@
+import collections
+import itertools
+import os
+import re
+import secrets
+import time
+from email import quoprimime
+from email.header import Header
+from email.utils import formataddr, formatdate
+from html.parser import HTMLParser
+
+# What a sender needs to put a message on the wire: envelope addresses plus the
+# finished RFC 5322 bytes for smtplib's sendmail()
+Envelope = collections.namedtuple('Envelope', 'sender recipient data message_id')
+
+CRLF = '\r\n'
+
+
+class _TextExtractor(HTMLParser):
+    BLOCK_TAGS = {'br', 'p', 'div', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.BLOCK_TAGS and tag != 'br':
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        self.parts.append(data)
+
+
+def html_to_text(markup):
+    """Rough plain-text rendering of an HTML fragment for the text/plain alternative."""
+    parser = _TextExtractor()
+    parser.feed(markup)
+    parser.close()
+    lines = [re.sub(r'[ \t]+', ' ', line).strip() for line in ''.join(parser.parts).split('\n')]
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+
+def _qp(text):
+    # Same transformation email.charset applies for utf-8 quoted-printable bodies
+    return quoprimime.body_encode(text.encode('utf-8').decode('latin-1'), maxlinelen=76, eol=CRLF)
+
+
+def _qp_join(head, tail):
+    """Concatenates two quoted-printable chunks so they decode to the concatenated text."""
+    if not head or head.endswith(CRLF):
+        return head + tail
+    return head + '=' + CRLF + tail
+
+
+def _header(name, value):
+    value = ' '.join(str(value).splitlines())
+    charset = 'us-ascii' if value.isascii() else 'utf-8'
+    # header_name makes the first folded line leave room for "Name: "
+    return f"{name}: {Header(value, charset, header_name=name).encode(linesep=CRLF)}"
+
+
+class MessageFactory:
+    """Builds multipart/alternative messages for one sender and signature.
+
+    Everything that is the same for every message of a campaign is worked out once: the
+    From header, the quoted-printable HTML and plain-text signature fragments and the
+    MIME boundary. build() then only encodes the per-recipient part and returns wire-ready
+    bytes for smtplib's sendmail(), skipping the email package's generator.
+    """
+
+    def __init__(self, from_name, from_email, signature_html=""):
+        self.from_name = from_name
+        self.from_email = from_email
+        self.domain = from_email.split("@")[-1]
+        self._from_header = formataddr((from_name, from_email), charset='utf-8')
+        self._boundary = f"=_dripmailer_{secrets.token_hex(12)}"
+        self._msgid_prefix = f"{os.getpid()}.{secrets.token_hex(6)}"
+        self._msgid_counter = itertools.count()
+
+        self._html_signature = _qp(f"<br><br>{signature_html}")
+        signature_text = html_to_text(signature_html) if signature_html else ""
+        self._text_signature = _qp(f"\n\n{signature_text}") if signature_text else ""
+
+        part_headers = 'Content-Type: text/{}; charset="utf-8"' + CRLF + 'Content-Transfer-Encoding: quoted-printable' + CRLF + CRLF
+        self._text_open = f"--{self._boundary}{CRLF}" + part_headers.format('plain')
+        self._html_open = f"{CRLF}--{self._boundary}{CRLF}" + part_headers.format('html')
+        self._close = f"{CRLF}--{self._boundary}--{CRLF}"
+        self._mime_headers = (
+            f"MIME-Version: 1.0{CRLF}"
+            f'Content-Type: multipart/alternative;{CRLF} boundary="{self._boundary}"{CRLF}{CRLF}'
+        )
+
+    def make_msgid(self):
+        # Unique per process and factory without make_msgid's per-call hostname/random work
+        return f"<{time.time_ns()}.{self._msgid_prefix}.{next(self._msgid_counter)}@{self.domain}>"
+
+    def _assemble(self, to_addr, subject, text_qp, html_qp):
+        message_id = self.make_msgid()
+        head = (
+            f"From: {self._from_header}{CRLF}"
+            f"{_header('To', to_addr)}{CRLF}"
+            f"{_header('Subject', subject)}{CRLF}"
+            f"Date: {formatdate(localtime=True)}{CRLF}"
+            f"Message-ID: {message_id}{CRLF}"
+        )
+        data = ''.join((head, self._mime_headers, self._text_open, text_qp, self._html_open, html_qp, self._close))
+        return Envelope(self.from_email, to_addr, data.encode('ascii'), message_id)
+
+    def build(self, to_addr, subject, body_text):
+        """Message for a rendered plain-text body; the signature is appended to both parts."""
+        text_qp = _qp_join(_qp(body_text), self._text_signature)
+        html_qp = _qp_join(_qp(body_text.replace('\n', '<br>')), self._html_signature)
+        return self._assemble(to_addr, subject, text_qp, html_qp)
+
+    def build_html(self, to_addr, subject, html_body):
+        """Message for an already-rendered HTML body (queue rows written before templates were stored)."""
+        return self._assemble(to_addr, subject, _qp(html_to_text(html_body)), _qp(html_body))
@@ -0,0 +1,179 @@
+import bisect
+import collections
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+# Upper bounds in seconds, Prometheus-style; the last bucket is +Inf
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Send-path stages, in the order the panel and exports list them
+STAGES = ('db_claim', 'render', 'mime_build', 'outbox_read', 'smtp_login', 'smtp_send', 'db_write', 'message')
+
+
+class Histogram:
+    """Fixed-bucket latency histogram; quantiles are interpolated within a bucket."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / n)
+            seen += n
+        return self.max
+
+
+class Metrics:
+    """Thread-safe stage timers, counters and throughput for one batch send or queue drain.
+
+    The pool's worker threads and the sending thread all record into the same instance;
+    snapshot() gives a consistent copy for the UI and the exporters.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = collections.Counter()
+        # Completion times of recent messages, for the current (not average) send rate
+        self._recent = collections.deque(maxlen=5000)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def message_done(self, sent):
+        with self._lock:
+            self._recent.append(time.monotonic())
+            self._counters[('messages_total', (('result', 'sent' if sent else 'failed'),))] += 1
+
+    def current_rate(self, window=30.0):
+        with self._lock:
+            now = time.monotonic()
+            recent = [t for t in self._recent if now - t <= window]
+        if len(recent) < 2:
+            return 0.0
+        return (len(recent) - 1) / max(now - recent[0], 1e-9)
+
+    def snapshot(self):
+        current_rate = self.current_rate()
+        with self._lock:
+            elapsed = time.time() - self.started
+            stages = {}
+            for name in sorted(self._stages, key=lambda s: (STAGES.index(s) if s in STAGES else len(STAGES), s)):
+                h = self._stages[name]
+                stages[name] = {
+                    'count': h.count,
+                    'total_s': round(h.sum, 6),
+                    'mean_ms': round(1000 * h.sum / h.count, 3) if h.count else 0.0,
+                    'p50_ms': round(1000 * h.quantile(0.5), 3),
+                    'p99_ms': round(1000 * h.quantile(0.99), 3),
+                    'max_ms': round(1000 * h.max, 3),
+                }
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            finished = sum(v for (name, _), v in self._counters.items() if name == 'messages_total')
+        return {
+            'timestamp': round(time.time(), 3),
+            'elapsed_s': round(elapsed, 3),
+            'messages': finished,
+            'msgs_per_sec': round(finished / elapsed, 3) if elapsed > 0 else 0.0,
+            'current_msgs_per_sec': round(current_rate, 3),
+            'stages': stages,
+            'counters': counters,
+        }
+
+    def to_prometheus(self, prefix='dripmailer'):
+        lines = []
+        with self._lock:
+            lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+            for name, h in sorted(self._stages.items()):
+                cumulative = 0
+                for bound, n in zip([*map(str, h.buckets), "+Inf"], h.counts):
+                    cumulative += n
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {h.sum:.6f}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {h.count}')
+            names = sorted({name for name, _ in self._counters})
+            for counter in names:
+                lines.append(f"# TYPE {prefix}_{counter} counter")
+                for (name, labels), value in sorted(self._counters.items()):
+                    if name == counter:
+                        label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                        lines.append(f"{prefix}_{name}{{{label_text}}} {value}" if label_text else f"{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """Writes Prometheus text to a .prom file (replaced atomically) or appends a JSON line to anything else."""
+        if path.endswith('.prom'):
+            tmp = f"{path}.tmp"
+            with open(tmp, 'w') as f:
+                f.write(self.to_prometheus())
+            os.replace(tmp, path)
+        else:
+            with open(path, 'a') as f:
+                f.write(json.dumps(self.snapshot()) + "\n")
+
+
+@contextlib.contextmanager
+def profiled(path=None):
+    """cProfile the calling thread for the duration of the block, dumping stats to `path` if given.
+
+    Only the thread that enters the block is profiled; SMTP pool threads show up as time
+    spent waiting on their results.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path:
+            profiler.dump_stats(path)
+
+
+def profile_summary(profiler, limit=25, sort='cumulative'):
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats(sort).print_stats(limit)
+    return out.getvalue()
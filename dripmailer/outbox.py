@@ -0,0 +1,332 @@
+"""An outbound spool: every email of a campaign rendered ahead of the send, by a process pool.
+
+An outbox is two files, `<campaign>.outbox` holding the wire-ready messages back to back and
+`<campaign>.outbox.idx` with one JSON line per message (recipient, step, sender account,
+Message-ID, offset, length). The data file is read through mmap, so a send only slices out
+bytes that were built before it started, and the same files can be inspected or diffed
+before anything goes out:
+
+    python -m dripmailer outbox build CAMPAIGN_ID
+    python -m dripmailer outbox show CAMPAIGN_ID --email someone@example.com
+    python -m dripmailer send --resume CAMPAIGN_ID --outbox
+
+Each message also records a digest of everything it was rendered from (sender, signature,
+templates, lead variables). A send only uses a spooled message while the lead or queue row
+it stands for still has the same digest; anything edited since is rendered afresh.
+"""
+import collections
+import concurrent.futures
+import difflib
+import json
+import mmap
+import multiprocessing
+import os
+import secrets
+from email import message_from_bytes, policy
+from email.utils import formatdate
+
+from dripmailer import storage
+from dripmailer.message import Envelope, MessageFactory
+from dripmailer.preview import content_hash
+from dripmailer.signatures import for_account
+from dripmailer.suppression import SuppressionList
+from dripmailer.templating import compile_template
+
+OUTBOX_DIR = 'outbox'
+
+# Leads rendered per task handed to a worker process
+CHUNK_SIZE = 200
+
+# The Date header is stamped again at send time; formatdate() is always this long
+DATE_LENGTH = len("Sun, 18 Oct 2026 14:04:52 +0000")
+
+_MAGIC = b'DRIPMAILER-OUTBOX 1 '
+
+Entry = collections.namedtuple('Entry', 'email step sender message_id offset length date_at digest')
+
+
+def outbox_path(campaign_id, directory=OUTBOX_DIR):
+    return os.path.join(directory, f"{campaign_id}.outbox")
+
+
+def exists(path):
+    return os.path.exists(path) and os.path.exists(path + '.idx')
+
+
+def remove(path):
+    """Deletes an outbox's files; returns whether there was one."""
+    found = False
+    for name in (path, path + '.idx'):
+        try:
+            os.remove(name)
+            found = True
+        except FileNotFoundError:
+            pass
+    return found
+
+
+def message_digest(sender_name, sender_email, signature_html, subject, body, variables):
+    """Fingerprint of what a message is rendered from; `variables` is the JSON text stored with the row."""
+    return content_hash(sender_name, sender_email, signature_html, subject, body, variables)
+
+
+# --- RENDERING (worker processes) ---
+
+_worker = {}
+
+
+def _init_worker(profiles, templates):
+    # Factories and compiled templates are set up once per process, not once per chunk
+    _worker['profiles'] = profiles
+    _worker['factories'] = [MessageFactory(name, email, signature) for name, email, signature in profiles]
+    _worker['templates'] = [(step, subject, body, compile_template(subject), compile_template(body))
+                            for step, subject, body in templates]
+
+
+def _render_chunk(leads):
+    """(email, step, sender, message_id, date_at, digest, data) for each template of each
+    (profile index, lead record) pair."""
+    out = []
+    for index, record in leads:
+        name, sender, signature = _worker['profiles'][index]
+        factory = _worker['factories'][index]
+        # The same variables CampaignRunner sends with and stores in the follow-up rows
+        variables = dict(record, your_name=name)
+        text = json.dumps(variables)
+        for step, subject, body, compiled_subject, compiled_body in _worker['templates']:
+            envelope = factory.build(record['email'], compiled_subject.render(variables), compiled_body.render(variables))
+            date_at = envelope.data.index(b'\r\nDate: ') + len(b'\r\nDate: ')
+            digest = message_digest(name, sender, signature, subject, body, text)
+            out.append((record['email'], step, sender, envelope.message_id, date_at, digest, envelope.data))
+    return out
+
+
+# --- WRITING ---
+
+class OutboxWriter:
+    """Appends messages to a new outbox under temporary names; commit() swaps it in.
+
+    An outbox that a dispatcher has open keeps working until it next looks for a newer one,
+    as the old files are replaced rather than overwritten.
+    """
+
+    def __init__(self, path, campaign_id):
+        self.path = path
+        self.token = secrets.token_hex(8)
+        self.count = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._data = open(path + '.tmp', 'wb')
+        self._index = open(path + '.idx.tmp', 'w', encoding='utf-8')
+        header = _MAGIC + self.token.encode('ascii') + b'\n'
+        self._data.write(header)
+        self.offset = len(header)
+        self._index.write(json.dumps({'outbox': self.token, 'campaign_id': campaign_id, 'created_at': storage.now_ts()}) + '\n')
+
+    def append(self, email, step, sender, message_id, date_at, digest, data):
+        self._data.write(data)
+        self._index.write(json.dumps([email, step, sender, message_id, self.offset, len(data), date_at, digest]) + '\n')
+        self.offset += len(data)
+        self.count += 1
+
+    def commit(self):
+        for f in (self._data, self._index):
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        # Readers check that both files carry the same token, so the moment between the two
+        # renames only looks like no outbox at all
+        os.replace(self.path + '.tmp', self.path)
+        os.replace(self.path + '.idx.tmp', self.path + '.idx')
+
+    def discard(self):
+        self._data.close()
+        self._index.close()
+        for name in (self.path + '.tmp', self.path + '.idx.tmp'):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+
+def _profiles(conn, campaign, accounts):
+    """(sender name, email, signature) per account, worked out the way CampaignRunner.factory does."""
+    profiles = []
+    for email in accounts:
+        account = storage.get_account(conn, email) if email != campaign['sender_email'] else None
+        name = (account['sender_name'] if account is not None else None) or campaign['sender_name']
+        profiles.append((name, email, for_account(campaign['signature_html'], campaign['sender_email'], email)))
+    return profiles
+
+
+def build(conn, campaign_id, path, accounts=None, workers=None, chunk_size=CHUNK_SIZE, on_progress=None):
+    """Renders the main email and every follow-up of each pending lead into a new outbox at `path`.
+
+    Leads are dealt round-robin to `accounts` (default: every account the campaign sends
+    from), as a send deals them; each lead's follow-ups are rendered for the same account.
+    Leads on the suppression list are left out. Rendering is spread over `workers`
+    processes (default: one per CPU) while this thread writes the results in lead order.
+    on_progress(leads done, leads total) is called after each chunk.
+
+    Returns {'leads', 'messages', 'bytes'}.
+    """
+    campaign = storage.get_campaign(conn, campaign_id)
+    if campaign is None:
+        raise ValueError(f"No campaign {campaign_id}")
+    templates = [(t['step'], t['subject'] or "", t['body'] or "") for t in storage.campaign_templates(conn, campaign_id)]
+    if accounts is None:
+        accounts = [email for email, _ in storage.campaign_accounts(conn, campaign)]
+    profiles = _profiles(conn, campaign, accounts)
+    suppressions = SuppressionList.load(conn)
+    total = storage.lead_status_counts(conn, campaign_id).get('pending', 0)
+    workers = max(1, min(workers or os.cpu_count() or 1, -(-total // chunk_size)))
+
+    def chunks():
+        chunk = []
+        dealt = 0
+        for record in storage.iter_leads(conn, campaign_id, status='pending'):
+            if suppressions.reason(record['email']):
+                continue
+            chunk.append((dealt % len(profiles), record))
+            dealt += 1
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    writer = OutboxWriter(path, campaign_id)
+    leads = 0
+    pending = collections.deque()
+
+    def write(future):
+        nonlocal leads
+        rendered = future.result()
+        for message in rendered:
+            writer.append(*message)
+        leads += len(rendered) // max(1, len(templates))
+        if on_progress:
+            on_progress(leads, total)
+
+    # spawn rather than fork: the app and the pools run threads that a forked child would inherit mid-lock
+    context = multiprocessing.get_context('spawn')
+    try:
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                                    initargs=(profiles, templates)) as executor:
+            try:
+                for chunk in chunks():
+                    pending.append(executor.submit(_render_chunk, chunk))
+                    # A couple of chunks queued per process keeps them busy without holding the whole list
+                    while len(pending) > 2 * workers or (pending and pending[0].done()):
+                        write(pending.popleft())
+                while pending:
+                    write(pending.popleft())
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+    except BaseException:
+        writer.discard()
+        raise
+    writer.commit()
+    return {'leads': leads, 'messages': writer.count, 'bytes': writer.offset}
+
+
+# --- READING ---
+
+class Outbox:
+    """A built outbox, read-only: its index in memory and its messages through mmap.
+
+    Lookups are by (recipient, step), step 0 being the main email. Safe to share between
+    the threads of a pool.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        with open(path + '.idx', encoding='utf-8') as f:
+            header = json.loads(f.readline() or 'null')
+            if not header:
+                raise ValueError(f"{path} has an empty index")
+            for line in f:
+                # An unfinished last line can only come from a copy taken mid-build
+                if line.endswith('\n'):
+                    entry = Entry(*json.loads(line))
+                    self.entries[(entry.email, entry.step)] = entry
+        self.campaign_id = header['campaign_id']
+        self.created_at = header['created_at']
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"{path} is empty")
+        if self._map[:self._map.find(b'\n')] != _MAGIC + header['outbox'].encode('ascii'):
+            self.close()
+            raise ValueError(f"{path} does not belong to its index; build the outbox again")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        """Entries in the order they were written: lead by lead, steps in order."""
+        return iter(self.entries.values())
+
+    @property
+    def size(self):
+        return len(self._map)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def get(self, email, step):
+        return self.entries.get((email, step))
+
+    def raw(self, entry):
+        """The message bytes exactly as spooled."""
+        return self._map[entry.offset:entry.offset + entry.length]
+
+    def envelope(self, entry):
+        """The spooled message ready for sendmail(), its Date header set to now."""
+        data = self.raw(entry)
+        date = formatdate(localtime=True).encode('ascii')
+        if len(date) == DATE_LENGTH:
+            data = data[:entry.date_at] + date + data[entry.date_at + DATE_LENGTH:]
+        return Envelope(entry.sender, entry.email, data, entry.message_id)
+
+
+def describe(data):
+    """A spooled message as text lines: the From, To and Subject headers and each decoded part.
+
+    Message-ID, Date and the MIME boundary are left out, as they differ on every build.
+    """
+    message = message_from_bytes(data, policy=policy.default)
+    lines = [f"{name}: {message[name]}" for name in ('From', 'To', 'Subject')]
+    for part in message.walk():
+        if part.get_content_maintype() == 'text':
+            lines += ["", f"[{part.get_content_type()}]", *part.get_content().splitlines()]
+    return lines
+
+
+def diff(old, new, context=3):
+    """Yields (recipient, step, change, unified-diff lines) for each message that differs between
+    two outboxes; change is 'changed', or 'removed'/'added' for one only the old/new one has.
+    Messages rendered from the same data are taken as equal without decoding them."""
+    for key, entry in old.entries.items():
+        other = new.entries.get(key)
+        if other is None:
+            yield key[0], key[1], 'removed', []
+        elif entry.digest != other.digest:
+            label = f"{key[0]} (step {key[1]})"
+            lines = difflib.unified_diff(describe(old.raw(entry)), describe(new.raw(other)),
+                                         f"{old.path}: {label}", f"{new.path}: {label}", n=context, lineterm='')
+            yield key[0], key[1], 'changed', list(lines)
+    for key in new.entries:
+        if key not in old.entries:
+            yield key[0], key[1], 'added', []
@@ -0,0 +1,128 @@
+"""Follow-up send times planned against each sender account's hourly capacity."""
+import datetime
+import random
+import re
+import time
+import zoneinfo
+
+from dripmailer import storage
+
+HOUR = 3600
+DAY = 86400
+
+# Lead columns read as the recipient's IANA time zone (e.g. Europe/Berlin)
+TIMEZONE_COLUMNS = ('timezone', 'time_zone', 'tz')
+
+
+def parse_holidays(text):
+    """Dates from YYYY-MM-DD entries separated by commas, spaces or new lines; ValueError on a bad one."""
+    return {datetime.date.fromisoformat(part) for part in re.split(r'[\s,]+', text or "") if part}
+
+
+class SendPlanner:
+    """Picks follow-up send times that spread the queue evenly over business hours.
+
+    A follow-up due T+N days goes out on that date, or on the next working day when that
+    is a weekend or one of `holidays`, between `start_hour` and `end_hour` local time.
+    Local is the lead's time zone column when `lead_timezones` is set and it holds a
+    valid zone name, otherwise this machine's zone.
+
+    Within the day it takes the clock hour with the fewest emails booked for its sender
+    account, counting both pending queue rows and the times this planner has already
+    handed out, at a random second of that hour. An account can be booked up to its hourly
+    quota from the accounts table, or `capacity` per hour if it has none (0 = no cap); when
+    every hour of a day is full, the next working day is tried, up to `max_days` ahead.
+    """
+
+    def __init__(self, conn, capacity=0, start_hour=9, end_hour=17, holidays=(), lead_timezones=False,
+                 workdays=(0, 1, 2, 3, 4), max_days=60):
+        if not 0 <= start_hour < end_hour <= 24:
+            raise ValueError(f"Business hours must be a range within 0-24, got {start_hour}-{end_hour}")
+        if not workdays:
+            raise ValueError("At least one working day is needed")
+        self.conn = conn
+        self.capacity = max(0, int(capacity or 0))
+        self.start_hour = start_hour
+        self.end_hour = end_hour
+        self.holidays = set(holidays)
+        self.lead_timezones = lead_timezones
+        self.workdays = set(workdays)
+        self.max_days = max_days
+        # Follow-ups that found no free hour within max_days and were put in the least booked one anyway
+        self.overbooked = 0
+        self._booked = {}
+        self._loaded_days = set()
+        self._capacities = {}
+        self._zones = {}
+        self._slots = {}
+
+    def __call__(self, days_ahead, lead=None, sender=None):
+        """send_at, as a local datetime, for a follow-up `days_ahead` days from now."""
+        zone = self._zone(lead) if self.lead_timezones and lead else None
+        capacity = self._capacity(sender)
+        now = time.time()
+        day = datetime.datetime.now(zone).date() + datetime.timedelta(days=days_ahead)
+        first = None
+        for _ in range(self.max_days):
+            day = self._next_workday(day)
+            slots = [slot for slot in self._day_slots(day, zone) if slot[2] > now]
+            if slots:
+                slot = min(slots, key=lambda s: self._load(sender, s[0]))
+                first = first or slot
+                if not capacity or self._load(sender, slot[0]) < capacity:
+                    return self._book(sender, slot, now)
+            day += datetime.timedelta(days=1)
+        self.overbooked += 1
+        return self._book(sender, first, now)
+
+    def _book(self, sender, slot, now):
+        hour, start, end = slot
+        self._booked[(sender, hour)] = self._load(sender, hour) + 1
+        return datetime.datetime.fromtimestamp(random.randrange(max(start, int(now)), end))
+
+    def _next_workday(self, day):
+        for _ in range(366):
+            if day.weekday() in self.workdays and day not in self.holidays:
+                return day
+            day += datetime.timedelta(days=1)
+        raise ValueError("No working day within a year")
+
+    def _day_slots(self, day, zone):
+        """(hour start, first second, end) for each clock hour the day's window touches, in epoch seconds."""
+        key = (day, zone)
+        slots = self._slots.get(key)
+        if slots is None:
+            start = int(datetime.datetime.combine(day, datetime.time(self.start_hour), zone).timestamp())
+            end_day = day + datetime.timedelta(days=1) if self.end_hour == 24 else day
+            end = int(datetime.datetime.combine(end_day, datetime.time(self.end_hour % 24), zone).timestamp())
+            # Zones half an hour off UTC get partial hours at the edges of the window
+            slots = self._slots[key] = [(hour, max(hour, start), min(hour + HOUR, end))
+                                        for hour in range(start - start % HOUR, end, HOUR)]
+        return slots
+
+    def _load(self, sender, hour):
+        utc_day = hour // DAY
+        if utc_day not in self._loaded_days:
+            # Each day's existing queue load is read once, the first time the planner looks at it
+            self._loaded_days.add(utc_day)
+            for key, count in storage.booked_per_hour(self.conn, utc_day * DAY, (utc_day + 1) * DAY).items():
+                self._booked[key] = self._booked.get(key, 0) + count
+        return self._booked.get((sender, hour), 0)
+
+    def _capacity(self, sender):
+        if sender not in self._capacities:
+            account = storage.get_account(self.conn, sender) if sender else None
+            hourly = account['hourly_quota'] if account is not None else 0
+            self._capacities[sender] = hourly or self.capacity
+        return self._capacities[sender]
+
+    def _zone(self, lead):
+        name = next((lead[c] for c in TIMEZONE_COLUMNS if lead.get(c)), None)
+        if not name:
+            return None
+        if name not in self._zones:
+            try:
+                self._zones[name] = zoneinfo.ZoneInfo(name.strip())
+            except (ValueError, zoneinfo.ZoneInfoNotFoundError):
+                self._zones[name] = None
+        return self._zones[name]
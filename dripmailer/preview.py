@@ -0,0 +1,86 @@
+"""Template previews against real leads, and a placeholder check over a whole lead list."""
+import collections
+import hashlib
+import threading
+
+from dripmailer.templating import compile_template, falls_back
+
+# body_html is what the send path puts in the HTML part: the rendered body plus the signature
+Preview = collections.namedtuple('Preview', 'lead_id email subject body_html')
+
+
+def content_hash(*parts):
+    """Short digest of some strings, so cache keys don't hold whole templates."""
+    digest = hashlib.blake2b(digest_size=8)
+    for part in parts:
+        digest.update((part or "").encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class PreviewEngine:
+    """Renders templates for single leads the way CampaignRunner does, with an LRU cache.
+
+    Entries are keyed on (template hash, signature hash, lead id). The signature hash also
+    covers the sender name, since {your_name} comes from it. Lead ids are never reused, so
+    an edit only re-renders the previews of the template or signature that changed.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, subject, body, signature_html, sender_name, lead_id, record):
+        key = (content_hash(subject, body), content_hash(signature_html, sender_name), lead_id)
+        with self._lock:
+            preview = self._cache.get(key)
+            if preview is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return preview
+        row = dict(record, your_name=sender_name)
+        body_html = compile_template(body).render(row).replace('\n', '<br>')
+        if signature_html:
+            body_html += f"<br><br>{signature_html}"
+        preview = Preview(lead_id, record.get('email', ''), compile_template(subject).render(row), body_html)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = preview
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return preview
+
+    def render_leads(self, subject, body, signature_html, sender_name, leads):
+        """Previews for (lead id, record) pairs, e.g. from storage.sample_leads()."""
+        return [self.render(subject, body, signature_html, sender_name, lead_id, record) for lead_id, record in leads]
+
+
+def template_keys(*templates):
+    """Sorted placeholder keys used by any of the templates."""
+    keys = set()
+    for template in templates:
+        keys.update(compile_template(template or "").keys)
+    return sorted(keys)
+
+
+def count_fallbacks(records, keys, provided=None):
+    """({key: records that would get its [var] fallback}, record count) in a single pass.
+
+    provided holds the values that come from the sender rather than the lead (your_name).
+    """
+    provided = provided or {}
+    lead_keys = [k for k in keys if k not in provided]
+    counts = dict.fromkeys(keys, 0)
+    total = 0
+    for record in records:
+        total += 1
+        for key in lead_keys:
+            if falls_back(record.get(key)):
+                counts[key] += 1
+    for key in keys:
+        if key in provided and falls_back(provided[key]):
+            counts[key] = total
+    return counts, total
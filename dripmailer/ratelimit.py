@@ -0,0 +1,131 @@
+import asyncio
+import random
+import smtplib
+import ssl
+import threading
+import time
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+# Reply codes relays use to say "slow down" rather than "no"
+THROTTLE_CODES = {421, 450, 451, 452}
+
+
+class RateLimiter:
+    """Thread-safe token bucket. A rate of 0 (or None) disables the limit."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate or 0)
+        self.capacity = max(1.0, float(burst))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """Takes a token and returns 0, or returns the seconds until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """acquire() for coroutines: waits without blocking the event loop."""
+        if self.rate <= 0:
+            return
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """Token bucket that halves its rate when the relay throttles and creeps back up on success.
+
+    The rate never drops below `min_fraction` of the configured maximum, and recovers by
+    `recovery` of the maximum per successful send (additive increase, multiplicative decrease).
+    """
+
+    def __init__(self, rate, burst=1, min_fraction=0.1, recovery=0.02):
+        super().__init__(rate, burst)
+        self.max_rate = self.rate
+        self.min_rate = self.rate * min_fraction
+        self.recovery = recovery
+
+    def slow_down(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * self.recovery)
+
+
+class LimiterGroup:
+    """Lazily creates one AdaptiveRateLimiter per key (sender account, recipient domain...)."""
+
+    def __init__(self, rate, **kwargs):
+        self.rate = rate
+        self.kwargs = kwargs
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.setdefault(key, AdaptiveRateLimiter(self.rate, **self.kwargs))
+        return limiter
+
+
+def smtp_code(error):
+    """The SMTP reply code carried by an smtplib exception, if any."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return codes[0] if codes else None
+    return getattr(error, 'smtp_code', None)
+
+
+def classify_error(error):
+    """Returns (TRANSIENT or PERMANENT, reply code or None) for a failed send.
+
+    4xx replies and dropped/timed-out connections are worth retrying later; 5xx replies
+    and anything unexpected are not.
+    """
+    code = smtp_code(error)
+    if isinstance(code, int) and 400 <= code < 500:
+        return TRANSIENT, code
+    if code is None and isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError, ssl.SSLError)):
+        return TRANSIENT, None
+    return PERMANENT, code
+
+
+def is_throttle(error):
+    return smtp_code(error) in THROTTLE_CODES
+
+
+def backoff_delay(attempt, base=30.0, cap=3600.0):
+    """Exponential backoff with full jitter: a random delay in [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def describe_error(error):
+    kind, code = classify_error(error)
+    label = "Temporary" if kind == TRANSIENT else "Permanent"
+    return f"{label}{f' {code}' if code else ''}: {error}"
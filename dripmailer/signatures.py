@@ -0,0 +1,65 @@
+import functools
+
+LAYOUTS = ("Minimalist Professional", "Creative with Avatar", "Corporate with Logo")
+
+# Keys of the `data` dict every layout is filled from
+FIELDS = ('name', 'title', 'company', 'phone', 'email', 'website', 'avatarUrl', 'logoUrl')
+
+DISCLAIMER_HTML = (
+    '<div style="margin-top: 25px; padding-top: 15px; border-top: 1px solid #e2e8f0; font-family: Arial, sans-serif; font-size: 10px; color: #64748b; line-height: 1.4; text-align: justify;">'
+    '<strong>Email Disclaimer:</strong> This e-mail is intended only for the person or entity to which it is addressed and may contain confidential and/or privileged material. Any review, retransmission, dissemination or other use of, or taking of any action in reliance upon, the information in this e-mail by persons or entities other than the intended recipient is prohibited and may be unlawful. If you received this e-mail in error, please contact the sender and delete it from any computer.'
+    '</div>'
+)
+
+
+def _build(layout, data):
+    if layout == "Minimalist Professional":
+        html = (
+            '<div style="font-family: Arial, sans-serif; color: #333; margin-top: 20px; border-top: 1px solid #eee; padding-top: 15px;">'
+            f'<p style="margin: 0; font-weight: bold; font-size: 14px; color: #000000;">{data["name"]}</p>'
+            f'<p style="margin: 0; font-size: 12px; color: #666;">{data["title"]} | <a href="{data["website"]}" style="color: #666; text-decoration: none;">{data["company"]}</a></p>'
+            f'<p style="margin: 0; font-size: 12px; color: #0066cc;">{data["email"]} | {data["phone"]}</p>'
+            '</div>'
+        )
+        return html + DISCLAIMER_HTML
+    elif layout == "Creative with Avatar":
+        html = (
+            '<div style="font-family: \'Helvetica Neue\', Helvetica, Arial, sans-serif; margin-top: 20px; display: flex; align-items: center; gap: 15px;">'
+            f'<img src="{data["avatarUrl"]}" alt="Avatar" style="width: 60px; height: 60px; border-radius: 50%; object-fit: cover; border: 2px solid #e2e8f0;" />'
+            '<div>'
+            f'<p style="margin: 0; font-weight: 600; font-size: 15px; color: #1e293b;">{data["name"]}</p>'
+            f'<p style="margin: 2px 0; font-size: 13px; color: #64748b;">{data["title"]}</p>'
+            f'<p style="margin: 2px 0; font-size: 13px; color: #3b82f6;">{data["email"]} <span style="color: #94a3b8;">|</span> <span style="color: #64748b;">{data["phone"]}</span></p>'
+            f'<a href="{data["website"]}" style="margin: 0; font-size: 13px; color: #3b82f6; text-decoration: none;">{data["company"]}</a>'
+            '</div></div>'
+        )
+        return html + DISCLAIMER_HTML
+    else: # Corporate with Logo
+        html = (
+            '<div style="font-family: Arial, sans-serif; margin-top: 25px;">'
+            f'<p style="margin: 0; font-weight: bold; font-size: 14px; color: #0f172a;">{data["name"]}</p>'
+            f'<p style="margin: 2px 0 5px 0; font-size: 12px; color: #475569;">{data["title"]}</p>'
+            f'<p style="margin: 0; font-size: 12px; color: #B2CC40;"><strong><a href="{data["website"]}" style="color: #B2CC40; text-decoration: none;">{data["company"]}</a></strong></p>'
+            f'<p style="margin: 4px 0 12px 0; font-size: 12px; color: #475569;"><a href="mailto:{data["email"]}" style="color: #B2CC40; text-decoration: none;">{data["email"]}</a> | {data["phone"]}</p>'
+            f'<img src="{data["logoUrl"]}" alt="Company Logo" style="height: 45px; border-radius: 4px;" />'
+            '</div>'
+        )
+        return html + DISCLAIMER_HTML
+
+
+@functools.lru_cache(maxsize=32)
+def _cached(layout, values):
+    return _build(layout, dict(zip(FIELDS, values)))
+
+
+def signature_html(layout, data):
+    """Signature block for one of LAYOUTS, with the disclaimer appended; unknown layouts get the corporate one."""
+    return _cached(layout, tuple(str(data.get(k, "")) for k in FIELDS))
+
+
+def for_account(signature, campaign_email, account_email):
+    """The campaign's signature as sent from another of the sender accounts: the campaign
+    account's address is swapped for the sending account's."""
+    if not signature or not campaign_email or account_email == campaign_email:
+        return signature
+    return signature.replace(campaign_email, account_email)
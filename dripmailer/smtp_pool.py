@@ -0,0 +1,253 @@
+import collections
+import queue
+import smtplib
+import ssl
+import threading
+import time
+
+from dripmailer.metrics import Metrics
+from dripmailer.ratelimit import PERMANENT, LimiterGroup, RateLimiter, backoff_delay, classify_error, is_throttle, smtp_code
+
+SMTP_HOST = "mail.streamax.com"
+SMTP_PORT = 465
+
+# Errors that mean the session itself is gone; the next attempt opens a fresh connection
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError, ssl.SSLError)
+
+_STOP = object()
+
+
+def session_lost(error):
+    """True when the failed send left the session unusable."""
+    return isinstance(error, RECONNECT_ERRORS) or smtp_code(error) == 421
+
+
+def open_smtp(username, password, host=SMTP_HOST, port=SMTP_PORT, use_ssl=True, timeout=30):
+    """Opens a single SMTP session and logs in."""
+    if use_ssl:
+        context = ssl.create_default_context()
+        server = smtplib.SMTP_SSL(host, port, timeout=timeout, context=context)
+    else:
+        server = smtplib.SMTP(host, port, timeout=timeout)
+    if password:
+        server.login(username, password)
+    return server
+
+
+def close_smtp(server):
+    try:
+        server.quit()
+    except Exception:
+        pass
+
+
+class SMTPPool:
+    """A fixed set of worker threads, each holding its own logged-in SMTP session.
+
+    Jobs go in through imap() and their results come back in submission order, so the
+    caller can keep driving progress bars and logs from a single thread.
+
+    By default every connection logs in as `username`. Given `accounts`, a list of
+    (email, password) pairs, the pool opens `workers` connections for each account and
+    routes every message to the connections of its envelope sender. Accounts that fail to
+    log in are left out (see `senders` and `failed_logins`) unless none can log in.
+
+    Sends are paced per connection, per account (`account_rate`, by default the same as
+    `global_rate`), for the pool as a whole (`global_rate`) and per recipient domain.
+    Temporary failures (4xx, dropped connections) are retried up to `max_retries` times
+    with jittered exponential backoff, and throttling replies halve the account and
+    domain rates until sends succeed again. Permanent (5xx) failures are reported at once.
+
+    Login and send times, end-to-end message latency and errors by reply code are
+    recorded in `metrics`.
+    """
+
+    def __init__(self, username, password, workers=4, per_connection_rate=1.0, global_rate=4.0,
+                 host=SMTP_HOST, port=SMTP_PORT, use_ssl=True, timeout=30, max_retries=2,
+                 domain_rate=0, backoff_base=5.0, backoff_cap=120.0, metrics=None, accounts=None,
+                 account_rate=None):
+        self.username = username
+        self.password = password
+        self.accounts = list(accounts) if accounts else [(username, password)]
+        self.workers = max(1, int(workers))
+        self.per_connection_rate = per_connection_rate
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.metrics = metrics or Metrics()
+        self._global = RateLimiter(global_rate)
+        self._account_limits = LimiterGroup(global_rate if account_rate is None else account_rate)
+        self._domains = LimiterGroup(domain_rate)
+        # One job queue per logged-in account, keyed by its address
+        self._queues = {}
+        self.senders = []
+        self.failed_logins = {}
+        self._results = {}
+        self._done = threading.Condition()
+        self._threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def connections(self):
+        return self.workers * max(1, len(self.senders))
+
+    def _connect(self, username, password):
+        with self.metrics.time('smtp_login'):
+            return open_smtp(username, password, self.host, self.port, self.use_ssl, self.timeout)
+
+    def start(self):
+        # Log in to each account once up front so bad credentials fail before any lead is touched
+        for username, password in self.accounts:
+            try:
+                first = self._connect(username, password)
+            except Exception as e:
+                self.failed_logins[username] = e
+                continue
+            jobs = self._queues[username] = queue.Queue()
+            self.senders.append(username)
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, args=(username, password, jobs, first if i == 0 else None),
+                                     name=f"smtp-pool-{username}-{i}", daemon=True)
+                t.start()
+                self._threads.append((jobs, t))
+        if not self.senders:
+            raise next(iter(self.failed_logins.values()))
+        return self
+
+    def _withdraw(self):
+        """Takes every job no worker has picked up yet off the queues and returns their seqs."""
+        withdrawn = set()
+        for jobs in self._queues.values():
+            try:
+                while True:
+                    job = jobs.get_nowait()
+                    if job is not _STOP:
+                        withdrawn.add(job[0])
+            except queue.Empty:
+                pass
+        return withdrawn
+
+    def close(self):
+        # Drop anything not yet picked up, then let each worker quit its session
+        self._withdraw()
+        for jobs, _ in self._threads:
+            jobs.put(_STOP)
+        for _, t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _send(self, server, envelope):
+        with self.metrics.time('smtp_send'):
+            server.sendmail(envelope.sender, [envelope.recipient], envelope.data)
+
+    def _run(self, username, password, jobs, server):
+        limiter = RateLimiter(self.per_connection_rate)
+        account = self._account_limits.get(username)
+        while True:
+            job = jobs.get()
+            if job is _STOP:
+                break
+            seq, envelope, submitted = job
+            domain = self._domains.get(envelope.recipient.rsplit("@", 1)[-1])
+            error = None
+            attempt = 0
+            while True:
+                try:
+                    if server is None:
+                        server = self._connect(username, password)
+                    limiter.acquire()
+                    account.acquire()
+                    self._global.acquire()
+                    domain.acquire()
+                    self._send(server, envelope)
+                    account.speed_up()
+                    domain.speed_up()
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    if session_lost(e):
+                        if server is not None:
+                            close_smtp(server)
+                        server = None
+                    delay = self._retry_delay(e, attempt, account, domain)
+                    if delay is None:
+                        break
+                    if delay:
+                        time.sleep(delay)
+                    attempt += 1
+            self._finish(seq, error, submitted)
+        if server is not None:
+            close_smtp(server)
+
+    def _retry_delay(self, error, attempt, account, domain):
+        """Counts a failed send; returns the seconds to wait before retrying it, or None to give up."""
+        self.metrics.count('smtp_errors_total', code=smtp_code(error) or type(error).__name__)
+        if classify_error(error)[0] == PERMANENT or attempt >= self.max_retries:
+            return None
+        if is_throttle(error):
+            account.slow_down()
+            domain.slow_down()
+        # A session that simply went stale is worth one immediate retry
+        if attempt or not isinstance(error, RECONNECT_ERRORS):
+            return backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+        return 0
+
+    def _finish(self, seq, error, submitted):
+        self.metrics.observe('message', time.perf_counter() - submitted)
+        self.metrics.message_done(error is None)
+        with self._done:
+            self._results[seq] = error
+            self._done.notify_all()
+
+    def _ready(self, seq):
+        with self._done:
+            return seq in self._results
+
+    def _take(self, seq, tag):
+        with self._done:
+            while seq not in self._results:
+                self._done.wait()
+            return tag, self._results.pop(seq)
+
+    def imap(self, jobs, window=None):
+        """Sends (tag, envelope) jobs and yields (tag, error) in the order they were submitted.
+
+        error is None on success. At most `window` messages are in flight, so jobs can be
+        a lazy generator over a large lead list. A job whose sender is not one of `senders`
+        fails with SMTPSenderRefused rather than going out from another account. If the
+        caller stops iterating early, jobs no worker has picked up yet are withdrawn, and
+        the (tag, error) results of those that did go out are left in `abandoned`.
+        """
+        window = window or self.connections * 4
+        pending = collections.deque()
+        self.abandoned = []
+        try:
+            for seq, (tag, envelope) in enumerate(jobs):
+                sender_jobs = self._queues.get(envelope.sender)
+                if sender_jobs is None:
+                    self._finish(seq, smtplib.SMTPSenderRefused(451, b"No logged-in session for this account", envelope.sender),
+                                 time.perf_counter())
+                else:
+                    sender_jobs.put((seq, envelope, time.perf_counter()))
+                pending.append((seq, tag))
+                while pending and (len(pending) >= window or self._ready(pending[0][0])):
+                    yield self._take(*pending.popleft())
+            while pending:
+                yield self._take(*pending.popleft())
+        finally:
+            if pending:
+                self.abandoned = self._abandon(pending)
+
+    def _abandon(self, pending):
+        withdrawn = self._withdraw()
+        return [self._take(seq, tag) for seq, tag in pending if seq not in withdrawn]
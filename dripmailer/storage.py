@@ -0,0 +1,1141 @@
+import datetime
+import json
+import os
+import random
+import sqlite3
+import time
+
+from dripmailer.metrics import Metrics
+
+DB_PATH = 'campaigns.db'
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Milliseconds a writer waits on a locked database before giving up
+BUSY_TIMEOUT_MS = 5000
+
+
+# --- TIME HELPERS ---
+# send_at and lease_until are stored as integer epoch seconds so range scans use the index
+
+def now_ts(offset_seconds=0):
+    return int(time.time()) + int(offset_seconds)
+
+
+def to_epoch(dt):
+    return int(dt.timestamp())
+
+
+def format_ts(ts):
+    return datetime.datetime.fromtimestamp(ts).strftime(TIME_FORMAT) if ts is not None else ""
+
+
+# --- MIGRATIONS ---
+# Each entry upgrades the schema by one version; PRAGMA user_version records how far a
+# database has been migrated. Never edit a shipped migration, append a new one instead.
+
+def _m001_create_scheduled_emails(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scheduled_emails (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            target_email TEXT,
+            sender_name TEXT,
+            sender_email TEXT,
+            sender_password TEXT,
+            subject TEXT,
+            html_body TEXT,
+            send_at DATETIME,
+            status TEXT DEFAULT 'pending',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _m002_lease_column(conn):
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(scheduled_emails)")]
+    if 'lease_until' not in columns:
+        conn.execute("ALTER TABLE scheduled_emails ADD COLUMN lease_until DATETIME")
+
+
+def _m003_epoch_times_and_status_index(conn):
+    # Text DATETIMEs were written in local time; the 'utc' modifier converts them on the way to epoch
+    conn.execute('''
+        CREATE TABLE scheduled_emails_v3 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            target_email TEXT,
+            sender_name TEXT,
+            sender_email TEXT,
+            sender_password TEXT,
+            subject TEXT,
+            html_body TEXT,
+            send_at INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            lease_until INTEGER
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO scheduled_emails_v3
+        (id, target_email, sender_name, sender_email, sender_password, subject, html_body, send_at, status, created_at, lease_until)
+        SELECT id, target_email, sender_name, sender_email, sender_password, subject, html_body,
+               COALESCE(CAST(strftime('%s', send_at, 'utc') AS INTEGER), 0),
+               COALESCE(status, 'pending'), created_at,
+               CAST(strftime('%s', lease_until, 'utc') AS INTEGER)
+        FROM scheduled_emails
+    ''')
+    conn.execute("DROP TABLE scheduled_emails")
+    conn.execute("ALTER TABLE scheduled_emails_v3 RENAME TO scheduled_emails")
+    conn.execute("CREATE INDEX idx_scheduled_status_send_at ON scheduled_emails (status, send_at)")
+
+
+def _m004_leads(conn):
+    # Uploaded lead lists are spooled here so the app never holds a whole list in memory
+    conn.execute('''
+        CREATE TABLE leads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id TEXT NOT NULL,
+            email TEXT NOT NULL,
+            data TEXT NOT NULL,
+            UNIQUE (campaign_id, email)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE lead_rejects (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id TEXT NOT NULL,
+            row_no INTEGER,
+            email TEXT,
+            reason TEXT,
+            data TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_lead_rejects_campaign ON lead_rejects (campaign_id, id)")
+
+
+def _m005_followup_campaign(conn):
+    # Lets a campaign cancel the follow-ups it pre-scheduled for leads whose main email failed
+    conn.execute("ALTER TABLE scheduled_emails ADD COLUMN campaign_id TEXT")
+    conn.execute("CREATE INDEX idx_scheduled_campaign_target ON scheduled_emails (campaign_id, target_email)")
+
+
+def _m006_campaigns(conn):
+    # Sender identity, signature and templates are stored once per campaign; queue rows only
+    # keep the recipient, their render variables and send_at, and are rendered at dispatch
+    conn.execute('''
+        CREATE TABLE campaigns (
+            id TEXT PRIMARY KEY,
+            sender_name TEXT,
+            sender_email TEXT,
+            sender_password TEXT,
+            signature_html TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE campaign_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id TEXT NOT NULL,
+            step INTEGER NOT NULL,
+            name TEXT,
+            subject TEXT,
+            body TEXT,
+            delay_days INTEGER
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_campaign_templates_campaign ON campaign_templates (campaign_id, step)")
+    conn.execute("ALTER TABLE scheduled_emails ADD COLUMN template_id INTEGER")
+    conn.execute("ALTER TABLE scheduled_emails ADD COLUMN variables TEXT")
+
+
+def _m007_retry_tracking(conn):
+    conn.execute("ALTER TABLE scheduled_emails ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE scheduled_emails ADD COLUMN last_error TEXT")
+
+
+def _m008_campaign_progress(conn):
+    # Each lead's outcome is checkpointed as a campaign runs so an interrupted run can resume
+    conn.execute("ALTER TABLE leads ADD COLUMN status TEXT NOT NULL DEFAULT 'pending'")
+    conn.execute("ALTER TABLE leads ADD COLUMN message_id TEXT")
+    conn.execute("ALTER TABLE leads ADD COLUMN sent_at INTEGER")
+    conn.execute("ALTER TABLE leads ADD COLUMN last_error TEXT")
+    conn.execute("CREATE INDEX idx_leads_campaign_status ON leads (campaign_id, status, id)")
+    conn.execute("ALTER TABLE campaigns ADD COLUMN status TEXT NOT NULL DEFAULT 'running'")
+    conn.execute("ALTER TABLE campaigns ADD COLUMN finished_at INTEGER")
+    # Campaigns run before this migration have no per-lead state to resume from
+    conn.execute("UPDATE campaigns SET status = 'completed'")
+    # One follow-up per (campaign, recipient, step), however often a run is resumed
+    conn.execute("ALTER TABLE scheduled_emails ADD COLUMN dedup_key TEXT")
+    conn.execute("CREATE UNIQUE INDEX idx_scheduled_dedup_key ON scheduled_emails (dedup_key) WHERE dedup_key IS NOT NULL")
+
+
+def _m009_sender_accounts(conn):
+    # Mailboxes a campaign can be spread over, each with its relay's quotas (0 = no cap)
+    conn.execute('''
+        CREATE TABLE accounts (
+            email TEXT PRIMARY KEY,
+            password TEXT,
+            sender_name TEXT,
+            daily_quota INTEGER NOT NULL DEFAULT 0,
+            hourly_quota INTEGER NOT NULL DEFAULT 0,
+            enabled INTEGER NOT NULL DEFAULT 1,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Sends per account per clock hour; the daily total is the sum of today's hours
+    conn.execute('''
+        CREATE TABLE account_usage (
+            email TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            sent INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (email, hour)
+        )
+    ''')
+    conn.execute("ALTER TABLE campaigns ADD COLUMN use_accounts INTEGER NOT NULL DEFAULT 0")
+    # The account a lead's main email went out from; its follow-ups are sent from the same one
+    conn.execute("ALTER TABLE leads ADD COLUMN sender_email TEXT")
+
+
+def _m010_suppressions(conn):
+    # Lowercased addresses and domains that are never emailed; expires_at NULL = for good
+    conn.execute('''
+        CREATE TABLE suppressions (
+            value TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            reason TEXT,
+            source TEXT,
+            created_at INTEGER NOT NULL,
+            expires_at INTEGER
+        ) WITHOUT ROWID
+    ''')
+
+
+def _m011_reply_tracking(conn):
+    # Follow-ups keep their Message-ID too, so replies and bounces can be traced to a lead
+    conn.execute("ALTER TABLE scheduled_emails ADD COLUMN message_id TEXT")
+    conn.execute("CREATE INDEX idx_scheduled_message_id ON scheduled_emails (message_id) WHERE message_id IS NOT NULL")
+    conn.execute("CREATE INDEX idx_leads_message_id ON leads (message_id) WHERE message_id IS NOT NULL")
+    # 'replied' or 'bounced', set by the inbox scanner; status stays 'sent'
+    conn.execute("ALTER TABLE leads ADD COLUMN response TEXT")
+    conn.execute("ALTER TABLE leads ADD COLUMN responded_at INTEGER")
+    # How far each scanned mailbox has been read; UIDs only hold within one UIDVALIDITY
+    conn.execute('''
+        CREATE TABLE mailbox_checkpoints (
+            mailbox TEXT PRIMARY KEY,
+            uidvalidity INTEGER NOT NULL,
+            last_uid INTEGER NOT NULL,
+            scanned_at INTEGER NOT NULL
+        )
+    ''')
+
+
+def _m012_queue_archive(conn):
+    # Finished queue rows older than the retention period, without bodies, variables or
+    # passwords; the sender is resolved when a row is archived
+    conn.execute('''
+        CREATE TABLE scheduled_emails_archive (
+            id INTEGER PRIMARY KEY,
+            campaign_id TEXT,
+            target_email TEXT,
+            sender_email TEXT,
+            template_id INTEGER,
+            subject TEXT,
+            status TEXT NOT NULL,
+            send_at INTEGER NOT NULL,
+            attempts INTEGER,
+            last_error TEXT,
+            message_id TEXT,
+            created_at DATETIME,
+            archived_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_archive_message_id ON scheduled_emails_archive (message_id) WHERE message_id IS NOT NULL")
+
+
+def _m013_finished_at(conn):
+    # When a row reached sent/failed/cancelled/suppressed, which is what retention counts
+    # from; rows finished before this column existed take their send_at, capped at now
+    # so cancelled future slots don't wait for their slot to pass
+    finished = "status IN ('sent', 'failed', 'cancelled', 'suppressed')"
+    for table in ('scheduled_emails', 'scheduled_emails_archive'):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN finished_at INTEGER")
+        conn.execute(f"UPDATE {table} SET finished_at = MIN(send_at, ?) WHERE {finished}", (now_ts(),))
+    conn.execute("CREATE INDEX idx_scheduled_finished_at ON scheduled_emails (finished_at) WHERE finished_at IS NOT NULL")
+
+
+MIGRATIONS = [
+    _m001_create_scheduled_emails,
+    _m002_lease_column,
+    _m003_epoch_times_and_status_index,
+    _m004_leads,
+    _m005_followup_campaign,
+    _m006_campaigns,
+    _m007_retry_tracking,
+    _m008_campaign_progress,
+    _m009_sender_accounts,
+    _m010_suppressions,
+    _m011_reply_tracking,
+    _m012_queue_archive,
+    _m013_finished_at,
+]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Applies any migrations newer than the database's user_version, each in its own transaction."""
+    conn.commit()
+    for version in range(schema_version(conn), len(MIGRATIONS)):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Re-check under the write lock in case another process migrated meanwhile
+            if schema_version(conn) > version:
+                conn.rollback()
+                continue
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+# --- CONNECTIONS ---
+
+def connect(path=DB_PATH):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)
+    conn.row_factory = sqlite3.Row
+    # Only takes effect on a new, empty database (it has to come before WAL); older ones
+    # switch over with enable_incremental_vacuum()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # WAL lets the UI read while a sender writes; NORMAL sync is durable enough under WAL
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+def init_db(path=DB_PATH):
+    conn = connect(path)
+    migrate(conn)
+    conn.close()
+
+
+# --- QUEUE ---
+
+# Queue rows with campaign-level fields filled in. Rows written before campaigns were
+# normalized carry their own sender/subject/html_body, which take precedence. Follow-ups
+# go out from the account that sent the lead's main email; when that is one of the
+# sender accounts rather than the campaign's own, its name and password come from there.
+QUEUE_SENDER = "COALESCE(s.sender_email, l.sender_email, c.sender_email)"
+
+QUEUE_SELECT = f'''
+    SELECT s.id, s.target_email, s.send_at, s.status, s.lease_until, s.campaign_id, s.template_id, s.variables,
+           s.attempts, s.last_error,
+           COALESCE(s.sender_name, NULLIF(a.sender_name, ''), c.sender_name) AS sender_name,
+           {QUEUE_SENDER} AS sender_email,
+           COALESCE(s.sender_password, a.password, c.sender_password) AS sender_password,
+           c.sender_email AS campaign_sender_email,
+           s.subject, s.html_body, t.step, t.subject AS subject_template, t.body AS body_template, c.signature_html
+    FROM scheduled_emails s
+    LEFT JOIN campaign_templates t ON t.id = s.template_id
+    LEFT JOIN campaigns c ON c.id = s.campaign_id
+    LEFT JOIN leads l ON l.campaign_id = s.campaign_id AND l.email = s.target_email
+    LEFT JOIN accounts a ON a.email = l.sender_email AND l.sender_email != c.sender_email
+'''
+
+
+def claim_due(conn, limit=50, lease_seconds=300, skip_senders=()):
+    """Atomically moves up to `limit` due rows to 'sending' and returns them.
+
+    Rows stuck in 'sending' past their lease (e.g. a worker that died mid-batch) are
+    claimable again. Follow-ups of leads whose main email has not gone out are left alone.
+    """
+    now = now_ts()
+    skip = list(skip_senders)
+    skip_sql = f"AND {QUEUE_SENDER} NOT IN ({','.join('?' * len(skip))})" if skip else ""
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(f'''
+            {QUEUE_SELECT}
+            WHERE ((s.status = 'pending' AND s.send_at <= ?) OR (s.status = 'sending' AND s.lease_until <= ?)) {skip_sql}
+              -- Pre-scheduled follow-ups wait until the lead's main email has gone out
+              AND (l.status IS NULL OR l.status = 'sent')
+            ORDER BY s.send_at ASC LIMIT ?
+        ''', (now, now, *skip, limit)).fetchall()
+        if rows:
+            conn.executemany(
+                "UPDATE scheduled_emails SET status = 'sending', lease_until = ? WHERE id = ?",
+                [(now + lease_seconds, r['id']) for r in rows],
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return rows
+
+
+def set_status(conn, email_id, status, error=None, message_id=None):
+    finished_at = now_ts() if status in FINISHED_STATUSES else None
+    conn.execute(
+        "UPDATE scheduled_emails SET status = ?, lease_until = NULL, last_error = ?, message_id = COALESCE(?, message_id), finished_at = ? WHERE id = ?",
+        (status, error, message_id, finished_at, email_id),
+    )
+    conn.commit()
+
+
+def reschedule(conn, email_id, send_at, error):
+    """Puts a temporarily failed row back in the queue for a later attempt."""
+    conn.execute('''
+        UPDATE scheduled_emails SET status = 'pending', lease_until = NULL, send_at = ?, attempts = attempts + 1, last_error = ?
+        WHERE id = ?
+    ''', (send_at, error, email_id))
+    conn.commit()
+
+
+def defer(conn, email_ids, send_at):
+    """Moves claimed rows to a later send_at without counting an attempt, e.g. past a quota reset."""
+    conn.executemany(
+        "UPDATE scheduled_emails SET status = 'pending', lease_until = NULL, send_at = ? WHERE id = ?",
+        [(send_at, i) for i in email_ids],
+    )
+    conn.commit()
+
+
+def release(conn, email_ids):
+    """Hands claimed rows back to the queue untouched."""
+    conn.executemany(
+        "UPDATE scheduled_emails SET status = 'pending', lease_until = NULL WHERE id = ? AND status = 'sending'",
+        [(i,) for i in email_ids],
+    )
+    conn.commit()
+
+
+def followup_row(campaign_id, target_email, template_id, variables, send_at, step):
+    dedup_key = f"{campaign_id}:{target_email}:{step}"
+    return (campaign_id, target_email, template_id, json.dumps(variables), send_at, dedup_key)
+
+
+def enqueue_followups(conn, rows):
+    """Bulk-inserts follow-up rows built with followup_row() without committing.
+
+    Rows whose (campaign, recipient, step) is already queued are skipped, so a resumed
+    campaign can safely schedule a lead's follow-ups again.
+    """
+    conn.executemany(
+        "INSERT OR IGNORE INTO scheduled_emails (campaign_id, target_email, template_id, variables, send_at, dedup_key) VALUES (?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+
+
+class FollowupWriter:
+    """Buffers follow-up rows and writes them with one executemany and one commit per batch."""
+
+    def __init__(self, conn, batch_size=500, metrics=None):
+        self.conn = conn
+        self.batch_size = max(1, int(batch_size))
+        self.metrics = metrics or Metrics()
+        self.written = 0
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.flush()
+
+    def add(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        with self.metrics.time('db_write'):
+            enqueue_followups(self.conn, self._rows)
+            self.conn.commit()
+        self.written += len(self._rows)
+        self._rows = []
+
+
+class CampaignCheckpoint(FollowupWriter):
+    """FollowupWriter that also records each lead's outcome, committed together with the
+    lead's follow-ups so a crash never leaves a lead marked sent without its schedule."""
+
+    def __init__(self, conn, batch_size=500, checkpoint_every=25, metrics=None):
+        super().__init__(conn, batch_size, metrics)
+        self.checkpoint_every = max(1, int(checkpoint_every))
+        self._leads = []
+
+    def lead_done(self, lead_id, status, message_id=None, error=None, sender_email=None):
+        sent_at = now_ts() if status == 'sent' else None
+        self._leads.append((status, message_id, sent_at, error, sender_email, lead_id))
+        if len(self._leads) >= self.checkpoint_every:
+            self.flush()
+
+    def flush(self):
+        if not self._rows and not self._leads:
+            return
+        with self.metrics.time('db_write'):
+            enqueue_followups(self.conn, self._rows)
+            self.conn.executemany(
+                "UPDATE leads SET status = ?, message_id = ?, sent_at = ?, last_error = ?, sender_email = ? WHERE id = ?",
+                self._leads,
+            )
+            self.conn.commit()
+        self.written += len(self._rows)
+        self._rows = []
+        self._leads = []
+
+
+def cancel_unsent_followups(conn, campaign_id, keep=('sent', 'pending', 'sending')):
+    """Cancels still-pending follow-ups of leads whose status is not in `keep`: those whose
+    main email failed, was suppressed or has an unknown outcome. claim_due never picks them
+    up, so they would otherwise stay pending for good. Returns the row count."""
+    cur = conn.execute(f'''
+        UPDATE scheduled_emails SET status = 'cancelled', finished_at = ?
+        WHERE campaign_id = ? AND status = 'pending'
+          AND target_email IN (SELECT email FROM leads WHERE campaign_id = ? AND status NOT IN ({', '.join('?' * len(keep))}))
+    ''', (now_ts(), campaign_id, campaign_id, *keep))
+    conn.commit()
+    return cur.rowcount
+
+
+def suppress_queued(conn, rows):
+    """Marks claimed rows as 'suppressed' instead of sending them; rows are (id, reason) pairs."""
+    conn.executemany(
+        "UPDATE scheduled_emails SET status = 'suppressed', lease_until = NULL, last_error = ?, finished_at = ? WHERE id = ?",
+        [(reason, now_ts(), i) for i, reason in rows],
+    )
+    conn.commit()
+
+
+def queue_counts(conn, now=None):
+    """Pending, due, in-flight and failed totals, each answered from the status index."""
+    now = now_ts() if now is None else now
+    row = conn.execute('''
+        SELECT (SELECT COUNT(*) FROM scheduled_emails WHERE status = 'pending'),
+               (SELECT COUNT(*) FROM scheduled_emails WHERE status = 'pending' AND send_at <= ?),
+               (SELECT COUNT(*) FROM scheduled_emails WHERE status = 'sending'),
+               (SELECT COUNT(*) FROM scheduled_emails WHERE status = 'failed')
+    ''', (now,)).fetchone()
+    return {'pending': row[0], 'due': row[1], 'sending': row[2], 'failed': row[3]}
+
+
+# Just what the queue listing shows; bodies, signatures and passwords stay in the database
+PENDING_PAGE_SELECT = '''
+    SELECT s.id, s.target_email, s.send_at, s.attempts, s.last_error, s.template_id, s.subject, s.variables,
+           t.subject AS subject_template
+    FROM scheduled_emails s
+    LEFT JOIN campaign_templates t ON t.id = s.template_id
+'''
+
+
+def pending_page(conn, after=None, limit=50):
+    """One page of pending rows in (send_at, id) order.
+
+    after is the (send_at, id) of the last row of the previous page, so each page is an
+    index range scan rather than an OFFSET over everything before it.
+    """
+    if after is None:
+        return conn.execute(f"{PENDING_PAGE_SELECT} WHERE s.status = 'pending' ORDER BY s.send_at, s.id LIMIT ?", (limit,)).fetchall()
+    return conn.execute(f'''
+        {PENDING_PAGE_SELECT}
+        WHERE s.status = 'pending' AND (s.send_at, s.id) > (?, ?)
+        ORDER BY s.send_at, s.id LIMIT ?
+    ''', (*after, limit)).fetchall()
+
+
+def next_due_at(conn):
+    row = conn.execute("SELECT MIN(send_at) FROM scheduled_emails WHERE status = 'pending'").fetchone()
+    return row[0]
+
+
+def booked_per_hour(conn, start_ts, end_ts):
+    """{(sender email, hour start): pending rows} for rows due in [start_ts, end_ts), by the account they'll go out from."""
+    rows = conn.execute(f'''
+        SELECT {QUEUE_SENDER} AS sender, s.send_at - s.send_at % 3600 AS hour, COUNT(*)
+        FROM scheduled_emails s
+        LEFT JOIN campaigns c ON c.id = s.campaign_id
+        LEFT JOIN leads l ON l.campaign_id = s.campaign_id AND l.email = s.target_email
+        WHERE s.status = 'pending' AND s.send_at >= ? AND s.send_at < ?
+        GROUP BY sender, hour
+    ''', (start_ts, end_ts))
+    return {(sender, hour): count for sender, hour, count in rows}
+
+
+# --- CAMPAIGNS ---
+
+def save_campaign(conn, campaign_id, sender_name, sender_email, sender_password, signature_html, templates, use_accounts=False):
+    """Stores the campaign-level data once and returns {step: template_id}.
+
+    templates are (step, name, subject, body, delay_days) tuples, step 0 being the main
+    email. Each call adds a fresh set of template rows so follow-ups already queued by an
+    earlier run keep rendering from the templates they were scheduled with.
+    use_accounts spreads the campaign over the enabled sender accounts as well.
+    """
+    conn.execute('''
+        INSERT INTO campaigns (id, sender_name, sender_email, sender_password, signature_html, use_accounts) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET sender_name = excluded.sender_name, sender_email = excluded.sender_email,
+            sender_password = excluded.sender_password, signature_html = excluded.signature_html,
+            use_accounts = excluded.use_accounts, status = 'running', finished_at = NULL
+    ''', (campaign_id, sender_name, sender_email, sender_password, signature_html, int(bool(use_accounts))))
+    template_ids = {}
+    for step, name, subject, body, delay_days in templates:
+        cur = conn.execute(
+            "INSERT INTO campaign_templates (campaign_id, step, name, subject, body, delay_days) VALUES (?, ?, ?, ?, ?, ?)",
+            (campaign_id, step, name, subject, body, delay_days),
+        )
+        template_ids[step] = cur.lastrowid
+    conn.commit()
+    return template_ids
+
+
+def get_campaign(conn, campaign_id):
+    return conn.execute("SELECT * FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+
+
+def campaign_templates(conn, campaign_id):
+    """The template set stored by the campaign's latest save_campaign(), in step order."""
+    return conn.execute('''
+        SELECT * FROM campaign_templates
+        WHERE campaign_id = ? AND id >= (SELECT MAX(id) FROM campaign_templates WHERE campaign_id = ? AND step = 0)
+        ORDER BY step
+    ''', (campaign_id, campaign_id)).fetchall()
+
+
+def unfinished_campaigns(conn):
+    return conn.execute("SELECT * FROM campaigns WHERE status = 'running' ORDER BY created_at DESC").fetchall()
+
+
+def finish_campaign(conn, campaign_id, status='completed'):
+    """Closes a campaign. An abandoned one also cancels the follow-ups of every lead whose
+    main email never went out, pending leads included."""
+    conn.execute("UPDATE campaigns SET status = ?, finished_at = ? WHERE id = ?", (status, now_ts(), campaign_id))
+    conn.commit()
+    cancel_unsent_followups(conn, campaign_id, keep=('sent',) if status == 'abandoned' else ('sent', 'pending', 'sending'))
+
+
+def campaign_accounts(conn, campaign):
+    """(email, password) of each account the campaign sends from, its own account first."""
+    accounts = [(campaign['sender_email'], campaign['sender_password'])]
+    if campaign['use_accounts']:
+        accounts += [(a['email'], a['password']) for a in list_accounts(conn, enabled_only=True) if a['email'] != campaign['sender_email']]
+    return accounts
+
+
+# --- SENDER ACCOUNTS ---
+# Quotas are counted per clock hour in account_usage. Hourly caps reset on the hour,
+# daily caps at local midnight. Accounts that are not configured here are never capped.
+
+def hour_start(ts):
+    return ts - ts % 3600
+
+
+def day_start(ts):
+    t = time.localtime(ts)
+    return int(time.mktime((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0, 0, 0, -1)))
+
+
+def save_account(conn, email, password, sender_name, daily_quota=0, hourly_quota=0, enabled=True):
+    """Adds or updates a sender account; an empty password keeps the stored one and an
+    empty name is stored as NULL, so the campaign's sender name is used."""
+    conn.execute('''
+        INSERT INTO accounts (email, password, sender_name, daily_quota, hourly_quota, enabled) VALUES (?, ?, NULLIF(TRIM(?), ''), ?, ?, ?)
+        ON CONFLICT (email) DO UPDATE SET password = COALESCE(NULLIF(excluded.password, ''), accounts.password),
+            sender_name = excluded.sender_name, daily_quota = excluded.daily_quota,
+            hourly_quota = excluded.hourly_quota, enabled = excluded.enabled
+    ''', (email, password, sender_name, int(daily_quota or 0), int(hourly_quota or 0), int(bool(enabled))))
+    conn.commit()
+
+
+def delete_account(conn, email):
+    conn.execute("DELETE FROM accounts WHERE email = ?", (email,))
+    conn.execute("DELETE FROM account_usage WHERE email = ?", (email,))
+    conn.commit()
+
+
+def get_account(conn, email):
+    return conn.execute("SELECT * FROM accounts WHERE email = ?", (email,)).fetchone()
+
+
+def list_accounts(conn, enabled_only=False):
+    sql = "SELECT * FROM accounts" + (" WHERE enabled = 1" if enabled_only else "") + " ORDER BY email"
+    return conn.execute(sql).fetchall()
+
+
+def accounts_overview(conn, now=None):
+    """Every account with its quotas and what it has sent today and this hour; no passwords."""
+    now = now_ts() if now is None else now
+    rows = conn.execute('''
+        SELECT a.email, a.sender_name, a.enabled, a.daily_quota, a.hourly_quota,
+               COALESCE(SUM(u.sent), 0) AS sent_today,
+               COALESCE(SUM(CASE WHEN u.hour = ? THEN u.sent END), 0) AS sent_this_hour
+        FROM accounts a LEFT JOIN account_usage u ON u.email = a.email AND u.hour >= ?
+        GROUP BY a.email ORDER BY a.email
+    ''', (hour_start(now), day_start(now))).fetchall()
+    return [dict(r) for r in rows]
+
+
+def account_usage(conn, email, now=None):
+    """(sent today, sent this hour) for one account."""
+    now = now_ts() if now is None else now
+    row = conn.execute('''
+        SELECT COALESCE(SUM(sent), 0), COALESCE(SUM(CASE WHEN hour = ? THEN sent END), 0)
+        FROM account_usage WHERE email = ? AND hour >= ?
+    ''', (hour_start(now), email, day_start(now))).fetchone()
+    return row[0], row[1]
+
+
+def quota_left(account, sent_today, sent_this_hour):
+    """Sends the account has left right now, or None if it is not capped."""
+    caps = [cap - used for cap, used in ((account['daily_quota'], sent_today), (account['hourly_quota'], sent_this_hour)) if cap]
+    return max(0, min(caps)) if caps else None
+
+
+def reserve_sends(conn, email, count, now=None):
+    """Takes up to `count` sends from the account's quotas and returns how many were granted,
+    or None if the account is not capped.
+
+    The check and the increment share one write transaction, so the app, the CLI and the
+    worker can send from the same account without overshooting its quota.
+    """
+    now = now_ts() if now is None else now
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        account = get_account(conn, email)
+        left = quota_left(account, *account_usage(conn, email, now)) if account is not None else None
+        if left is None:
+            conn.rollback()
+            return None
+        granted = min(count, left)
+        if granted:
+            conn.execute('''
+                INSERT INTO account_usage (email, hour, sent) VALUES (?, ?, ?)
+                ON CONFLICT (email, hour) DO UPDATE SET sent = sent + excluded.sent
+            ''', (email, hour_start(now), granted))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return granted
+
+
+def release_sends(conn, email, count, hour):
+    """Gives reserved sends that did not go out back to the hour they were taken from."""
+    if count:
+        conn.execute("UPDATE account_usage SET sent = MAX(0, sent - ?) WHERE email = ? AND hour = ?", (count, email, hour))
+        conn.commit()
+
+
+def quota_resets_at(conn, email, now=None):
+    """When an account out of quota can send again: the next hour, or the next day once its daily cap is used up."""
+    now = now_ts() if now is None else now
+    account = get_account(conn, email)
+    sent_today, _ = account_usage(conn, email, now)
+    if account is not None and account['daily_quota'] and sent_today >= account['daily_quota']:
+        # Noon tomorrow is safely inside the next day whatever DST does tonight
+        return day_start(day_start(now) + 36 * 3600)
+    return hour_start(now) + 3600
+
+
+# --- LEADS ---
+
+def existing_lead_emails(conn, campaign_id, emails):
+    rows = conn.execute(
+        "SELECT email FROM leads WHERE campaign_id = ? AND email IN (SELECT value FROM json_each(?))",
+        (campaign_id, json.dumps(list(emails))),
+    )
+    return {r[0] for r in rows}
+
+
+def insert_leads(conn, campaign_id, records):
+    conn.executemany(
+        "INSERT OR IGNORE INTO leads (campaign_id, email, data) VALUES (?, ?, ?)",
+        [(campaign_id, r['email'], json.dumps(r)) for r in records],
+    )
+
+
+def insert_rejects(conn, campaign_id, rejects):
+    """rejects are (row_no, email, reason, record) tuples."""
+    conn.executemany(
+        "INSERT INTO lead_rejects (campaign_id, row_no, email, reason, data) VALUES (?, ?, ?, ?, ?)",
+        [(campaign_id, row_no, email, reason, json.dumps(record)) for row_no, email, reason, record in rejects],
+    )
+
+
+def count_leads(conn, campaign_id):
+    return conn.execute("SELECT COUNT(*) FROM leads WHERE campaign_id = ?", (campaign_id,)).fetchone()[0]
+
+
+def count_rejects(conn, campaign_id):
+    return conn.execute("SELECT COUNT(*) FROM lead_rejects WHERE campaign_id = ?", (campaign_id,)).fetchone()[0]
+
+
+def iter_leads(conn, campaign_id, limit=None, batch_size=500, status=None):
+    """Yields lead records in upload order, fetching from the cursor in batches."""
+    sql = "SELECT data FROM leads WHERE campaign_id = ?"
+    params = (campaign_id,)
+    if status is not None:
+        sql += " AND status = ?"
+        params += (status,)
+    sql += " ORDER BY id"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params += (limit,)
+    cursor = conn.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for r in rows:
+            yield json.loads(r[0])
+
+
+def sample_leads(conn, campaign_id, n, seed=0):
+    """Up to n (id, record) pairs picked at random from the campaign's leads, in upload order.
+
+    The same seed picks the same leads, so previews stay put across reruns. Random ids
+    between the campaign's first and last lead are each resolved to the next lead of the
+    campaign, so only the sampled rows are read, not every id of a large list.
+    """
+    low, high, count = conn.execute(
+        "SELECT MIN(id), MAX(id), COUNT(*) FROM leads WHERE campaign_id = ?", (campaign_id,)).fetchone()
+    if not count or n <= 0:
+        return []
+    if count <= n:
+        rows = conn.execute("SELECT id, data FROM leads WHERE campaign_id = ? ORDER BY id", (campaign_id,))
+        return [(r[0], json.loads(r[1])) for r in rows]
+    picked = {}
+    # A few spare draws, since ids of another campaign spooled in between map to the same lead
+    for target in random.Random(seed).sample(range(low, high + 1), min(high - low + 1, n * 4)):
+        lead_id, data = conn.execute(
+            "SELECT id, data FROM leads WHERE id >= ? AND campaign_id = ? ORDER BY id LIMIT 1", (target, campaign_id)).fetchone()
+        picked.setdefault(lead_id, data)
+        if len(picked) == n:
+            break
+    return [(lead_id, json.loads(picked[lead_id])) for lead_id in sorted(picked)]
+
+
+def iter_rejects(conn, campaign_id, limit=None):
+    sql = "SELECT row_no, reason, data FROM lead_rejects WHERE campaign_id = ? ORDER BY id"
+    params = (campaign_id,)
+    if limit is not None:
+        sql += " LIMIT ?"
+        params += (limit,)
+    for row_no, reason, data in conn.execute(sql, params):
+        yield dict({'row': row_no}, **json.loads(data), reason=reason)
+
+
+def lead_status_counts(conn, campaign_id):
+    rows = conn.execute("SELECT status, COUNT(*) FROM leads WHERE campaign_id = ? GROUP BY status", (campaign_id,))
+    return {status: count for status, count in rows}
+
+
+def claim_leads(conn, campaign_id, after_id=0, limit=50):
+    """Marks the next `limit` pending leads after `after_id` as 'sending' and returns (id, record) pairs.
+
+    The claim is committed before the emails go out, so after a crash those leads show up
+    as unconfirmed instead of being silently sent twice.
+    """
+    rows = conn.execute(
+        "SELECT id, data FROM leads WHERE campaign_id = ? AND status = 'pending' AND id > ? ORDER BY id LIMIT ?",
+        (campaign_id, after_id, limit),
+    ).fetchall()
+    if rows:
+        conn.executemany("UPDATE leads SET status = 'sending' WHERE id = ?", [(r['id'],) for r in rows])
+        conn.commit()
+    return [(r['id'], json.loads(r['data'])) for r in rows]
+
+
+def release_leads(conn, lead_ids):
+    """Hands claimed leads that were never sent back to 'pending'."""
+    conn.executemany("UPDATE leads SET status = 'pending' WHERE id = ? AND status = 'sending'", [(i,) for i in lead_ids])
+    conn.commit()
+
+
+def settle_unconfirmed_leads(conn, campaign_id, status):
+    """Moves leads left in 'sending' by an interrupted run to `status`. Returns the row count."""
+    cur = conn.execute("UPDATE leads SET status = ? WHERE campaign_id = ? AND status = 'sending'", (status, campaign_id))
+    conn.commit()
+    return cur.rowcount
+
+
+def delete_campaign_leads(conn, campaign_id):
+    conn.execute("DELETE FROM leads WHERE campaign_id = ?", (campaign_id,))
+    conn.execute("DELETE FROM lead_rejects WHERE campaign_id = ?", (campaign_id,))
+    conn.commit()
+
+
+def suppress_leads(conn, campaign_id, reason_for):
+    """Sets pending leads that reason_for(email) returns a reason for to 'suppressed'. Returns the count."""
+    rows = conn.execute("SELECT id, email FROM leads WHERE campaign_id = ? AND status = 'pending'", (campaign_id,))
+    suppressed = [(reason, lead_id) for lead_id, reason in ((r[0], reason_for(r[1])) for r in rows) if reason]
+    conn.executemany("UPDATE leads SET status = 'suppressed', last_error = ? WHERE id = ?", suppressed)
+    conn.commit()
+    return len(suppressed)
+
+
+def contacted_emails(conn, exclude_campaign_id=None):
+    """Addresses any other campaign's main email has gone out to."""
+    rows = conn.execute("SELECT DISTINCT email FROM leads WHERE status = 'sent' AND campaign_id != ?", (exclude_campaign_id or "",))
+    return {r[0] for r in rows}
+
+
+class QuotaTracker:
+    """Hands out single sends against the accounts' quotas for a batch send, reserving them
+    from the database a block at a time. release() gives back whatever was not used."""
+
+    def __init__(self, conn, block=10):
+        self.conn = conn
+        self.block = max(1, int(block))
+        self._held = {}
+        self._uncapped = set()
+        self._resets_at = {}
+
+    def take(self, email):
+        if email in self._uncapped:
+            return True
+        now = now_ts()
+        if self._resets_at.get(email, 0) > now:
+            return False
+        held = self._held.get(email)
+        if held and held[0] != hour_start(now):
+            # The hour rolled over; what is left belongs to the old hour's count
+            self._give_back(email)
+            held = None
+        if not held or not held[1]:
+            granted = reserve_sends(self.conn, email, self.block, now)
+            if granted is None:
+                self._uncapped.add(email)
+                return True
+            if not granted:
+                self._resets_at[email] = quota_resets_at(self.conn, email, now)
+                return False
+            held = self._held[email] = [hour_start(now), granted]
+        held[1] -= 1
+        return True
+
+    def refund(self, email):
+        """A send that did not go out does not count against the quota."""
+        held = self._held.get(email)
+        if held:
+            held[1] += 1
+
+    def resets_at(self, email):
+        return self._resets_at.get(email)
+
+    def _give_back(self, email):
+        hour, unused = self._held.pop(email)
+        release_sends(self.conn, email, unused, hour)
+
+    def release(self):
+        for email in list(self._held):
+            self._give_back(email)
+
+
+# --- SUPPRESSIONS ---
+
+def add_suppressions(conn, entries, source, expires_at=None, now=None):
+    """Upserts (value, kind, reason) entries, values already normalized. Returns how many were written.
+
+    An address suppressed again keeps the later of the two expiries, and never expires
+    if either entry doesn't.
+    """
+    now = now_ts() if now is None else now
+    cur = conn.executemany('''
+        INSERT INTO suppressions (value, kind, reason, source, created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (value) DO UPDATE SET
+            reason = excluded.reason, source = excluded.source, created_at = excluded.created_at,
+            expires_at = CASE WHEN expires_at IS NULL OR excluded.expires_at IS NULL THEN NULL
+                              ELSE MAX(expires_at, excluded.expires_at) END
+    ''', ((value, kind, reason, source, now, expires_at) for value, kind, reason in entries))
+    conn.commit()
+    return cur.rowcount
+
+
+def remove_suppressions(conn, values):
+    cur = conn.executemany("DELETE FROM suppressions WHERE value = ?", [(v,) for v in values])
+    conn.commit()
+    return cur.rowcount
+
+
+def active_suppressions(conn, now=None):
+    """Yields (value, kind, reason) for every suppression that has not expired."""
+    now = now_ts() if now is None else now
+    yield from conn.execute("SELECT value, kind, reason FROM suppressions WHERE expires_at IS NULL OR expires_at > ?", (now,))
+
+
+def suppression_page(conn, search="", limit=100):
+    """Most recently added suppressions, optionally only those containing `search`."""
+    return conn.execute('''
+        SELECT value, kind, reason, source, created_at, expires_at FROM suppressions
+        WHERE value LIKE ? ORDER BY created_at DESC LIMIT ?
+    ''', (f"%{search.strip().lower()}%", limit)).fetchall()
+
+
+def suppression_counts(conn, now=None):
+    """{'address': n, 'domain': n, 'expired': n}."""
+    now = now_ts() if now is None else now
+    counts = {'address': 0, 'domain': 0, 'expired': 0}
+    rows = conn.execute('''
+        SELECT CASE WHEN expires_at IS NOT NULL AND expires_at <= ? THEN 'expired' ELSE kind END, COUNT(*)
+        FROM suppressions GROUP BY 1
+    ''', (now,))
+    counts.update({kind: n for kind, n in rows})
+    return counts
+
+
+def purge_expired_suppressions(conn, now=None):
+    now = now_ts() if now is None else now
+    cur = conn.execute("DELETE FROM suppressions WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+    conn.commit()
+    return cur.rowcount
+
+
+# --- REPLIES AND BOUNCES ---
+
+def sent_by_message_ids(conn, message_ids):
+    """{message id: (campaign id, recipient)} for the ids of main emails and follow-ups that were sent."""
+    ids = json.dumps(list(message_ids))
+    rows = conn.execute('''
+        SELECT message_id, campaign_id, email FROM leads
+        WHERE message_id IN (SELECT value FROM json_each(?))
+        UNION ALL
+        SELECT message_id, campaign_id, target_email FROM scheduled_emails
+        WHERE message_id IN (SELECT value FROM json_each(?))
+        UNION ALL
+        SELECT message_id, campaign_id, target_email FROM scheduled_emails_archive
+        WHERE message_id IN (SELECT value FROM json_each(?))
+    ''', (ids, ids, ids))
+    return {message_id: (campaign_id, email) for message_id, campaign_id, email in rows}
+
+
+def record_responses(conn, leads, response, now=None):
+    """Marks (campaign id, email) leads as 'replied'/'bounced' and cancels their pending follow-ups.
+
+    Both are a single UPDATE over the whole batch, each looked up through an index. Returns
+    the number of follow-ups cancelled. The caller commits.
+    """
+    now = now_ts() if now is None else now
+    pairs = json.dumps(sorted(set(leads)))
+    matched = "SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?)"
+    # A bounce outranks an earlier reply (e.g. an out-of-office sent before the mailbox was closed)
+    conn.execute(f'''
+        UPDATE leads SET response = ?, responded_at = ?
+        WHERE (campaign_id, email) IN ({matched}) AND (response IS NULL OR ? = 'bounced')
+    ''', (response, now, pairs, response))
+    # +status keeps the planner on the (campaign_id, target_email) index rather than the status one
+    cur = conn.execute(f'''
+        UPDATE scheduled_emails SET status = 'cancelled', last_error = ?, finished_at = ?
+        WHERE +status = 'pending' AND (campaign_id, target_email) IN ({matched})
+    ''', ("Lead replied" if response == 'replied' else "Email bounced", now, pairs))
+    return cur.rowcount
+
+
+def response_counts(conn):
+    return {response: n for response, n in conn.execute("SELECT response, COUNT(*) FROM leads WHERE response IS NOT NULL GROUP BY response")}
+
+
+def get_mailbox_checkpoint(conn, mailbox):
+    return conn.execute("SELECT * FROM mailbox_checkpoints WHERE mailbox = ?", (mailbox,)).fetchone()
+
+
+def save_mailbox_checkpoint(conn, mailbox, uidvalidity, last_uid, now=None):
+    """Records how far `mailbox` has been read. The caller commits, together with what was read."""
+    conn.execute('''
+        INSERT INTO mailbox_checkpoints (mailbox, uidvalidity, last_uid, scanned_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT (mailbox) DO UPDATE SET uidvalidity = excluded.uidvalidity, last_uid = excluded.last_uid, scanned_at = excluded.scanned_at
+    ''', (mailbox, uidvalidity, last_uid, now_ts() if now is None else now))
+
+
+# --- RETENTION ---
+# Finished rows are moved out of scheduled_emails, so the table the dispatcher and the
+# Queue Manager read stays about as large as the work still ahead of them
+
+# Terminal statuses; every update that sets one also sets finished_at
+FINISHED_STATUSES = ('sent', 'failed', 'cancelled', 'suppressed')
+
+
+def archivable_count(conn, older_than_days, now=None):
+    """Queue rows finished more than `older_than_days` days ago."""
+    cutoff = (now_ts() if now is None else now) - older_than_days * 86400
+    return conn.execute("SELECT COUNT(*) FROM scheduled_emails WHERE finished_at < ?", (cutoff,)).fetchone()[0]
+
+
+def archive_finished(conn, older_than_days, batch_size=1000, pause=0.05, now=None, on_batch=None):
+    """Moves queue rows finished more than `older_than_days` days ago to scheduled_emails_archive.
+
+    Each batch of `batch_size` rows is copied and deleted in one short write transaction,
+    with `pause` seconds between batches so the dispatcher and the app get the write lock
+    in between. on_batch(rows archived so far) is called after each batch. Returns the total.
+    """
+    now = now_ts() if now is None else now
+    cutoff = now - older_than_days * 86400
+    archived = 0
+    while True:
+        conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ids = json.dumps([r[0] for r in conn.execute(
+                "SELECT id FROM scheduled_emails WHERE finished_at < ? LIMIT ?", (cutoff, batch_size))])
+            moved = conn.execute(f'''
+                INSERT INTO scheduled_emails_archive
+                    (id, campaign_id, target_email, sender_email, template_id, subject, status, send_at, attempts,
+                     last_error, message_id, created_at, finished_at, archived_at)
+                SELECT s.id, s.campaign_id, s.target_email, {QUEUE_SENDER}, s.template_id, s.subject, s.status, s.send_at,
+                       s.attempts, s.last_error, s.message_id, s.created_at, s.finished_at, ?
+                FROM scheduled_emails s
+                LEFT JOIN campaigns c ON c.id = s.campaign_id
+                LEFT JOIN leads l ON l.campaign_id = s.campaign_id AND l.email = s.target_email
+                WHERE s.id IN (SELECT value FROM json_each(?))
+            ''', (now, ids)).rowcount
+            conn.execute("DELETE FROM scheduled_emails WHERE id IN (SELECT value FROM json_each(?))", (ids,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if not moved:
+            return archived
+        archived += moved
+        if on_batch:
+            on_batch(archived)
+        time.sleep(pause)
+
+
+def reclaim_space(conn, max_pages=0):
+    """Hands free pages back to the filesystem with PRAGMA incremental_vacuum (all of them
+    when max_pages is 0). Returns the bytes freed; 0 unless auto_vacuum is INCREMENTAL."""
+    conn.commit()
+    before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    # execute() steps the pragma once, freeing a single page; executescript() runs it to completion
+    conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)})")
+    freed = before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return freed * conn.execute("PRAGMA page_size").fetchone()[0]
+
+
+def enable_incremental_vacuum(conn):
+    """Switches an existing database to auto_vacuum=INCREMENTAL. Rewrites the whole file
+    with VACUUM once and needs no other connection writing meanwhile."""
+    conn.commit()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+def storage_stats(conn):
+    """Row counts of the queue and its archive, and the database's size on disk."""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    path = conn.execute("PRAGMA database_list").fetchone()['file']
+    wal_path = path + '-wal'
+    return {
+        'hot': {status: n for status, n in conn.execute("SELECT status, COUNT(*) FROM scheduled_emails GROUP BY status")},
+        'archived': conn.execute("SELECT COUNT(*) FROM scheduled_emails_archive").fetchone()[0],
+        'db_bytes': conn.execute("PRAGMA page_count").fetchone()[0] * page_size,
+        'free_bytes': conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+        'wal_bytes': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+        'incremental_vacuum': conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2,
+    }
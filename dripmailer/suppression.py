@@ -0,0 +1,146 @@
+"""Addresses and domains that are never emailed, checked before every send."""
+import csv
+import io
+import itertools
+import smtplib
+import time
+
+from dripmailer import storage
+from dripmailer.leads import EMAIL_PATTERN
+from dripmailer.ratelimit import PERMANENT, classify_error
+
+# A long-running dispatcher reloads the list this often, to see entries added elsewhere
+RELOAD_SECONDS = 300
+
+# Header names read as the address/domain and the reason when importing a CSV
+VALUE_COLUMNS = ('email', 'address', 'domain', 'value')
+REASON_COLUMNS = ('reason',)
+
+IMPORT_BATCH = 5000
+
+
+def normalize(value):
+    """(value, kind) as stored: a lowercased address or domain, or (None, None) for neither.
+
+    "@example.com" and "example.com" both suppress the whole domain, subdomains included.
+    """
+    value = (value or "").strip().lower()
+    if value.startswith('mailto:'):
+        value = value[len('mailto:'):]
+    local, _, domain = value.rpartition('@')
+    if local:
+        return (value, 'address') if EMAIL_PATTERN.match(value) else (None, None)
+    domain = domain.strip('.')
+    if '.' in domain and EMAIL_PATTERN.match(f"x@{domain}"):
+        return domain, 'domain'
+    return None, None
+
+
+def hard_bounce(error):
+    """The suppression reason when a failed send means the address is refused for good
+    (a 5xx reply to RCPT TO), otherwise None."""
+    if not isinstance(error, smtplib.SMTPRecipientsRefused) or classify_error(error)[0] != PERMANENT:
+        return None
+    code, message = next(iter(error.recipients.values()))
+    if isinstance(message, bytes):
+        message = message.decode('utf-8', 'replace')
+    return f"Hard bounce: {code} {message}"
+
+
+class SuppressionList:
+    """The active suppressions held in memory, so each recipient is checked with a dict lookup
+    or two instead of a query. Entries added through `add` are written to the database and
+    take effect at once; `refresh` picks up ones added by other processes.
+    """
+
+    def __init__(self, addresses=None, domains=None):
+        self.addresses = addresses or {}
+        self.domains = domains or {}
+        self.loaded_at = time.monotonic()
+
+    @classmethod
+    def load(cls, conn, now=None):
+        suppressions = cls()
+        suppressions._read(conn, now)
+        return suppressions
+
+    def _read(self, conn, now=None):
+        addresses, domains = {}, {}
+        for value, kind, reason in storage.active_suppressions(conn, now):
+            (addresses if kind == 'address' else domains)[value] = reason or "Suppressed"
+        self.addresses, self.domains = addresses, domains
+        self.loaded_at = time.monotonic()
+
+    def refresh(self, conn, max_age=RELOAD_SECONDS):
+        """Reloads from the database once the loaded list is more than `max_age` seconds old."""
+        if time.monotonic() - self.loaded_at >= max_age:
+            self._read(conn)
+
+    def __len__(self):
+        return len(self.addresses) + len(self.domains)
+
+    def reason(self, email):
+        """Why `email` must not be emailed, or None if it may be."""
+        email = email.lower()
+        reason = self.addresses.get(email)
+        domain = email.rpartition('@')[2]
+        # A domain entry covers its subdomains too
+        while reason is None and domain:
+            reason = self.domains.get(domain)
+            domain = domain.partition('.')[2]
+        return reason
+
+    def add(self, conn, values, reason, source='manual', expires_at=None):
+        """Suppresses addresses/domains from now on. Returns (added, invalid) counts."""
+        entries, invalid = [], 0
+        for raw in values:
+            value, kind = normalize(raw)
+            if value is None:
+                invalid += 1
+                continue
+            entries.append((value, kind, reason))
+            (self.addresses if kind == 'address' else self.domains)[value] = reason
+        storage.add_suppressions(conn, entries, source, expires_at)
+        return len(entries), invalid
+
+
+def import_csv(conn, fileobj, reason, source='import', expires_at=None, batch_size=IMPORT_BATCH):
+    """Bulk-suppresses the addresses/domains in a CSV file object (text or binary).
+
+    The values come from an email/address/domain/value column, or from the first column
+    when the file has no such header; a reason column overrides `reason` row by row.
+    Rows are written in batches of `batch_size` per transaction. Returns (added, invalid).
+    """
+    if not isinstance(fileobj, io.TextIOBase):
+        fileobj = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+    rows = csv.reader(fileobj)
+    first = next(rows, None)
+    if first is None:
+        return 0, 0
+    header = [c.strip().lower() for c in first]
+    value_col = next((header.index(c) for c in VALUE_COLUMNS if c in header), None)
+    reason_col = next((header.index(c) for c in REASON_COLUMNS if c in header), None)
+    if value_col is None:
+        # No header: the first row is data like the rest
+        value_col = 0
+        rows = itertools.chain([first], rows)
+
+    added = invalid = 0
+    batch = {}
+    for row in rows:
+        if len(row) <= value_col:
+            continue
+        value, kind = normalize(row[value_col])
+        if value is None:
+            invalid += bool(row[value_col].strip())
+            continue
+        row_reason = row[reason_col].strip() if reason_col is not None and len(row) > reason_col else ""
+        # Repeats within a file collapse to one entry; the last one wins
+        batch[value] = (value, kind, row_reason or reason)
+        if len(batch) >= batch_size:
+            added += storage.add_suppressions(conn, batch.values(), source, expires_at)
+            batch = {}
+    if batch:
+        added += storage.add_suppressions(conn, batch.values(), source, expires_at)
+    return added, invalid
+
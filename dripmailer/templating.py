@@ -0,0 +1,64 @@
+import functools
+import re
+
+PLACEHOLDER = re.compile(r'\{([^}]+)\}')
+
+
+def _value(val, fallback):
+    """Same rule the app has always used: None, NaN, blank and the text 'nan' fall back to [var]."""
+    if isinstance(val, str):
+        return val if val.strip() != "" and val.lower() != "nan" else fallback
+    if val is None:
+        return fallback
+    try:
+        if val != val:  # NaN / NaT
+            return fallback
+    except TypeError:  # pd.NA refuses to be truth-tested
+        return fallback
+    text = str(val)
+    return text if text.strip() != "" and text.lower() != "nan" else fallback
+
+
+def falls_back(val):
+    """True when a placeholder with this value would render as its [var] fallback."""
+    return _value(val, None) is None
+
+
+class CompiledTemplate:
+    """A template parsed once into literal text and {field} segments.
+
+    literals always has one more entry than fields, so rendering interleaves them and
+    joins once.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        parts = PLACEHOLDER.split(source)
+        self.literals = parts[0::2]
+        # (lookup key, fallback text) - the key is normalized, the fallback keeps the original spelling
+        self.fields = [(name.lower().strip(), f"[{name}]") for name in parts[1::2]]
+        self.keys = sorted({key for key, _ in self.fields})
+
+    def render(self, row):
+        if not self.fields:
+            return self.source
+        literals = self.literals
+        out = [literals[0]]
+        for i, (key, fallback) in enumerate(self.fields, start=1):
+            out.append(_value(row.get(key, ""), fallback))
+            out.append(literals[i])
+        return "".join(out)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_template(template_str):
+    return CompiledTemplate(template_str)
+
+
+def render_template(template_str, row):
+    return compile_template(template_str).render(row)
+
+
+def render_many(template_str, records):
+    render = compile_template(template_str).render
+    return [render(r) for r in records]
@@ -0,0 +1,145 @@
+"""Background dispatcher for the scheduled_emails queue.
+
+Run next to the Streamlit app (same working directory, so both see campaigns.db):
+
+    python -m dripmailer.worker
+"""
+import argparse
+import signal
+import sys
+import threading
+import time
+from contextlib import closing
+
+from dripmailer import storage
+from dripmailer.dispatcher import Dispatcher
+from dripmailer.metrics import Metrics
+from dripmailer.outbox import OUTBOX_DIR
+from dripmailer.ratelimit import describe_error
+from dripmailer.smtp_pool import SMTP_HOST, SMTP_PORT
+
+# Seconds between archive runs with --archive-days
+ARCHIVE_INTERVAL = 3600
+
+
+def log(message):
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {message}", flush=True)
+
+
+def log_event(event, subject, error):
+    if event == 'login':
+        log(f"Authenticating for account {subject}...")
+    elif event == 'login_failed':
+        log(f"Critical Auth Error for {subject}: {error}")
+    elif event == 'sent':
+        log(f"Sent ID {subject['id']} to {subject['target_email']}")
+    elif event == 'deferred':
+        count, resets_at = error
+        log(f"{subject} is out of quota, deferred {count} emails to {storage.format_ts(resets_at)}")
+    elif event == 'retry':
+        log(f"Will retry ID {subject['id']} to {subject['target_email']}: {describe_error(error)}")
+    elif event == 'suppressed':
+        log(f"Suppressed ID {subject['id']} to {subject['target_email']}: {error}")
+    elif event == 'failed':
+        log(f"Failed ID {subject['id']} to {subject['target_email']}: {describe_error(error)}")
+
+
+def seconds_until_next(conn, poll_interval):
+    next_at = storage.next_due_at(conn)
+    if next_at is None:
+        return poll_interval
+    return min(poll_interval, max(0, next_at - storage.now_ts()))
+
+
+def archive(conn, archive_days):
+    archived = storage.archive_finished(conn, archive_days)
+    if archived:
+        freed = storage.reclaim_space(conn)
+        log(f"Archived {archived} emails finished more than {archive_days} days ago, freed {freed / 1e6:.1f} MB")
+
+
+def run(db_path=storage.DB_PATH, poll_interval=30, batch_size=25, lease_seconds=300,
+        host=SMTP_HOST, port=SMTP_PORT, use_ssl=True, once=False, stop=None, metrics_path=None, archive_days=0,
+        **dispatcher_options):
+    """Drains the queue until `stop` is set, or once. Returns 1 if the last round failed, else 0."""
+    stop = stop or threading.Event()
+    failed = False
+    metrics = Metrics()
+    storage.init_db(db_path)
+    log(f"Dispatcher started on {db_path}")
+    archived_at = 0
+    with closing(storage.connect(db_path)) as conn, Dispatcher(host=host, port=port, use_ssl=use_ssl, metrics=metrics, **dispatcher_options) as dispatcher:
+        while not stop.is_set():
+            try:
+                handled = dispatcher.drain(conn, batch_size, lease_seconds, on_event=log_event)
+                if handled:
+                    log(f"Processed {handled} due emails")
+                    if metrics_path:
+                        metrics.export(metrics_path)
+                if archive_days and time.monotonic() - archived_at >= ARCHIVE_INTERVAL:
+                    archive(conn, archive_days)
+                    archived_at = time.monotonic()
+                wait = seconds_until_next(conn, poll_interval)
+                failed = False
+            except Exception as e:
+                # A locked database or a relay error must not end an unattended worker; rows
+                # left claimed go back to the queue when their lease runs out
+                conn.rollback()
+                log(f"Queue round failed, retrying in {poll_interval:g}s: {e!r}")
+                wait = poll_interval
+                failed = True
+            if once:
+                break
+            stop.wait(wait)
+    log("Dispatcher stopped")
+    return 1 if failed else 0
+
+
+def add_dispatcher_arguments(parser):
+    """Queue and SMTP options shared by the worker and `python -m dripmailer drain-queue`."""
+    parser.add_argument("--db", default=storage.DB_PATH, help="Path to campaigns.db")
+    parser.add_argument("--batch-size", type=int, default=25, help="Rows claimed per transaction")
+    parser.add_argument("--lease", type=int, default=300, help="Seconds before an unfinished claim is retried")
+    parser.add_argument("--host", default=SMTP_HOST)
+    parser.add_argument("--port", type=int, default=SMTP_PORT)
+    parser.add_argument("--no-ssl", action="store_true", help="Plain SMTP instead of SMTPS")
+    parser.add_argument("--account-rate", type=float, default=2.0, help="Max emails/sec per sender account")
+    parser.add_argument("--domain-rate", type=float, default=0, help="Max emails/sec per recipient domain (0 = no limit)")
+    parser.add_argument("--async-smtp", action="store_true", help="Send through the asyncio engine (pipelined, NOOP keep-alive)")
+    parser.add_argument("--max-attempts", type=int, default=5, help="Tries before a temporarily failing email is marked failed")
+    parser.add_argument("--backoff-base", type=float, default=60, help="Seconds of backoff after the first temporary failure")
+    parser.add_argument("--backoff-cap", type=float, default=3600, help="Upper bound on a single backoff, in seconds")
+    parser.add_argument("--metrics", metavar="FILE", help="Write send metrics after each drain: Prometheus text for *.prom, JSON lines otherwise")
+    parser.add_argument("--archive-days", type=int, default=0,
+                        help="Every hour, archive emails finished more than this many days ago (0 = never)")
+    parser.add_argument("--outbox-dir", default=OUTBOX_DIR,
+                        help="Send follow-ups as pre-rendered in the campaign outboxes here, where one was built")
+
+
+def run_options(args):
+    """run() keyword arguments from the options added by add_dispatcher_arguments."""
+    return dict(
+        db_path=args.db, batch_size=args.batch_size, lease_seconds=args.lease, host=args.host, port=args.port,
+        use_ssl=not args.no_ssl, metrics_path=args.metrics,
+        rate_per_account=args.account_rate, domain_rate=args.domain_rate, max_attempts=args.max_attempts,
+        backoff_base=args.backoff_base, backoff_cap=args.backoff_cap, async_smtp=args.async_smtp,
+        archive_days=args.archive_days, outbox_dir=args.outbox_dir,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send due follow-ups from the scheduled_emails queue.")
+    add_dispatcher_arguments(parser)
+    parser.add_argument("--interval", type=float, default=30, help="Max seconds between queue polls")
+    parser.add_argument("--once", action="store_true", help="Drain the queue once and exit")
+    args = parser.parse_args(argv)
+
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+
+    return run(poll_interval=args.interval, once=args.once, stop=stop, **run_options(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
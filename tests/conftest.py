@@ -0,0 +1,60 @@
+import io
+
+import pytest
+
+from benchmarks.smtp_sink import SMTPSink
+from dripmailer import storage
+from dripmailer.leads import spool_csv
+
+
+@pytest.fixture
+def conn(tmp_path):
+    path = str(tmp_path / 'campaigns.db')
+    storage.init_db(path)
+    conn = storage.connect(path)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def queue_email(conn):
+    """Adds a scheduled email, due a minute ago unless `send_at` says otherwise."""
+    def queue_email(target, send_at=None, sender='me@example.com'):
+        conn.execute('''
+            INSERT INTO scheduled_emails (target_email, sender_name, sender_email, sender_password, subject, html_body, send_at)
+            VALUES (?, 'Me', ?, 'secret', 'Hi', '<p>Hello</p>', ?)
+        ''', (target, sender, send_at or storage.now_ts(-60)))
+        conn.commit()
+    return queue_email
+
+
+@pytest.fixture
+def make_campaign(conn):
+    return lambda *args, **kwargs: _make_campaign(conn, *args, **kwargs)
+
+
+@pytest.fixture
+def sink():
+    with SMTPSink() as sink:
+        yield sink
+
+
+@pytest.fixture
+def relay(sink):
+    """Connection arguments for sending to the sink."""
+    return dict(host='127.0.0.1', port=sink.address[1], use_ssl=False)
+
+
+@pytest.fixture
+def pool_options(relay):
+    """SMTPPool arguments for an unthrottled pool sending to the sink."""
+    return dict(workers=2, per_connection_rate=0, global_rate=0, **relay)
+
+
+def _make_campaign(conn, campaign_id='c1', leads=5, followups=1, sender='me@example.com', sender_name='Me'):
+    """Spools `leads` leads and stores a campaign with a main email and `followups` follow-ups."""
+    csv = "email,first_name,last_name,company,role\n" + "".join(f"lead{i}@example.com,First{i},Last,Company {i},Role\n" for i in range(leads))
+    spool_csv(conn, io.BytesIO(csv.encode()), campaign_id)
+    templates = [(0, 'Original', 'Hello {company}', 'Hi {first_name},\n{your_name}', 0)]
+    templates += [(step, f'Follow-up {step}', 'Re: {company}', f'Bump {step}, {{first_name}}', 2 * step) for step in range(1, followups + 1)]
+    return storage.save_campaign(conn, campaign_id, sender_name, sender, 'secret', '', templates)
@@ -0,0 +1,133 @@
+import smtplib
+import time
+
+import pytest
+
+from benchmarks.smtp_sink import SMTPSink
+from dripmailer.aiosmtp import AsyncSessions, AsyncSMTP, AsyncSMTPPool
+from dripmailer.message import Envelope
+
+
+def message(i, data=b"Subject: Hi\r\n\r\nHello\r\n"):
+    return Envelope('me@example.com', f"lead{i}@example.com", data, f"<{i}@example.com>")
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    """Counts the socket writes AsyncSMTP makes, i.e. the client's side of each round-trip."""
+    counted = []
+    write = AsyncSMTP._write
+
+    def counting_write(self, data):
+        counted.append(data)
+        return write(self, data)
+
+    monkeypatch.setattr(AsyncSMTP, '_write', counting_write)
+    return counted
+
+
+@pytest.fixture
+def pipelining_sink():
+    with SMTPSink(pipelining=True) as sink:
+        yield sink
+
+
+def sink_options(sink, **options):
+    return dict(workers=1, per_connection_rate=0, global_rate=0, host='127.0.0.1', port=sink.address[1], use_ssl=False,
+                **options)
+
+
+def send(pool, count, start=0):
+    return list(pool.imap((i, message(i)) for i in range(start, start + count)))
+
+
+def test_pipelined_batch_costs_two_writes_per_message(pipelining_sink, writes):
+    with AsyncSMTPPool('me@example.com', 'secret', **sink_options(pipelining_sink)) as pool:
+        del writes[:]
+        results = send(pool, 5)
+    assert all(error is None for _, error in results)
+    assert pipelining_sink.messages == 5
+    # MAIL, RCPT and DATA in one write, then the dot-stuffed message; plus the closing QUIT
+    assert len(writes) == 5 * 2 + 1
+    assert writes[0] == b"MAIL FROM:<me@example.com>\r\nRCPT TO:<lead0@example.com>\r\nDATA\r\n"
+
+
+@pytest.mark.parametrize('server_pipelining, client_pipelining', [(False, True), (True, False)])
+def test_falls_back_to_one_command_at_a_time(server_pipelining, client_pipelining, writes):
+    with SMTPSink(pipelining=server_pipelining) as sink:
+        with AsyncSMTPPool('me@example.com', 'secret', pipelining=client_pipelining, **sink_options(sink)) as pool:
+            del writes[:]
+            results = send(pool, 3)
+        assert all(error is None for _, error in results)
+        assert sink.messages == 3
+    assert len(writes) == 3 * 4 + 1
+    assert writes[:4] == [b"MAIL FROM:<me@example.com>\r\n", b"RCPT TO:<lead0@example.com>\r\n", b"DATA\r\n", writes[3]]
+
+
+@pytest.mark.parametrize('pipelining', [True, False])
+def test_refused_recipient_does_not_spoil_the_session(pipelining):
+    with SMTPSink(pipelining=pipelining, replies={'lead1@example.com': "550 5.1.1 User unknown"}) as sink:
+        with AsyncSMTPPool('me@example.com', 'secret', **sink_options(sink)) as pool:
+            results = dict(send(pool, 3))
+        assert isinstance(results[1], smtplib.SMTPRecipientsRefused)
+        assert results[1].recipients == {'lead1@example.com': (550, b"5.1.1 User unknown")}
+        assert results[0] is None and results[2] is None
+        assert sink.messages == 2 and sink.logins == 1
+        # A pipelined DATA after the refused RCPT is never answered with 354 by the sink
+        assert sink.commands['RSET'] == 1
+
+
+def test_dot_lines_survive_the_pipelined_data(pipelining_sink):
+    data = b"Subject: Hi\r\n\r\n.\r\n..two\r\n.three"
+    with AsyncSMTPPool('me@example.com', 'secret', **sink_options(pipelining_sink)) as pool:
+        [(_, error)] = list(pool.imap([(0, message(0, data))]))
+    assert error is None
+    # The sink counts bytes up to the terminating dot; every leading dot was doubled
+    assert pipelining_sink.bytes == len(b"Subject: Hi\r\n\r\n..\r\n...two\r\n..three\r\n")
+
+
+def test_idle_pool_connection_sends_noop_and_keeps_its_login(pipelining_sink):
+    with AsyncSMTPPool('me@example.com', 'secret', keepalive=0.05, **sink_options(pipelining_sink)) as pool:
+        send(pool, 1)
+        time.sleep(0.3)
+        send(pool, 1, start=1)
+    assert pipelining_sink.commands['NOOP'] >= 2
+    assert pipelining_sink.messages == 2 and pipelining_sink.logins == 1
+
+
+def test_dropped_pool_connection_reconnects_on_the_next_send(pipelining_sink):
+    pipelining_sink.replies['lead0@example.com'] = "421 4.7.0 Closing connection"
+    with AsyncSMTPPool('me@example.com', 'secret', max_retries=0, **sink_options(pipelining_sink)) as pool:
+        results = dict(send(pool, 2))
+    assert isinstance(results[0], smtplib.SMTPRecipientsRefused) and results[1] is None
+    assert pipelining_sink.logins == 2
+
+
+@pytest.mark.parametrize('pipelining', [True, False])
+def test_async_sessions_stay_logged_in_between_sends(pipelining):
+    with SMTPSink(pipelining=pipelining) as sink:
+        sessions = AsyncSessions('127.0.0.1', sink.address[1], use_ssl=False, keepalive=0.05, pipelining=pipelining)
+        try:
+            for i in range(2):
+                envelope = message(i)
+                sessions.session('me@example.com', 'secret').sendmail(envelope.sender, [envelope.recipient], envelope.data)
+                time.sleep(0.2)
+        finally:
+            sessions.close()
+        assert sink.messages == 2 and sink.logins == 1
+        assert sink.commands['NOOP'] >= 2
+        assert sink.commands['QUIT'] == 1
+
+
+def test_async_sessions_quit_after_max_idle(pipelining_sink):
+    sessions = AsyncSessions('127.0.0.1', pipelining_sink.address[1], use_ssl=False, keepalive=0.05, max_idle=0.1)
+    try:
+        sessions.session('me@example.com', 'secret')
+        time.sleep(0.4)
+        assert pipelining_sink.commands['QUIT'] == 1
+        # The next send logs in again
+        envelope = message(0)
+        sessions.session('me@example.com', 'secret').sendmail(envelope.sender, [envelope.recipient], envelope.data)
+    finally:
+        sessions.close()
+    assert pipelining_sink.messages == 1 and pipelining_sink.logins == 2
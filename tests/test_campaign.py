@@ -0,0 +1,77 @@
+import pytest
+
+from dripmailer import storage
+from dripmailer.campaign import CampaignRunner
+from dripmailer.smtp_pool import SMTPPool
+
+
+class Interrupted(Exception):
+    pass
+
+
+def stop_after(sends):
+    sent = []
+
+    def on_event(event, subject, detail):
+        if event == 'sent':
+            sent.append(subject['email'])
+            if len(sent) == sends:
+                raise Interrupted()
+    return on_event
+
+
+def followup_statuses(conn):
+    return dict(conn.execute("SELECT target_email, status FROM scheduled_emails").fetchall())
+
+
+def test_resume_after_an_interrupt_sends_each_lead_once(conn, sink, pool_options, make_campaign):
+    make_campaign(leads=30)
+    with SMTPPool('me@example.com', 'secret', **pool_options) as pool:
+        with pytest.raises(Interrupted):
+            CampaignRunner(conn, 'c1', checkpoint_every=4).run(pool, on_event=stop_after(8))
+
+    counts = storage.lead_status_counts(conn, 'c1')
+    # Sends still in flight when it stopped were recorded too; nothing is left claimed
+    assert 'sending' not in counts
+    assert counts['sent'] == sink.messages >= 8
+    assert counts['sent'] + counts['pending'] == 30
+    assert [c['id'] for c in storage.unfinished_campaigns(conn)] == ['c1']
+
+    with SMTPPool('me@example.com', 'secret', **pool_options) as pool:
+        assert CampaignRunner(conn, 'c1').run(pool) == {'sent': 30}
+    assert sink.messages == 30
+    assert storage.get_campaign(conn, 'c1')['status'] == 'completed'
+    # Every sent lead got its follow-up, including the one whose 'sent' event stopped the run
+    assert conn.execute("SELECT COUNT(DISTINCT target_email) FROM scheduled_emails WHERE status = 'pending'").fetchone()[0] == 30
+
+
+def test_leads_left_sending_by_a_crash_are_set_aside_with_their_followups(conn, sink, pool_options, make_campaign):
+    template_ids = make_campaign(leads=6)
+    # A run that pre-scheduled the follow-ups and was killed with two sends in flight
+    storage.enqueue_followups(conn, [storage.followup_row('c1', f"lead{i}@example.com", template_ids[1], {}, storage.now_ts(86400), 1)
+                                     for i in range(6)])
+    conn.execute("UPDATE leads SET status = 'sending' WHERE email IN ('lead0@example.com', 'lead1@example.com')")
+    conn.commit()
+
+    with SMTPPool('me@example.com', 'secret', **pool_options) as pool:
+        counts = CampaignRunner(conn, 'c1').run(pool)
+    assert counts == {'sent': 4, 'unconfirmed': 2}
+    assert sink.messages == 4
+    followups = followup_statuses(conn)
+    assert followups['lead0@example.com'] == followups['lead1@example.com'] == 'cancelled'
+    assert sum(status == 'pending' for status in followups.values()) == 4
+
+
+def test_abandoning_a_campaign_cancels_followups_of_leads_not_yet_sent(conn, make_campaign):
+    template_ids = make_campaign(leads=3)
+    storage.enqueue_followups(conn, [storage.followup_row('c1', f"lead{i}@example.com", template_ids[1], {}, storage.now_ts(86400), 1)
+                                     for i in range(3)])
+    conn.execute("UPDATE leads SET status = 'sent' WHERE email = 'lead0@example.com'")
+    conn.execute("UPDATE leads SET status = 'failed' WHERE email = 'lead1@example.com'")
+    conn.commit()
+
+    # Pending leads may still be resumed, so only the failed lead's follow-up goes
+    assert storage.cancel_unsent_followups(conn, 'c1') == 1
+    storage.finish_campaign(conn, 'c1', status='abandoned')
+    assert followup_statuses(conn) == {'lead0@example.com': 'pending', 'lead1@example.com': 'cancelled', 'lead2@example.com': 'cancelled'}
+    assert storage.unfinished_campaigns(conn) == []
@@ -0,0 +1,106 @@
+import argparse
+
+import pytest
+
+from dripmailer import cli, storage, worker
+from dripmailer.dispatcher import Dispatcher
+
+
+@pytest.fixture(autouse=True)
+def keep_signal_handlers(monkeypatch):
+    # cli and worker install SIGTERM/SIGINT handlers meant for a standalone process
+    monkeypatch.setattr('signal.signal', lambda *args: None)
+
+
+@pytest.fixture
+def db(conn, tmp_path):
+    return str(tmp_path / 'campaigns.db')
+
+
+@pytest.fixture
+def relay_args(relay):
+    return ['--host', relay['host'], '--port', str(relay['port']), '--no-ssl']
+
+
+@pytest.fixture
+def campaign_files(tmp_path, monkeypatch):
+    monkeypatch.setenv('DRIPMAILER_PASSWORD', 'secret')
+    leads = tmp_path / 'leads.csv'
+    leads.write_text("email,first_name,last_name,company,role\n"
+                     + "".join(f"lead{i}@example.com,First{i},Last,Company {i},Role\n" for i in range(5))
+                     + "not-an-address,Bad,Row,X,Y\n")
+    intro = tmp_path / 'intro.txt'
+    intro.write_text("Subject: Hello {company}\n\nHi {first_name},\n{your_name}\n")
+    bump = tmp_path / 'bump.txt'
+    bump.write_text("Subject: Re: Hello {company}\n\nJust checking in, {first_name}\n")
+    return ['--leads', str(leads), '--template', str(intro), '--followup', f"4:{bump}",
+            '--email', 'me@example.com', '--log', str(tmp_path / 'log.csv'), '--workers', '2',
+            '--connection-rate', '0', '--rate', '0']
+
+
+def test_followup_spec():
+    assert cli.followup_spec("4:bump.txt") == (4, "bump.txt")
+    for bad in ("bump.txt", "0:bump.txt", "x:bump.txt"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            cli.followup_spec(bad)
+
+
+@pytest.mark.parametrize('argv', [
+    [],
+    ['send'],
+    ['send', '--leads', 'leads.csv'],
+    ['send', '--leads', 'leads.csv', '--template', 'intro.txt', '--followup', 'soon:bump.txt'],
+    ['drain-queue', '--port', 'smtp'],
+])
+def test_invalid_arguments_exit_with_usage_error(argv, capsys):
+    with pytest.raises(SystemExit) as exc:
+        cli.main(argv)
+    assert exc.value.code == 2
+    assert "usage:" in capsys.readouterr().err
+
+
+def test_send_delivers_the_campaign_and_queues_followups(db, conn, sink, relay_args, campaign_files, tmp_path, capsys):
+    assert cli.main(['send', '--db', db, *campaign_files, *relay_args]) == 0
+    assert sink.messages == 5
+    [campaign] = conn.execute("SELECT * FROM campaigns").fetchall()
+    assert campaign['status'] == 'completed'
+    assert storage.lead_status_counts(conn, campaign['id']) == {'sent': 5}
+    assert conn.execute("SELECT COUNT(*) FROM scheduled_emails WHERE status = 'pending'").fetchone()[0] == 5
+    output = capsys.readouterr().out
+    assert "5 valid leads, 1 rows skipped" in output and "Done: 5 sent" in output
+    assert "Sent Main Email" in (tmp_path / 'log.csv').read_text()
+
+
+def test_send_exit_codes(db, conn, sink, relay_args, campaign_files, tmp_path):
+    # A template without its Subject line is a usage problem, reported before anything is stored
+    bad_template = tmp_path / 'bad.txt'
+    bad_template.write_text("Hi {first_name}\n")
+    argv = ['send', '--db', db, *campaign_files, *relay_args]
+    assert cli.main(argv + ['--template', str(bad_template)]) == 2
+    assert cli.main(['send', '--db', db, '--resume', 'nope', *relay_args]) == 2
+
+    # A refused login leaves neither a campaign nor its spooled leads behind
+    sink.refuse_login = True
+    assert cli.main(argv) == 1
+    assert conn.execute("SELECT COUNT(*) FROM campaigns").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM leads").fetchone()[0] == 0
+    assert sink.messages == 0
+
+
+def test_drain_queue_sends_due_rows(db, conn, sink, relay_args, queue_email):
+    for i in range(3):
+        queue_email(f"lead{i}@example.com")
+    queue_email('later@example.com', send_at=storage.now_ts(3600))
+    assert cli.main(['drain-queue', '--db', db, '--account-rate', '0', *relay_args]) == 0
+    assert sink.messages == 3
+    assert conn.execute("SELECT COUNT(*) FROM scheduled_emails WHERE status = 'sent'").fetchone()[0] == 3
+    assert worker.main(['--db', db, '--once', *relay_args]) == 0
+
+
+def test_drain_queue_and_worker_report_a_failed_round(db, relay_args, monkeypatch):
+    def drain(self, *args, **kwargs):
+        raise OSError("relay unreachable")
+
+    monkeypatch.setattr(Dispatcher, 'drain', drain)
+    assert cli.main(['drain-queue', '--db', db, *relay_args]) == 1
+    assert worker.main(['--db', db, '--once', *relay_args]) == 1
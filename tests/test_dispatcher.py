@@ -0,0 +1,104 @@
+import pytest
+
+from dripmailer import storage
+from dripmailer.dispatcher import Dispatcher
+
+THROTTLED = "421 4.7.0 Too many messages, slow down"
+GREYLISTED = "451 4.7.1 Greylisted, try again later"
+UNKNOWN_USER = "550 5.1.1 User unknown"
+
+
+def statuses(conn):
+    return dict(conn.execute("SELECT target_email, status FROM scheduled_emails").fetchall())
+
+
+def row_state(conn, target):
+    return tuple(conn.execute("SELECT status, attempts, send_at, last_error FROM scheduled_emails WHERE target_email = ?",
+                              (target,)).fetchone())
+
+
+def dispatch_due(dispatcher, conn, on_event=None):
+    return dispatcher.dispatch(conn, storage.claim_due(conn, 50, 300), on_event)
+
+
+def test_drain_sends_due_rows_over_one_session_per_account(conn, sink, relay, queue_email):
+    for i in range(3):
+        queue_email(f"lead{i}@example.com")
+    queue_email('other@example.com', sender='other@example.com')
+    queue_email('later@example.com', send_at=storage.now_ts(3600))
+    sink.replies['lead2@example.com'] = UNKNOWN_USER
+
+    with Dispatcher(rate_per_account=0, **relay) as dispatcher:
+        assert dispatcher.drain(conn) == 4
+    assert statuses(conn) == {'lead0@example.com': 'sent', 'lead1@example.com': 'sent', 'lead2@example.com': 'failed',
+                              'other@example.com': 'sent', 'later@example.com': 'pending'}
+    assert sink.logins == 2
+    assert sink.messages == 3
+
+
+def test_rows_of_an_account_that_cannot_log_in_go_back_to_the_queue(conn, sink, relay, queue_email):
+    queue_email('lead0@example.com')
+    sink.refuse_login = True
+    events = []
+    with Dispatcher(rate_per_account=0, **relay) as dispatcher:
+        assert dispatcher.drain(conn, on_event=lambda event, subject, error: events.append(event)) == 0
+    assert events == ['login', 'login_failed']
+    assert statuses(conn) == {'lead0@example.com': 'pending'}
+
+
+@pytest.mark.parametrize('reply', [THROTTLED, GREYLISTED])
+def test_temporary_failure_is_rescheduled_with_backoff(conn, sink, relay, queue_email, reply):
+    queue_email('lead0@example.com')
+    sink.replies['lead0@example.com'] = reply
+    events = []
+    with Dispatcher(rate_per_account=0, backoff_base=10, **relay) as dispatcher:
+        before = storage.now_ts()
+        dispatch_due(dispatcher, conn, on_event=lambda event, subject, error: events.append(event))
+    status, attempts, send_at, last_error = row_state(conn, 'lead0@example.com')
+    assert (status, attempts) == ('pending', 1)
+    # Full jitter over base * 2**0 for the first retry
+    assert before <= send_at <= storage.now_ts(10)
+    assert last_error.startswith(f"Temporary {reply[:3]}")
+    assert events[-1] == 'retry'
+    assert sink.messages == 0
+
+
+def test_retries_stop_at_max_attempts(conn, sink, relay, queue_email):
+    queue_email('lead0@example.com')
+    sink.replies['lead0@example.com'] = GREYLISTED
+    with Dispatcher(rate_per_account=0, max_attempts=3, backoff_base=0, **relay) as dispatcher:
+        for expected in (1, 2):
+            dispatch_due(dispatcher, conn)
+            assert row_state(conn, 'lead0@example.com')[:2] == ('pending', expected)
+        dispatch_due(dispatcher, conn)
+    status, attempts, _, last_error = row_state(conn, 'lead0@example.com')
+    assert (status, attempts) == ('failed', 2)
+    assert last_error.startswith("Temporary 451")
+
+
+def test_permanent_failure_is_not_retried(conn, sink, relay, queue_email):
+    queue_email('lead0@example.com')
+    sink.replies['lead0@example.com'] = UNKNOWN_USER
+    with Dispatcher(rate_per_account=0, **relay) as dispatcher:
+        dispatch_due(dispatcher, conn)
+        assert storage.claim_due(conn, 50, 300) == []
+    status, attempts, _, last_error = row_state(conn, 'lead0@example.com')
+    assert (status, attempts) == ('failed', 0)
+    assert last_error.startswith("Permanent 550")
+
+
+def test_throttling_slows_the_account_and_domain_down(conn, sink, relay, queue_email):
+    queue_email('lead0@example.com')
+    queue_email('lead1@example.com')
+    sink.replies['lead0@example.com'] = THROTTLED
+    with Dispatcher(rate_per_account=100, domain_rate=50, **relay) as dispatcher:
+        dispatch_due(dispatcher, conn)
+        account = dispatcher._accounts.get('me@example.com')
+        domain = dispatcher._domains.get('example.com')
+        # Halved by the 421, then one additive step back up for lead1's success
+        assert account.rate == pytest.approx(50 + 100 * account.recovery)
+        assert domain.rate == pytest.approx(25 + 50 * domain.recovery)
+    # The relay closed the session after its 421, so lead1 went out over a fresh login
+    assert sink.logins == 2
+    assert row_state(conn, 'lead1@example.com')[0] == 'sent'
+    assert sink.messages == 1
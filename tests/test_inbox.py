@@ -0,0 +1,81 @@
+import pytest
+
+from benchmarks.imap_mailbox import IMAPMailbox, bounce_message, reply_message
+from dripmailer import storage
+from dripmailer.campaign import CampaignRunner
+from dripmailer.inbox import InboxScanner, classify
+from dripmailer.smtp_pool import SMTPPool
+from dripmailer.suppression import SuppressionList
+
+
+@pytest.fixture
+def sent(conn, sink, pool_options, make_campaign):
+    """Message-ID of each lead's main email, sent with one follow-up queued per lead."""
+    make_campaign(leads=5)
+    with SMTPPool('me@example.com', 'secret', **pool_options) as pool:
+        CampaignRunner(conn, 'c1').run(pool)
+    return dict(conn.execute("SELECT email, message_id FROM leads").fetchall())
+
+
+@pytest.fixture
+def mailbox():
+    with IMAPMailbox(uidvalidity=7) as mailbox:
+        yield mailbox
+
+
+@pytest.fixture
+def scanner(mailbox):
+    return InboxScanner('me@example.com', 'secret', host='127.0.0.1', port=mailbox.address[1], use_ssl=False)
+
+
+def test_classify_replies_and_bounces():
+    assert classify(reply_message('<a@example.com>')) == ('replied', ['<a@example.com>', '<a@example.com>'])
+    assert classify(reply_message('<a@example.com>', auto=True)) == (None, [])
+    assert classify(bounce_message('<b@example.com>')) == ('bounced', ['<b@example.com>'])
+    assert classify(bounce_message('<b@example.com>', action='delayed')) == (None, [])
+
+
+def test_scan_stops_followups_of_leads_who_replied_or_bounced(conn, sent, mailbox, scanner):
+    mailbox.deliver(reply_message(sent['lead0@example.com']))
+    mailbox.deliver(reply_message(sent['lead1@example.com'], auto=True))
+    mailbox.deliver(bounce_message(sent['lead2@example.com']))
+    mailbox.deliver(bounce_message(sent['lead3@example.com'], action='delayed'))
+    mailbox.deliver(reply_message('<unknown@example.com>'))
+
+    assert scanner.scan(conn) == {'messages': 5, 'replied': 1, 'bounced': 1, 'cancelled': 2}
+    responses = dict(conn.execute("SELECT email, response FROM leads").fetchall())
+    assert responses == {'lead0@example.com': 'replied', 'lead1@example.com': None, 'lead2@example.com': 'bounced',
+                         'lead3@example.com': None, 'lead4@example.com': None}
+    pending = {r[0] for r in conn.execute("SELECT target_email FROM scheduled_emails WHERE status = 'pending'")}
+    assert pending == {'lead1@example.com', 'lead3@example.com', 'lead4@example.com'}
+    assert SuppressionList.load(conn).reason('lead2@example.com')
+
+
+def test_scan_only_fetches_messages_past_the_checkpoint(conn, sent, mailbox, scanner):
+    mailbox.deliver(reply_message(sent['lead0@example.com']))
+    scanner.scan(conn)
+    checkpoint = storage.get_mailbox_checkpoint(conn, scanner.checkpoint_key)
+    assert (checkpoint['uidvalidity'], checkpoint['last_uid']) == (7, 1)
+
+    # "2:*" still matches UID 1 on the server; the scanner must not count it again
+    assert scanner.scan(conn)['messages'] == 0
+    assert mailbox.fetched == 1
+
+    mailbox.deliver(reply_message(sent['lead1@example.com']))
+    assert scanner.scan(conn) == {'messages': 1, 'replied': 1, 'bounced': 0, 'cancelled': 1}
+    assert storage.get_mailbox_checkpoint(conn, scanner.checkpoint_key)['last_uid'] == 2
+
+
+def test_new_uidvalidity_rescans_recent_messages(conn, sent, mailbox, scanner):
+    mailbox.deliver(reply_message(sent['lead0@example.com']))
+    mailbox.deliver(reply_message(sent['lead1@example.com']))
+    scanner.scan(conn)
+
+    mailbox.rebuild(uidvalidity=8)
+    mailbox.deliver(bounce_message(sent['lead2@example.com']))
+    mailbox.commands.clear()
+    # UIDs restart under the new UIDVALIDITY: everything recent is read again, matching twice is harmless
+    assert scanner.scan(conn) == {'messages': 3, 'replied': 2, 'bounced': 1, 'cancelled': 1}
+    assert any('SINCE' in command for command in mailbox.commands)
+    checkpoint = storage.get_mailbox_checkpoint(conn, scanner.checkpoint_key)
+    assert (checkpoint['uidvalidity'], checkpoint['last_uid']) == (8, 3)
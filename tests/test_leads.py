@@ -0,0 +1,18 @@
+import pandas as pd
+
+from dripmailer.leads import missing_columns, normalize_columns, prepare_leads
+
+
+def test_prepare_leads_cleans_and_rejects_in_one_pass():
+    df = normalize_columns(pd.DataFrame({
+        ' Email ': [' Ann@Example.com ', 'bad-address', None, 'ann@example.com', 'bob@example.com'],
+        'First_Name': ['Ann', 'X', 'Y', 'Ann again', float('nan')],
+    }))
+    records, rejected = prepare_leads(df)
+    assert records == [{'email': 'ann@example.com', 'first_name': 'Ann'}, {'email': 'bob@example.com', 'first_name': ''}]
+    assert rejected[['row', 'reason']].to_dict('records') == [
+        {'row': 2, 'reason': "Invalid email"}, {'row': 3, 'reason': "Missing email"}, {'row': 4, 'reason': "Duplicate email"}]
+
+
+def test_missing_columns():
+    assert missing_columns(['email', 'first_name', 'last_name']) == ['role', 'company']
@@ -0,0 +1,77 @@
+import email
+from email import policy
+from email.utils import parseaddr
+
+import pytest
+
+from dripmailer.message import MessageFactory
+
+LONG_LINE = "This line is deliberately longer than seventy-six characters so quoted-printable has to soft-break it somewhere"
+SUBJECT = "Grüße – a very long subject line that certainly needs folding over more than one header line"
+BODY = "\n".join([
+    "Hi Zoë,",
+    LONG_LINE,
+    "Trailing spaces stay   ",
+    "Trailing tab\t",
+    ".A line that starts with a dot",
+    ".",
+    "Ünïcödé ✓ and = signs",
+])
+
+
+def parse(envelope):
+    return email.message_from_bytes(envelope.data, policy=policy.default)
+
+
+def parts(msg):
+    text, html = msg.get_payload()
+    return text, html
+
+
+def content(part):
+    # Line breaks inside a MIME text part are CRLF on the wire
+    return part.get_content().replace("\r\n", "\n")
+
+
+@pytest.fixture
+def factory():
+    return MessageFactory("Jürgen Müller", "jurgen@example.com", signature_html="<p>Jürgen<br>Acme ✓</p>")
+
+
+def test_build_round_trips_headers_and_both_parts(factory):
+    envelope = factory.build("lead@example.com", SUBJECT, BODY)
+    assert envelope.sender == "jurgen@example.com" and envelope.recipient == "lead@example.com"
+    msg = parse(envelope)
+    assert msg['Subject'] == SUBJECT
+    assert parseaddr(str(msg['From'])) == ("Jürgen Müller", "jurgen@example.com")
+    assert msg['To'] == "lead@example.com"
+    assert msg['Message-ID'] == envelope.message_id
+    assert msg.get_content_type() == 'multipart/alternative'
+    text, html = parts(msg)
+    assert text.get_content_type() == 'text/plain' and html.get_content_type() == 'text/html'
+    assert content(text) == BODY + "\n\nJürgen\nAcme ✓"
+    assert content(html) == BODY.replace("\n", "<br>") + "<br><br><p>Jürgen<br>Acme ✓</p>"
+
+
+def test_wire_format_is_safe_for_smtp(factory):
+    data = factory.build("lead@example.com", SUBJECT, BODY).data
+    lines = data.split(b"\r\n")
+    assert all(len(line) <= 78 for line in lines)
+    # No bare LF, and no trailing whitespace for a relay to strip in transit
+    assert b"\n" not in data.replace(b"\r\n", b"")
+    assert not any(line.endswith((b" ", b"\t")) for line in lines)
+
+
+def test_build_html_round_trips(factory):
+    html_body = "<p>Hallo Zoë,</p><p>" + LONG_LINE + "</p>\n.<br>Bye   "
+    msg = parse(factory.build_html("lead@example.com", "Ünïcödé", html_body))
+    assert msg['Subject'] == "Ünïcödé"
+    assert msg['To'] == "lead@example.com"
+    text, html = parts(msg)
+    assert content(html) == html_body
+    assert content(text) == "Hallo Zoë,\n\n" + LONG_LINE + "\n\n.\nBye"
+
+
+def test_messages_get_distinct_ids(factory):
+    ids = {factory.build("lead@example.com", "Hi", "Hello").message_id for _ in range(100)}
+    assert len(ids) == 100
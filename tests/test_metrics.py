@@ -0,0 +1,103 @@
+import json
+import re
+
+import pytest
+
+from dripmailer.dispatcher import Dispatcher
+from dripmailer.metrics import Histogram, Metrics
+
+SAMPLE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+
+
+def parse_prometheus(text):
+    """{(name, labels): value} for every sample line, plus {name: type} from the TYPE comments."""
+    samples, types = {}, {}
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ')
+            types[name] = kind
+            continue
+        name, labels, value = SAMPLE.match(line).groups()
+        labels = tuple(re.findall(r'(\w+)="([^"]*)"', labels or ""))
+        samples[(name, labels)] = float(value)
+    return samples, types
+
+
+@pytest.fixture
+def metrics():
+    metrics = Metrics()
+    for seconds in (0.002, 0.002, 0.02, 0.2):
+        metrics.observe('smtp_send', seconds)
+    metrics.observe('render', 0.0001)
+    metrics.count('retries_total', code=451)
+    metrics.count('retries_total', 2, code=451)
+    metrics.message_done(True)
+    metrics.message_done(True)
+    metrics.message_done(False)
+    return metrics
+
+
+def test_prometheus_export_parses(metrics, tmp_path):
+    path = str(tmp_path / 'dripmailer.prom')
+    metrics.export(path)
+    with open(path) as f:
+        samples, types = parse_prometheus(f.read())
+
+    assert types == {'dripmailer_stage_seconds': 'histogram', 'dripmailer_messages_total': 'counter',
+                     'dripmailer_retries_total': 'counter'}
+    buckets = [(labels[1][1], value) for (name, labels), value in samples.items()
+               if name == 'dripmailer_stage_seconds_bucket' and labels[0] == ('stage', 'smtp_send')]
+    counts = [value for _, value in buckets]
+    assert counts == sorted(counts) and buckets[-1] == ('+Inf', 4)
+    assert dict(buckets)['0.0025'] == 2 and dict(buckets)['0.025'] == 3
+    assert samples[('dripmailer_stage_seconds_count', (('stage', 'smtp_send'),))] == 4
+    assert samples[('dripmailer_stage_seconds_sum', (('stage', 'smtp_send'),))] == pytest.approx(0.224)
+    assert samples[('dripmailer_stage_seconds_count', (('stage', 'render'),))] == 1
+    assert samples[('dripmailer_messages_total', (('result', 'sent'),))] == 2
+    assert samples[('dripmailer_messages_total', (('result', 'failed'),))] == 1
+    assert samples[('dripmailer_retries_total', (('code', '451'),))] == 3
+
+
+def test_json_export_appends_one_snapshot_per_call(metrics, tmp_path):
+    path = str(tmp_path / 'metrics.jsonl')
+    metrics.export(path)
+    metrics.observe('smtp_send', 0.002)
+    metrics.export(path)
+    with open(path) as f:
+        first, second = [json.loads(line) for line in f]
+
+    assert first['messages'] == second['messages'] == 3
+    assert list(first['stages']) == ['render', 'smtp_send']
+    assert first['stages']['smtp_send']['count'] == 4 and second['stages']['smtp_send']['count'] == 5
+    assert first['stages']['smtp_send']['max_ms'] == 200.0
+    assert {'name': 'retries_total', 'labels': {'code': 451}, 'value': 3} in first['counters']
+    assert second['timestamp'] >= first['timestamp']
+
+
+def test_histogram_quantiles_stay_within_observed_range():
+    histogram = Histogram()
+    for ms in range(1, 101):
+        histogram.observe(ms / 1000)
+    assert 0.04 <= histogram.quantile(0.5) <= 0.06
+    assert histogram.quantile(0.99) <= histogram.max == 0.1
+    assert Histogram().quantile(0.5) == 0.0
+
+
+def test_a_drain_records_every_stage_it_goes_through(conn, sink, relay, queue_email, tmp_path):
+    for i in range(3):
+        queue_email(f"lead{i}@example.com")
+    sink.replies['lead2@example.com'] = "550 5.1.1 User unknown"
+    metrics = Metrics()
+    with Dispatcher(rate_per_account=0, metrics=metrics, **relay) as dispatcher:
+        dispatcher.drain(conn)
+
+    path = str(tmp_path / 'drain.prom')
+    metrics.export(path)
+    with open(path) as f:
+        samples, _ = parse_prometheus(f.read())
+    stage_counts = {labels[0][1]: value for (name, labels), value in samples.items() if name == 'dripmailer_stage_seconds_count'}
+    assert stage_counts['smtp_login'] == 1
+    assert stage_counts['smtp_send'] == stage_counts['mime_build'] == stage_counts['message'] == 3
+    assert stage_counts['db_claim'] >= 1 and stage_counts['db_write'] >= 3
+    assert samples[('dripmailer_messages_total', (('result', 'sent'),))] == 2
+    assert samples[('dripmailer_smtp_errors_total', (('code', '550'),))] == 1
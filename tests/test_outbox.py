@@ -0,0 +1,56 @@
+import collections
+
+import pytest
+
+from dripmailer import outbox
+from dripmailer.campaign import CampaignRunner
+from dripmailer.metrics import Metrics
+from dripmailer.smtp_pool import SMTPPool
+
+
+@pytest.fixture
+def built(conn, tmp_path, make_campaign):
+    make_campaign(leads=6)
+    path = outbox.outbox_path('c1', str(tmp_path))
+    stats = outbox.build(conn, 'c1', path, workers=1)
+    with outbox.Outbox(path) as box:
+        yield stats, box
+
+
+def test_build_renders_every_step_of_every_pending_lead(built):
+    stats, box = built
+    assert stats['leads'] == 6 and stats['messages'] == len(box) == 12
+    entry = box.get('lead2@example.com', 1)
+    assert entry.sender == 'me@example.com'
+    assert "Subject: Re: Company 2" in outbox.describe(box.raw(entry))
+    # The Date header is stamped again on the way out, the rest is sent as spooled
+    envelope = box.envelope(entry)
+    assert len(envelope.data) == entry.length and envelope.message_id == entry.message_id
+
+
+def test_send_uses_spooled_messages_only_while_their_digest_matches(conn, built, sink, pool_options):
+    _, box = built
+    conn.execute("UPDATE leads SET data = json_set(data, '$.first_name', 'Edited') WHERE email = 'lead3@example.com'")
+    conn.commit()
+    metrics = Metrics()
+    with SMTPPool('me@example.com', 'secret', **pool_options) as pool:
+        assert CampaignRunner(conn, 'c1', metrics=metrics, outbox=box).run(pool) == {'sent': 6}
+    outcomes = {c['labels']['result']: c['value'] for c in metrics.snapshot()['counters'] if c['name'] == 'outbox_messages_total'}
+    assert outcomes == {'hit': 5, 'stale': 1}
+    sent = dict(conn.execute("SELECT email, message_id FROM leads").fetchall())
+    assert sent['lead3@example.com'] != box.get('lead3@example.com', 0).message_id
+    assert sent['lead1@example.com'] == box.get('lead1@example.com', 0).message_id
+
+
+def test_diff_reports_only_messages_whose_inputs_changed(conn, tmp_path, built):
+    _, box = built
+    conn.execute("UPDATE campaign_templates SET body = 'Bump again {first_name}' WHERE step = 1")
+    conn.execute("DELETE FROM leads WHERE email = 'lead5@example.com'")
+    conn.commit()
+    path = outbox.outbox_path('c1', str(tmp_path / 'new'))
+    outbox.build(conn, 'c1', path, workers=1)
+    with outbox.Outbox(path) as new:
+        changes = list(outbox.diff(box, new))
+    assert collections.Counter((step, change) for _, step, change, _ in changes) == {(1, 'changed'): 5, (0, 'removed'): 1, (1, 'removed'): 1}
+    lines = next(lines for email, step, change, lines in changes if change == 'changed')
+    assert any(line.startswith('+Bump again') for line in lines)
@@ -0,0 +1,45 @@
+import collections
+import datetime
+
+import pytest
+
+from dripmailer import storage
+from dripmailer.planner import SendPlanner, parse_holidays
+
+EVERY_DAY = range(7)
+
+
+def test_capacity_spreads_followups_and_spills_into_the_next_day(conn):
+    planner = SendPlanner(conn, capacity=2, start_hour=9, end_hour=11, workdays=EVERY_DAY)
+    times = [planner(1, sender='me@example.com') for _ in range(5)]
+    per_hour = collections.Counter((t.date(), t.hour) for t in times)
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    assert per_hour == {(tomorrow, 9): 2, (tomorrow, 10): 2, (tomorrow + datetime.timedelta(days=1), 9): 1}
+    assert planner.overbooked == 0
+
+
+def test_capacity_counts_emails_already_queued(conn):
+    planner = SendPlanner(conn, capacity=1, start_hour=9, end_hour=10, workdays=EVERY_DAY)
+    first = planner(1, sender='me@example.com')
+    # A second planner (a later run) sees that hour taken by the queued row
+    storage.save_campaign(conn, 'c1', 'Me', 'me@example.com', 'secret', '', [(0, 'Original', 'Hi', 'Hello', 0)])
+    storage.enqueue_followups(conn, [storage.followup_row('c1', 'lead@example.com', 1, {}, storage.to_epoch(first), 1)])
+    conn.commit()
+    second = SendPlanner(conn, capacity=1, start_hour=9, end_hour=10, workdays=EVERY_DAY)(1, sender='me@example.com')
+    assert second.date() == first.date() + datetime.timedelta(days=1)
+
+
+def test_weekends_and_holidays_are_skipped(conn):
+    today = datetime.date.today()
+    holiday = today + datetime.timedelta(days=1)
+    planner = SendPlanner(conn, holidays={holiday}, workdays=EVERY_DAY)
+    assert planner(1).date() == holiday + datetime.timedelta(days=1)
+    weekdays = SendPlanner(conn)
+    assert all(weekdays(days).weekday() < 5 for days in range(1, 8))
+
+
+def test_parse_holidays():
+    assert parse_holidays("2026-12-25, 2026-12-26\n2027-01-01") == {
+        datetime.date(2026, 12, 25), datetime.date(2026, 12, 26), datetime.date(2027, 1, 1)}
+    with pytest.raises(ValueError):
+        parse_holidays("25/12/2026")
@@ -0,0 +1,51 @@
+import io
+
+import numpy as np
+
+from dripmailer import storage
+from dripmailer.leads import spool_csv
+from dripmailer.preview import count_fallbacks, template_keys
+
+
+def spool(conn, campaign_id, count):
+    csv = "email,first_name,last_name,company,role\n" + "".join(f"{campaign_id}{i}@example.com,F{i},L,C,R\n" for i in range(count))
+    spool_csv(conn, io.BytesIO(csv.encode()), campaign_id)
+
+
+def test_sample_leads_is_stable_for_a_seed_and_stays_in_its_campaign(conn):
+    spool(conn, 'a', 200)
+    spool(conn, 'b', 50)
+    spool(conn, 'a', 100)  # a second upload under the same id leaves a gap of b's ids
+
+    sample = storage.sample_leads(conn, 'a', 10, seed=3)
+    assert len(sample) == 10
+    ids = [lead_id for lead_id, _ in sample]
+    assert ids == sorted(set(ids))
+    assert all(record['email'].startswith('a') for _, record in sample)
+    assert storage.sample_leads(conn, 'a', 10, seed=3) == sample
+    assert storage.sample_leads(conn, 'a', 10, seed=4) != sample
+
+
+def test_sample_leads_returns_every_lead_of_a_small_list(conn):
+    spool(conn, 'a', 3)
+    assert [record['email'] for _, record in storage.sample_leads(conn, 'a', 10)] == ['a0@example.com', 'a1@example.com', 'a2@example.com']
+    assert storage.sample_leads(conn, 'missing', 10) == []
+    assert storage.sample_leads(conn, 'a', 0) == []
+
+
+def test_count_fallbacks_counts_records_per_placeholder():
+    keys = template_keys("Hi {first_name} from {your_name}", "{Company} / { role }")
+    assert keys == ['company', 'first_name', 'role', 'your_name']
+    records = [
+        {'first_name': 'Ann', 'company': 'Acme', 'role': 'CTO'},
+        {'first_name': '', 'company': 'nan', 'role': None},
+        {'first_name': '   ', 'company': np.nan, 'role': 'VP'},
+        {'company': 'Initech'},
+    ]
+    counts, total = count_fallbacks(iter(records), keys, provided={'your_name': 'Me'})
+    assert total == 4
+    assert counts == {'company': 2, 'first_name': 3, 'role': 2, 'your_name': 0}
+
+    # A blank sender name falls back in every email
+    counts, _ = count_fallbacks(records, keys, provided={'your_name': ' '})
+    assert counts['your_name'] == 4
@@ -0,0 +1,59 @@
+import smtplib
+import time
+
+import pytest
+
+from dripmailer.ratelimit import (PERMANENT, TRANSIENT, AdaptiveRateLimiter, LimiterGroup, RateLimiter, backoff_delay,
+                                  classify_error, is_throttle)
+
+
+def test_rate_limiter_paces_acquires():
+    limiter = RateLimiter(20)
+    started = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+    # The first token is there from the start, the other five come 50ms apart
+    assert time.monotonic() - started == pytest.approx(0.25, abs=0.08)
+
+
+def test_rate_limiter_zero_is_unlimited():
+    limiter = RateLimiter(0)
+    started = time.monotonic()
+    for _ in range(1000):
+        limiter.acquire()
+    assert time.monotonic() - started < 0.1
+
+
+def test_adaptive_limiter_halves_down_to_its_floor_and_recovers():
+    limiter = AdaptiveRateLimiter(10, min_fraction=0.25, recovery=0.5)
+    limiter.slow_down()
+    assert limiter.rate == 5
+    for _ in range(5):
+        limiter.slow_down()
+    assert limiter.rate == 2.5
+    limiter.speed_up()
+    assert limiter.rate == 7.5
+    limiter.speed_up()
+    assert limiter.rate == 10
+
+
+def test_limiter_group_keeps_one_limiter_per_key():
+    group = LimiterGroup(5)
+    assert group.get('a@example.com') is group.get('a@example.com')
+    assert group.get('a@example.com') is not group.get('b@example.com')
+
+
+@pytest.mark.parametrize('error, expected', [
+    (smtplib.SMTPResponseException(451, b"Try again later"), (TRANSIENT, 451)),
+    (smtplib.SMTPRecipientsRefused({'x@example.com': (550, b"User unknown")}), (PERMANENT, 550)),
+    (smtplib.SMTPServerDisconnected("gone"), (TRANSIENT, None)),
+    (ValueError("bug"), (PERMANENT, None)),
+])
+def test_classify_error(error, expected):
+    assert classify_error(error) == expected
+
+
+def test_throttle_codes_and_backoff_cap():
+    assert is_throttle(smtplib.SMTPResponseException(421, b"Slow down"))
+    assert not is_throttle(smtplib.SMTPResponseException(550, b"No"))
+    assert all(0 <= backoff_delay(attempt, base=1, cap=8) <= 8 for attempt in range(20))
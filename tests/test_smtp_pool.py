@@ -0,0 +1,81 @@
+import smtplib
+import time
+
+import pytest
+
+from dripmailer.aiosmtp import AsyncSMTPPool
+from dripmailer.message import Envelope
+from dripmailer.smtp_pool import SMTPPool
+
+
+ACCOUNTS = [('a@example.com', 'secret'), ('b@example.com', 'secret')]
+
+
+def message(i, sender='me@example.com'):
+    return Envelope(sender, f"lead{i}@example.com", b"Subject: Hi\r\n\r\nHello\r\n", f"<{i}@example.com>")
+
+
+def jobs(senders, count):
+    for i in range(count):
+        yield i, message(i, senders[i % len(senders)])
+
+
+def test_results_come_back_in_submission_order(sink, pool_options):
+    pool_options.update(workers=3)
+    with SMTPPool('me@example.com', 'secret', **pool_options) as pool:
+        results = list(pool.imap((i, message(i)) for i in range(40)))
+    assert [tag for tag, _ in results] == list(range(40))
+    assert all(error is None for _, error in results)
+    assert sink.messages == 40
+    # One login up front, then one per remaining worker as it picks up its first job
+    assert sink.logins <= 3
+
+
+def test_a_failed_send_is_reported_for_its_own_message(sink, pool_options):
+    sink.replies['lead3@example.com'] = "550 5.1.1 User unknown"
+    with SMTPPool('me@example.com', 'secret', **pool_options) as pool:
+        results = dict(pool.imap((i, message(i)) for i in range(6)))
+    assert isinstance(results.pop(3), smtplib.SMTPRecipientsRefused)
+    assert all(error is None for error in results.values())
+    assert sink.messages == 5
+
+
+def test_dropped_connection_is_replaced(sink, pool_options):
+    # The relay hangs up after every 421, so each retry needs a new session
+    sink.replies['lead0@example.com'] = "421 4.7.0 Try again later"
+    pool_options.update(workers=1, max_retries=2, backoff_base=0)
+    with SMTPPool('me@example.com', 'secret', **pool_options) as pool:
+        refused, ok = list(pool.imap((i, message(i)) for i in range(2)))
+    assert refused[0] == 0 and refused[1] is not None
+    assert ok == (1, None)
+    assert sink.messages == 1
+    # Each of lead0's three tries and then lead1 went out over a fresh login
+    assert sink.logins == 4
+
+
+@pytest.mark.parametrize('pool_class', [SMTPPool, AsyncSMTPPool])
+def test_each_account_sends_its_own_messages(pool_class, sink, pool_options):
+    with pool_class('a@example.com', 'secret', accounts=ACCOUNTS, **pool_options) as pool:
+        results = list(pool.imap(jobs(['a@example.com', 'b@example.com'], 40)))
+    assert [tag for tag, _ in results] == list(range(40))
+    assert all(error is None for _, error in results)
+    assert sink.messages == 40
+
+
+@pytest.mark.parametrize('pool_class', [SMTPPool, AsyncSMTPPool])
+def test_global_rate_caps_all_accounts_together(pool_class, sink, pool_options):
+    pool_options.update(global_rate=20, account_rate=1000)
+    with pool_class('a@example.com', 'secret', accounts=ACCOUNTS, **pool_options) as pool:
+        started = time.monotonic()
+        list(pool.imap(jobs(['a@example.com', 'b@example.com'], 11)))
+        elapsed = time.monotonic() - started
+    # Ten waits of 50ms; at the per-account rate alone this would take a few milliseconds
+    assert elapsed >= 0.4
+
+
+def test_unknown_sender_fails_instead_of_using_another_account(sink, pool_options):
+    with SMTPPool('a@example.com', 'secret', accounts=ACCOUNTS, **pool_options) as pool:
+        results = dict(pool.imap(jobs(['a@example.com', 'nobody@example.com'], 6)))
+    assert [tag for tag, error in results.items() if error is None] == [0, 2, 4]
+    assert all(isinstance(results[tag], smtplib.SMTPSenderRefused) for tag in (1, 3, 5))
+    assert sink.messages == 3
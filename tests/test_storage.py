@@ -0,0 +1,210 @@
+import sqlite3
+from contextlib import closing
+
+from dripmailer import storage
+
+
+def test_claim_due_leases_rows_until_the_lease_expires(conn, queue_email):
+    queue_email('someone@example.com')
+
+    (row,) = storage.claim_due(conn, lease_seconds=300)
+    assert row['target_email'] == 'someone@example.com'
+    # Still leased to the first worker
+    assert storage.claim_due(conn) == []
+
+    # The worker died; once its lease runs out the row is claimable again
+    conn.execute("UPDATE scheduled_emails SET lease_until = ?", (storage.now_ts(-1),))
+    conn.commit()
+    assert [r['id'] for r in storage.claim_due(conn)] == [row['id']]
+
+
+def test_claim_due_takes_due_rows_in_order_and_skips_senders(conn, queue_email):
+    queue_email('later@example.com', send_at=storage.now_ts(3600))
+    queue_email('second@example.com', send_at=storage.now_ts(-60))
+    queue_email('first@example.com', send_at=storage.now_ts(-120))
+    queue_email('other@example.com', sender='other@example.com')
+
+    assert [r['target_email'] for r in storage.claim_due(conn, limit=1)] == ['first@example.com']
+    assert [r['target_email'] for r in storage.claim_due(conn, skip_senders=['other@example.com'])] == ['second@example.com']
+
+
+def test_release_hands_claimed_rows_back(conn, queue_email):
+    queue_email('someone@example.com')
+    (row,) = storage.claim_due(conn)
+    storage.release(conn, [row['id']])
+    assert tuple(conn.execute("SELECT status, lease_until FROM scheduled_emails").fetchone()) == ('pending', None)
+    assert len(storage.claim_due(conn)) == 1
+
+
+def test_migrations_convert_a_legacy_database(tmp_path):
+    path = str(tmp_path / 'campaigns.db')
+    legacy = sqlite3.connect(path)
+    storage._m001_create_scheduled_emails(legacy)
+    legacy.execute("INSERT INTO scheduled_emails (target_email, send_at, status) VALUES ('old@example.com', '2026-01-02 09:30:00', 'pending')")
+    legacy.commit()
+    legacy.close()
+
+    storage.init_db(path)
+    storage.init_db(path)
+    with closing(storage.connect(path)) as conn:
+        assert storage.schema_version(conn) == len(storage.MIGRATIONS)
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        (send_at,) = conn.execute("SELECT send_at FROM scheduled_emails").fetchone()
+        # Text times were local time
+        assert storage.format_ts(send_at) == '2026-01-02 09:30:00'
+        plan = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN SELECT id FROM scheduled_emails WHERE status = 'pending' AND send_at <= 0")]
+        assert any('idx_scheduled_status_send_at' in step for step in plan)
+
+
+def queue_followup(conn, campaign_id, target, template_id, send_at=0):
+    storage.enqueue_followups(conn, [storage.followup_row(campaign_id, target, template_id, {'first_name': 'X'}, send_at, 1)])
+    conn.commit()
+
+
+def test_blank_account_sender_name_falls_back_to_the_campaign(conn, make_campaign):
+    template_ids = make_campaign(leads=1, sender_name='Campaign Name')
+    storage.save_account(conn, 'other@example.com', 'secret', '  ')
+    assert storage.get_account(conn, 'other@example.com')['sender_name'] is None
+    conn.execute("UPDATE leads SET status = 'sent', sender_email = 'other@example.com'")
+    conn.commit()
+    queue_followup(conn, 'c1', 'lead0@example.com', template_ids[1])
+
+    (row,) = storage.claim_due(conn)
+    assert row['sender_email'] == 'other@example.com'
+    assert row['sender_name'] == 'Campaign Name'
+
+
+def test_legacy_empty_sender_name_is_ignored(conn, make_campaign):
+    template_ids = make_campaign(leads=1, sender_name='Campaign Name')
+    storage.save_account(conn, 'other@example.com', 'secret', 'Named')
+    # Accounts saved before blank names were stored as NULL
+    conn.execute("UPDATE accounts SET sender_name = ''")
+    conn.execute("UPDATE leads SET status = 'sent', sender_email = 'other@example.com'")
+    conn.commit()
+    queue_followup(conn, 'c1', 'lead0@example.com', template_ids[1])
+    assert storage.claim_due(conn)[0]['sender_name'] == 'Campaign Name'
+
+
+# --- RETENTION ---
+
+DAY = 86400
+
+
+def statuses(conn, table='scheduled_emails'):
+    return {r['target_email']: (r['status'], r['finished_at']) for r in conn.execute(f"SELECT * FROM {table}")}
+
+
+def test_terminal_updates_stamp_finished_at(conn, queue_email):
+    for target in ('sent@example.com', 'failed@example.com', 'suppressed@example.com', 'retry@example.com'):
+        queue_email(target)
+    rows = {r['target_email']: r['id'] for r in storage.claim_due(conn)}
+    storage.set_status(conn, rows['sent@example.com'], 'sent', message_id='<1@example.com>')
+    storage.set_status(conn, rows['failed@example.com'], 'failed', '550 User unknown')
+    storage.suppress_queued(conn, [(rows['suppressed@example.com'], "Unsubscribed")])
+    storage.reschedule(conn, rows['retry@example.com'], storage.now_ts(60), '451 Try later')
+
+    now = storage.now_ts()
+    found = statuses(conn)
+    assert found.pop('retry@example.com') == ('pending', None)
+    assert {status for status, _ in found.values()} == {'sent', 'failed', 'suppressed'}
+    assert all(now - 5 <= finished_at <= now for _, finished_at in found.values())
+
+
+def test_followups_cancelled_by_a_campaign_or_a_reply_are_stamped(conn, make_campaign):
+    template_ids = make_campaign(leads=2)
+    conn.execute("UPDATE leads SET status = CASE email WHEN 'lead0@example.com' THEN 'failed' ELSE 'sent' END")
+    for target in ('lead0@example.com', 'lead1@example.com'):
+        storage.enqueue_followups(conn, [storage.followup_row('c1', target, template_ids[1], {}, storage.now_ts(90 * DAY), 1)])
+    conn.commit()
+    assert storage.cancel_unsent_followups(conn, 'c1') == 1
+    assert storage.record_responses(conn, [('c1', 'lead1@example.com')], 'replied', now=1000) == 1
+    conn.commit()
+    found = statuses(conn)
+    assert found['lead1@example.com'] == ('cancelled', 1000)
+    assert found['lead0@example.com'][0] == 'cancelled' and found['lead0@example.com'][1] >= storage.now_ts(-5)
+
+
+def test_archive_counts_from_when_a_row_finished(conn, queue_email):
+    # Due long ago but only sent now, after a string of retries
+    queue_email('retried@example.com', send_at=storage.now_ts(-60 * DAY))
+    # A follow-up slot three months out, cancelled today
+    queue_email('cancelled@example.com', send_at=storage.now_ts(90 * DAY))
+    queue_email('pending@example.com', send_at=storage.now_ts(90 * DAY))
+    (row,) = storage.claim_due(conn)
+    storage.set_status(conn, row['id'], 'sent', message_id='<1@example.com>')
+    conn.execute("UPDATE scheduled_emails SET status = 'cancelled', finished_at = ? WHERE target_email = 'cancelled@example.com'", (storage.now_ts(),))
+    conn.commit()
+
+    assert storage.archivable_count(conn, 30) == 0
+    assert storage.archive_finished(conn, 30, pause=0) == 0
+
+    later = storage.now_ts(31 * DAY)
+    assert storage.archivable_count(conn, 30, now=later) == 2
+    batches = []
+    assert storage.archive_finished(conn, 30, batch_size=1, pause=0, now=later, on_batch=batches.append) == 2
+    assert batches == [1, 2]
+    assert set(statuses(conn)) == {'pending@example.com'}
+    archived = statuses(conn, 'scheduled_emails_archive')
+    assert {target: status for target, (status, _) in archived.items()} == {'retried@example.com': 'sent', 'cancelled@example.com': 'cancelled'}
+    (archived_row,) = conn.execute("SELECT * FROM scheduled_emails_archive WHERE status = 'sent'").fetchall()
+    assert archived_row['sender_email'] == 'me@example.com' and archived_row['message_id'] == '<1@example.com>'
+    assert archived_row['archived_at'] == later
+
+    stats = storage.storage_stats(conn)
+    assert stats['hot'] == {'pending': 1} and stats['archived'] == 2
+    assert storage.archivable_count(conn, 30, now=later) == 0
+
+
+def test_migration_backfills_finished_at(tmp_path):
+    path = str(tmp_path / 'campaigns.db')
+    with closing(sqlite3.connect(path)) as legacy:
+        for migration in storage.MIGRATIONS[:12]:
+            migration(legacy)
+        legacy.execute("PRAGMA user_version = 12")
+        legacy.executemany("INSERT INTO scheduled_emails (target_email, status, send_at) VALUES (?, ?, ?)", [
+            ('sent@example.com', 'sent', 1000),
+            ('cancelled@example.com', 'cancelled', storage.now_ts(90 * DAY)),
+            ('pending@example.com', 'pending', 2000),
+        ])
+        legacy.commit()
+
+    storage.init_db(path)
+    with closing(storage.connect(path)) as conn:
+        found = statuses(conn)
+    assert found['sent@example.com'] == ('sent', 1000)
+    assert found['pending@example.com'] == ('pending', None)
+    assert found['cancelled@example.com'][1] <= storage.now_ts()
+
+
+def test_reclaim_space_hands_archived_pages_back(conn, queue_email):
+    for i in range(200):
+        queue_email(f"lead{i}@example.com")
+    conn.execute("UPDATE scheduled_emails SET html_body = ?, status = 'sent', finished_at = 0", ("x" * 4000,))
+    conn.commit()
+    assert storage.storage_stats(conn)['incremental_vacuum']
+    size = storage.storage_stats(conn)['db_bytes']
+
+    assert storage.archive_finished(conn, 30, pause=0) == 200
+    assert storage.storage_stats(conn)['free_bytes'] > 0
+    freed = storage.reclaim_space(conn)
+    stats = storage.storage_stats(conn)
+    assert freed > 200 * 4000 * 0.9
+    # What is left is mostly the archive rows, without their bodies
+    assert stats['free_bytes'] == 0 and stats['db_bytes'] < size / 4
+
+
+def test_older_databases_switch_to_incremental_vacuum_once(tmp_path):
+    path = str(tmp_path / 'old.db')
+    with closing(sqlite3.connect(path)) as legacy:
+        storage._m001_create_scheduled_emails(legacy)
+        legacy.executemany("INSERT INTO scheduled_emails (target_email, html_body, status, send_at) VALUES (?, ?, 'sent', 0)",
+                           [(f"lead{i}@example.com", "x" * 4000) for i in range(50)])
+        legacy.commit()
+    storage.init_db(path)
+    with closing(storage.connect(path)) as conn:
+        assert not storage.storage_stats(conn)['incremental_vacuum']
+        assert storage.archive_finished(conn, 30, pause=0) == 50
+        assert storage.reclaim_space(conn) == 0
+        storage.enable_incremental_vacuum(conn)
+        stats = storage.storage_stats(conn)
+        assert stats['incremental_vacuum'] and stats['free_bytes'] == 0
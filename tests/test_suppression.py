@@ -0,0 +1,25 @@
+import pytest
+
+from dripmailer import storage
+from dripmailer.suppression import SuppressionList, normalize
+
+
+@pytest.mark.parametrize('value, expected', [
+    (" Someone@Example.COM ", ('someone@example.com', 'address')),
+    ("mailto:someone@example.com", ('someone@example.com', 'address')),
+    ("@Example.com", ('example.com', 'domain')),
+    ("example.com.", ('example.com', 'domain')),
+    ("not an address@", (None, None)),
+    ("localhost", (None, None)),
+    ("", (None, None)),
+])
+def test_normalize(value, expected):
+    assert normalize(value) == expected
+
+
+def test_domain_entries_cover_subdomains(conn):
+    storage.add_suppressions(conn, [('blocked.com', 'domain', "Asked us to stop"), ('one@example.com', 'address', "Unsubscribed")], 'manual')
+    suppressions = SuppressionList.load(conn)
+    assert suppressions.reason('anyone@mail.blocked.com') == "Asked us to stop"
+    assert suppressions.reason('ONE@example.com') == "Unsubscribed"
+    assert suppressions.reason('two@example.com') is None
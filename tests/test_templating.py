@@ -0,0 +1,48 @@
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from dripmailer.templating import render_many, render_template
+
+
+def legacy_render(template_str, row):
+    """The per-call re.sub renderer the app used before templates were compiled."""
+    def replace_var(match):
+        key = match.group(1).lower().strip()
+        val = row.get(key, "")
+        return str(val) if pd.notna(val) and str(val).strip() != "" and str(val).lower() != "nan" else f"[{match.group(1)}]"
+    return re.sub(r'\{([^}]+)\}', replace_var, template_str)
+
+
+TEMPLATES = [
+    "Hi {first_name}, about {Company}",
+    "Hi { First_Name }!",
+    "{first_name}{last_name}",
+    "Dear {unknown}, see {company}",
+    "No placeholders here",
+    "Unmatched {first_name and } braces { left {company",
+    "Stray } and {} and {{company}}",
+    "",
+]
+
+ROWS = [
+    {'first_name': "Ann", 'last_name': "Lee", 'company': "Acme"},
+    {'first_name': None, 'last_name': float('nan'), 'company': pd.NA},
+    {'first_name': "", 'last_name': "   ", 'company': "nan"},
+    {'first_name': "NaN", 'last_name': np.nan, 'company': " Acme "},
+    {'first_name': 7, 'last_name': 1.5, 'company': pd.NaT},
+    {},
+]
+
+
+@pytest.mark.parametrize("template", TEMPLATES)
+@pytest.mark.parametrize("row", ROWS)
+def test_compiled_render_matches_legacy(template, row):
+    assert render_template(template, row) == legacy_render(template, row)
+
+
+def test_render_many_matches_legacy():
+    template = "{first_name} at {company} ({ Last_Name })"
+    assert render_many(template, ROWS) == [legacy_render(template, r) for r in ROWS]
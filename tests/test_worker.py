@@ -0,0 +1,23 @@
+import sqlite3
+import threading
+
+from dripmailer import worker
+from dripmailer.dispatcher import Dispatcher
+
+
+def test_worker_keeps_polling_after_a_failed_round(tmp_path, monkeypatch, capsys):
+    stop = threading.Event()
+    rounds = []
+
+    def drain(self, conn, *args, **kwargs):
+        rounds.append(len(rounds))
+        if len(rounds) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        stop.set()
+        return 0
+
+    monkeypatch.setattr(Dispatcher, 'drain', drain)
+    worker.run(str(tmp_path / 'campaigns.db'), poll_interval=0.01, stop=stop)
+    assert rounds == [0, 1]
+    output = capsys.readouterr().out
+    assert "database is locked" in output and "Dispatcher stopped" in output